@@ -0,0 +1,18 @@
+import sys
+
+from main import backup_databases, close_db_pool, history_writer
+
+#Takes a consistent copy of app.db and the history while the server keeps running:
+#
+#   python backup.py [folder]
+#
+# Without a folder the copy goes to a new timestamped folder under BACKUP_DIR (data/backups). The server does the
+# same on POST /admin/backup
+
+result = backup_databases(sys.argv[1] if len(sys.argv) > 1 else None)
+history_writer.stop()
+close_db_pool()
+
+for name, size in result["files"].items():
+    print(f"{name}: {size} bytes")
+print(f"Backup written to {result['path']}")
@@ -0,0 +1,302 @@
+import argparse
+import asyncio
+import json
+import math
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import httpx
+
+#bench.py measures the hot paths of the API. It builds a synthetic rules table (same schema and importer as seed.py)
+# in a temporary directory, replays a mix of /check, /rules, /history and rule edits against the app in-process (no
+# server, no network) at a fixed concurrency, and writes throughput and p50/p95/p99 latency per endpoint as JSON.
+# Two result files can be compared with --compare old.json new.json
+#
+#   python bench.py --rules 100000 --requests 20000 --concurrency 32 --out results.json
+#
+# The /check traffic can be taken from real data with --traffic data/history.json (or any NDJSON file with drug_a and
+# drug_b on each line): the pairs that were found are added to the synthetic rules and used as hits, the others as misses
+
+DEFAULT_MIX = "check=70,rules=10,rule=5,history=10,mutate=5"
+SEVERITIES = ["contraindicated", "major", "moderate", "minor"]
+
+
+def parse_mix(text: str) -> dict[str, float]:
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in {"check", "rules", "rule", "history", "mutate"}:
+            raise SystemExit(f"Unknown traffic kind in --mix: {name}")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def load_traffic(paths: list[str]) -> tuple[list[tuple[str, str]], list[tuple[str, str]]]:
+    #returns (pairs that were found, pairs that were not) from history files (a JSON array) or NDJSON files.
+    # Lines without drug_a/drug_b are skipped, so any request log can be passed in
+    hits, misses = [], []
+    for path in paths:
+        text = Path(path).read_text(encoding="utf-8").strip()
+        if not text:
+            continue
+        if text.startswith("["):
+            records = json.loads(text)
+        else:
+            records = []
+            for line in text.splitlines():
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    continue
+        for rec in records:
+            if not isinstance(rec, dict):
+                continue
+            a, b = rec.get("drug_a"), rec.get("drug_b")
+            if not (isinstance(a, str) and isinstance(b, str) and a.strip() and b.strip()):
+                continue
+            (hits if rec.get("found", True) else misses).append((a, b))
+    return hits, misses
+
+
+def synthetic_rules(count: int, rng: random.Random):
+    #pairs drugN with the drugs after it until there are `count` rules, so about sqrt(2 * count) names are used
+    names = math.ceil(math.sqrt(2 * count)) + 1
+    made = 0
+    for i in range(names):
+        for j in range(i + 1, names):
+            if made >= count:
+                return
+            yield {
+                "a": f"drug{i:05d}",
+                "b": f"drug{j:05d}",
+                "severity": rng.choice(SEVERITIES),
+                "description": f"Synthetic interaction {made} " + "x" * rng.randint(20, 200),
+            }
+            made += 1
+
+
+def setup_app(workdir: Path, rules: int, traffic_hits: list[tuple[str, str]], seed: int):
+    import main
+
+    main.DB_PATH = str(workdir / "bench.db")
+    main.HISTORY_PATH = workdir / "history.json"
+    main.ensure_rules_schema()
+
+    rng = random.Random(seed)
+    records = list(synthetic_rules(rules, rng))
+    seen = {main.normalize_pair(r["a"], r["b"]) for r in records}
+    for a, b in traffic_hits:
+        pair = main.normalize_pair(a, b)
+        if pair[0] != pair[1] and pair not in seen:
+            seen.add(pair)
+            records.append({"a": a, "b": b, "severity": rng.choice(SEVERITIES), "description": "From traffic"})
+    report = main.import_rules(records, mode="insert")
+    if main.RULE_INDEX_ENABLED:
+        main.reload_rule_index()
+
+    with main.db_conn() as conn:
+        rows = conn.execute("SELECT id, a, b FROM rules").fetchall()
+    return main, rows, report["inserted"]
+
+
+def build_ops(count: int, mix: dict[str, float], hit_ratio: float, rules: list[tuple], traffic_hits: list,
+              traffic_misses: list, rng: random.Random) -> list[tuple]:
+    kinds, weights = zip(*mix.items())
+    hit_pairs = traffic_hits or [(a, b) for _, a, b in rules]
+    ops = []
+    for n in range(count):
+        kind = rng.choices(kinds, weights)[0]
+        if kind == "check":
+            if rng.random() < hit_ratio and hit_pairs:
+                a, b = rng.choice(hit_pairs)
+            elif traffic_misses:
+                a, b = rng.choice(traffic_misses)
+            else:
+                a, b = f"unknown{rng.randint(0, 10 ** 6)}", rng.choice(rules)[1]
+            if rng.random() < 0.5:
+                a, b = b, a
+            ops.append(("check", a, b))
+        elif kind == "rules":
+            ops.append(("rules", rng.choice([50, 200, 1000])))
+        elif kind == "rule":
+            ops.append(("rule", rng.choice(rules)[0]))
+        elif kind == "history":
+            ops.append(("history", rng.choice([20, 50, 200])))
+        else:
+            if rng.random() < 0.6:
+                ops.append(("update", rng.choice(rules)[0], rng.choice(SEVERITIES)))
+            else:
+                ops.append(("create_delete", f"benchnew{n}"))
+    return ops
+
+
+async def run_op(client: httpx.AsyncClient, op: tuple, samples: dict[str, list[float]], errors: dict[str, int]):
+    async def timed(label: str, method: str, url: str, **kwargs):
+        start = time.perf_counter()
+        resp = await client.request(method, url, **kwargs)
+        samples.setdefault(label, []).append(time.perf_counter() - start)
+        if resp.status_code >= 400:
+            errors[label] = errors.get(label, 0) + 1
+        return resp
+
+    kind = op[0]
+    if kind == "check":
+        await timed("POST /check", "POST", "/check", json={"drug_a": op[1], "drug_b": op[2]})
+    elif kind == "rules":
+        await timed("GET /rules", "GET", "/rules", params={"limit": op[1]})
+    elif kind == "rule":
+        await timed("GET /rules/{id}", "GET", f"/rules/{op[1]}")
+    elif kind == "history":
+        await timed("GET /history", "GET", "/history", params={"limit": op[1]})
+    elif kind == "update":
+        await timed("PUT /rules/{id}", "PUT", f"/rules/{op[1]}", params={"severity": op[2], "description": "Updated by bench"})
+    elif kind == "create_delete":
+        rule = {"id": op[1], "a": op[1], "b": "benchpartner", "severity": "minor", "description": "Created by bench"}
+        await timed("POST /rules", "POST", "/rules", json=rule)
+        await timed("DELETE /rules/{id}", "DELETE", f"/rules/{op[1]}")
+
+
+async def replay(app, ops: list[tuple], concurrency: int, samples: dict, errors: dict) -> float:
+    queue: asyncio.Queue = asyncio.Queue()
+    for op in ops:
+        queue.put_nowait(op)
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        async def worker():
+            while True:
+                try:
+                    op = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                await run_op(client, op, samples, errors)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        return time.perf_counter() - start
+
+
+def percentile(sorted_values: list[float], p: float) -> float:
+    #nearest-rank percentile, the same definition every run so results stay comparable
+    if not sorted_values:
+        return 0.0
+    rank = max(1, math.ceil(p / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def summarize(samples: dict[str, list[float]], errors: dict[str, int], elapsed: float) -> dict:
+    def stats(values: list[float], errs: int) -> dict:
+        values = sorted(values)
+        return {
+            "requests": len(values),
+            "errors": errs,
+            "throughput_rps": round(len(values) / elapsed, 1) if elapsed else 0.0,
+            "mean_ms": round(sum(values) / len(values) * 1000, 3) if values else 0.0,
+            "p50_ms": round(percentile(values, 50) * 1000, 3),
+            "p95_ms": round(percentile(values, 95) * 1000, 3),
+            "p99_ms": round(percentile(values, 99) * 1000, 3),
+            "max_ms": round(values[-1] * 1000, 3) if values else 0.0,
+        }
+
+    endpoints = {label: stats(values, errors.get(label, 0)) for label, values in sorted(samples.items())}
+    everything = [v for values in samples.values() for v in values]
+    return {"elapsed_s": round(elapsed, 3), "total": stats(everything, sum(errors.values())), "endpoints": endpoints}
+
+
+def git_commit() -> str | None:
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, timeout=5,
+                             cwd=Path(__file__).resolve().parent)
+    except (OSError, subprocess.SubprocessError):
+        return None
+    return out.stdout.strip() or None
+
+
+def run_benchmark(rules: int = 1000, requests: int = 2000, concurrency: int = 16, hit_ratio: float = 0.8,
+                  mix: str = DEFAULT_MIX, traffic: list[str] | None = None, warmup: int = 200, seed: int = 42,
+                  workdir: str | None = None) -> dict:
+    traffic_hits, traffic_misses = load_traffic(traffic or [])
+    with tempfile.TemporaryDirectory(dir=workdir) as tmp:
+        main, rows, inserted = setup_app(Path(tmp), rules, traffic_hits, seed)
+        try:
+            rng = random.Random(seed)
+            ops = build_ops(warmup + requests, parse_mix(mix), hit_ratio, rows, traffic_hits, traffic_misses, rng)
+            asyncio.run(replay(main.app, ops[:warmup], concurrency, {}, {}))
+            samples: dict[str, list[float]] = {}
+            errors: dict[str, int] = {}
+            elapsed = asyncio.run(replay(main.app, ops[warmup:], concurrency, samples, errors))
+        finally:
+            main.history_writer.stop()
+            main.close_db_pool()
+
+    return {
+        "config": {
+            "rules": inserted, "requests": requests, "concurrency": concurrency, "hit_ratio": hit_ratio,
+            "mix": mix, "traffic": traffic or [], "warmup": warmup, "seed": seed,
+            "rule_index": main.RULE_INDEX_ENABLED, "history_format": main.HISTORY_FORMAT,
+        },
+        "environment": {
+            "python": platform.python_version(), "platform": platform.platform(), "commit": git_commit(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        },
+        "results": summarize(samples, errors, elapsed),
+    }
+
+
+def print_results(report: dict):
+    results = report["results"]
+    print(f"{'endpoint':<22}{'requests':>9}{'errors':>8}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for label, s in [*results["endpoints"].items(), ("total", results["total"])]:
+        print(f"{label:<22}{s['requests']:>9}{s['errors']:>8}{s['throughput_rps']:>10}"
+              f"{s['p50_ms']:>10}{s['p95_ms']:>10}{s['p99_ms']:>10}")
+
+
+def compare(old_path: str, new_path: str):
+    old = json.loads(Path(old_path).read_text(encoding="utf-8"))["results"]
+    new = json.loads(Path(new_path).read_text(encoding="utf-8"))["results"]
+    print(f"{'endpoint':<22}{'metric':<16}{'old':>10}{'new':>10}{'change':>9}")
+    labels = sorted(set(old["endpoints"]) | set(new["endpoints"]))
+    for label in labels + ["total"]:
+        a = old["total"] if label == "total" else old["endpoints"].get(label)
+        b = new["total"] if label == "total" else new["endpoints"].get(label)
+        if a is None or b is None:
+            print(f"{label:<22}only in {'new' if a is None else 'old'} run")
+            continue
+        for metric in ("throughput_rps", "p50_ms", "p95_ms", "p99_ms"):
+            change = f"{(b[metric] - a[metric]) / a[metric] * 100:+.1f}%" if a[metric] else "n/a"
+            print(f"{label:<22}{metric:<16}{a[metric]:>10}{b[metric]:>10}{change:>9}")
+
+
+def main_cli(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the API hot paths in-process")
+    parser.add_argument("--rules", type=int, default=1000, help="synthetic rules to create (default 1000)")
+    parser.add_argument("--requests", type=int, default=2000, help="measured requests (default 2000)")
+    parser.add_argument("--concurrency", type=int, default=16, help="requests in flight at once (default 16)")
+    parser.add_argument("--hit-ratio", type=float, default=0.8, help="share of /check calls that find a rule (default 0.8)")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help=f"traffic weights (default {DEFAULT_MIX})")
+    parser.add_argument("--traffic", action="append", help="history.json or NDJSON file with drug_a/drug_b, can be repeated")
+    parser.add_argument("--warmup", type=int, default=200, help="requests sent before measuring (default 200)")
+    parser.add_argument("--seed", type=int, default=42, help="random seed, the same seed replays the same traffic")
+    parser.add_argument("--out", help="write the results as JSON to this file")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="compare two result files and exit")
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        compare(*args.compare)
+        return
+    report = run_benchmark(args.rules, args.requests, args.concurrency, args.hit_ratio, args.mix, args.traffic,
+                           args.warmup, args.seed)
+    print_results(report)
+    if args.out:
+        Path(args.out).write_text(json.dumps(report, indent=2), encoding="utf-8")
+        print(f"Results written to {args.out}")
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
@@ -0,0 +1,18 @@
+import sys
+
+from main import DB_PATH, RULE_SNAPSHOT_PATH, close_db_pool, compile_rules_snapshot
+
+#Compiles the rules table of app.db into the snapshot file the workers map when RULE_SNAPSHOT is set:
+#
+#   python compile_snapshot.py [snapshot path]
+#
+# The new file replaces the old one in one rename, and running workers switch to it within SNAPSHOT_CHECK_INTERVAL
+
+target = sys.argv[1] if len(sys.argv) > 1 else (RULE_SNAPSHOT_PATH or "data/rules.snap")
+result = compile_rules_snapshot(target)
+close_db_pool()
+
+if result["replaced"]:
+    print(f"Compiled {result['rules']} rules from {DB_PATH} into {target}")
+else:
+    print(f"{target} was replaced by a newer snapshot while compiling, kept that one")
@@ -1,15 +1,37 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel, Field
 from pathlib import Path
-import sqlite3, json, time
+from datetime import datetime, timezone
+import sqlite3, json, time, os, threading, queue, logging, atexit, base64, binascii, csv, heapq, math, asyncio, mmap, struct, re, gzip, zlib, shutil, tempfile
+import contextvars, cProfile, pstats, io, itertools, hmac, functools, sys, weakref, calendar
+from collections import OrderedDict
+from contextlib import asynccontextmanager, contextmanager
+import httpx
+from prometheus_client import REGISTRY, Counter, Gauge, Histogram
 from prometheus_fastapi_instrumentator import Instrumentator
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse
+from fastapi.responses import FileResponse, HTMLResponse, JSONResponse, PlainTextResponse, StreamingResponse
 from pathlib import Path
 
 
-app = FastAPI(title="Drug Interaction Verifier")
+#the lifespan hook runs once when the server starts, we use it to warm up the in-memory rule index (or to map the
+# rules snapshot) so the first /check after a deploy doesn't pay for loading it. On shutdown the queued history is written out first
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    ensure_rules_schema()
+    if RULE_SNAPSHOT_PATH:
+        current_snapshot()
+    elif RULE_INDEX_ENABLED:
+        reload_rule_index()
+    yield
+    history_writer.stop()
+    close_db_pool()
+
+
+app = FastAPI(title="Drug Interaction Verifier", lifespan=lifespan)
 Instrumentator().instrument(app).expose(app)
 
 app.mount("/static", StaticFiles(directory="app/static"), name="static")
@@ -35,6 +57,109 @@ app.add_middleware(
 DB_PATH = "app.db"
 HISTORY_PATH = Path(__file__).resolve().parents[1] / "data" / "history.json"
 VALID_SEVERITIES = {"contraindicated", "major", "moderate", "minor"}
+SEVERITY_RANK = {"contraindicated": 0, "major": 1, "moderate": 2, "minor": 3}
+REGIMEN_MAX_DRUGS = 100
+RULE_FIELDS = ("id", "a", "b", "severity", "description")
+RULES_PAGE_MAX = 1000
+RULES_STREAM_CHUNK = 500
+BULK_MODES = ("insert", "upsert", "skip-existing")
+BULK_CHUNK_SIZE = 500
+BULK_MAX_ERRORS = 1000
+SUGGEST_MIN_SCORE = 0.3
+SUGGEST_MAX = 20
+SEARCH_PAGE_SIZE = 20
+SEARCH_SNIPPET_TOKENS = 16
+
+#GET /pharmacies asks the upstream (Overpass by default) for square tiles of PHARMACY_TILE_DEG degrees and caches each
+# tile for PHARMACY_CACHE_TTL seconds, keeping at most PHARMACY_CACHE_TILES tiles (least recently used go first)
+PHARMACY_UPSTREAM_URL = os.environ.get("PHARMACY_UPSTREAM_URL", "https://overpass-api.de/api/interpreter")
+PHARMACY_UPSTREAM_TIMEOUT = float(os.environ.get("PHARMACY_UPSTREAM_TIMEOUT", 30))
+PHARMACY_TILE_DEG = float(os.environ.get("PHARMACY_TILE_DEG", 0.05))
+PHARMACY_CACHE_TTL = float(os.environ.get("PHARMACY_CACHE_TTL", 6 * 3600))
+PHARMACY_CACHE_TILES = int(os.environ.get("PHARMACY_CACHE_TILES", 2048))
+PHARMACY_MAX_RADIUS = 10000
+#Overpass only gives each IP a couple of query slots, so at most PHARMACY_UPSTREAM_CONCURRENCY queries run at a time
+PHARMACY_UPSTREAM_CONCURRENCY = int(os.environ.get("PHARMACY_UPSTREAM_CONCURRENCY", 2))
+
+#settings of the SQLite connection pool. WAL journaling lets readers keep going while a rule write commits,
+# synchronous=NORMAL is safe with WAL and avoids an fsync on every commit
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 8))
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", 10))
+DB_BUSY_TIMEOUT = float(os.environ.get("DB_BUSY_TIMEOUT", 5))
+DB_PRAGMAS = {
+    "journal_mode": os.environ.get("DB_JOURNAL_MODE", "WAL"),
+    "synchronous": os.environ.get("DB_SYNCHRONOUS", "NORMAL"),
+    "mmap_size": int(os.environ.get("DB_MMAP_SIZE", 64 * 1024 * 1024)),
+    "cache_size": int(os.environ.get("DB_CACHE_SIZE", -16000)),
+    "temp_store": "MEMORY",
+}
+RULE_INDEX_ENABLED = os.environ.get("RULE_INDEX", "1") != "0"
+#every worker keeps its own copy of the rule index and the alias map, and looks in app.db for changes made by other
+# processes (other workers, seed.py, restore.py) at most every RULES_SYNC_INTERVAL seconds
+RULES_SYNC_INTERVAL = float(os.environ.get("RULES_SYNC_INTERVAL", 1))
+#RULE_SNAPSHOT=data/rules.snap makes the rule lookups read a compiled snapshot file through mmap instead of the
+# in-memory index, so several workers share one copy of the rules in the page cache. Workers look for a newer file
+# at most every SNAPSHOT_CHECK_INTERVAL seconds, and a rule write recompiles it SNAPSHOT_REBUILD_DELAY seconds later
+RULE_SNAPSHOT_PATH = os.environ.get("RULE_SNAPSHOT", "")
+SNAPSHOT_CHECK_INTERVAL = float(os.environ.get("SNAPSHOT_CHECK_INTERVAL", 1))
+SNAPSHOT_REBUILD_DELAY = float(os.environ.get("SNAPSHOT_REBUILD_DELAY", 1))
+#GET /rules/changes keeps one entry per rule (its latest change) plus tombstones of deleted rules. Tombstones older than
+# RULE_CHANGES_RETENTION_DAYS are dropped (checked at most every RULE_CHANGES_COMPACT_INTERVAL seconds), a mirror that
+# is further behind than that has to download /rules again. A long poll waits at most RULE_CHANGES_MAX_WAIT seconds
+RULE_CHANGES_RETENTION_DAYS = float(os.environ.get("RULE_CHANGES_RETENTION_DAYS", 30))
+RULE_CHANGES_COMPACT_INTERVAL = 3600
+RULE_CHANGES_MAX_WAIT = 60
+RULE_CHANGES_POLL_INTERVAL = 1.0
+#POST /admin/backup (and backup.py) copy the databases with SQLite's online backup API, BACKUP_PAGES pages per step
+# with a pause of BACKUP_STEP_PAUSE seconds between steps, into a timestamped folder under BACKUP_DIR (data/backups).
+# The endpoint is off unless BACKUP_TOKEN is set, and then only answers requests sending "X-Backup-Token: <BACKUP_TOKEN>"
+BACKUP_DIR = os.environ.get("BACKUP_DIR", "")
+BACKUP_TOKEN = os.environ.get("BACKUP_TOKEN", "")
+BACKUP_PAGES = int(os.environ.get("BACKUP_PAGES", 256))
+BACKUP_STEP_PAUSE = float(os.environ.get("BACKUP_STEP_PAUSE", 0.005))
+EXPORT_VERSION = 1
+EXPORT_CHUNK_BYTES = 64 * 1024
+#request profiling is off unless PROFILE_TOKEN or PROFILE_SAMPLE_EVERY is set, and then a request sending the header
+# "X-Profile: <PROFILE_TOKEN>" is profiled, and so is one request out of every PROFILE_SAMPLE_EVERY. The profiles are
+# written to PROFILE_DIR (data/profiles) and only the newest PROFILE_KEEP are kept
+PROFILE_TOKEN = os.environ.get("PROFILE_TOKEN", "")
+PROFILE_SAMPLE_EVERY = int(os.environ.get("PROFILE_SAMPLE_EVERY", 0))
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "")
+PROFILE_KEEP = int(os.environ.get("PROFILE_KEEP", 50))
+#CHECK_COALESCE=0 turns off the sharing of one lookup between concurrent /check requests for the same pair
+CHECK_COALESCE = os.environ.get("CHECK_COALESCE", "1") != "0"
+#METRICS_BUCKETS overrides the buckets (in seconds, comma separated) of the latency histograms on /metrics, and
+# DB_QUERY_METRICS=0 turns off the per-statement query timing
+METRICS_BUCKETS = os.environ.get("METRICS_BUCKETS", "")
+DB_QUERY_METRICS = os.environ.get("DB_QUERY_METRICS", "1") != "0"
+#Cache-Control sent with the ETags of GET /rules and /rules/{id}. "no-cache" lets clients keep the response but makes
+# them ask again every time (which is cheap thanks to the ETag), "max-age=60" would let them skip asking for a minute
+RULES_CACHE_CONTROL = os.environ.get("RULES_CACHE_CONTROL", "no-cache")
+
+#history is stored in an indexed SQLite table (history.db next to the history file) so /history can filter without
+# reading everything. HISTORY_FORMAT=ndjson stores it as an append-only log with one JSON object per line instead, and
+# HISTORY_FORMAT=json keeps the old behaviour of rewriting one big JSON array. When the ndjson log grows past
+# HISTORY_MAX_BYTES it is rotated into a numbered segment, and old segments are dropped once there are more than
+# HISTORY_MAX_SEGMENTS. HISTORY_MAX_AGE_DAYS drops history older than that many days in both formats (the ndjson log
+# is then also rotated when its oldest entry gets that old, so its segments expire without growing to HISTORY_MAX_BYTES)
+HISTORY_FORMAT = os.environ.get("HISTORY_FORMAT", "sqlite")
+HISTORY_MAX_BYTES = int(os.environ.get("HISTORY_MAX_BYTES", 5 * 1024 * 1024))
+HISTORY_MAX_SEGMENTS = int(os.environ.get("HISTORY_MAX_SEGMENTS", 10))
+HISTORY_MAX_AGE_DAYS = float(os.environ.get("HISTORY_MAX_AGE_DAYS", 0))
+HISTORY_COMPACT_INTERVAL = 3600
+
+#the checks don't write their history themselves, they put it on a queue that a background thread writes out in
+# batches of HISTORY_FLUSH_COUNT entries or every HISTORY_FLUSH_INTERVAL seconds. When the queue is full the
+# HISTORY_QUEUE_POLICY decides what happens: "spill" writes on the request thread, "block" waits for room, "drop" drops and counts
+HISTORY_ASYNC = os.environ.get("HISTORY_ASYNC", "1") != "0"
+HISTORY_QUEUE_SIZE = int(os.environ.get("HISTORY_QUEUE_SIZE", 10000))
+HISTORY_FLUSH_COUNT = int(os.environ.get("HISTORY_FLUSH_COUNT", 500))
+HISTORY_FLUSH_INTERVAL = float(os.environ.get("HISTORY_FLUSH_INTERVAL", 0.5))
+#the longest a reader (GET /history, the export, ...) waits for the queued history to be written before reading anyway
+HISTORY_FLUSH_TIMEOUT = float(os.environ.get("HISTORY_FLUSH_TIMEOUT", 10))
+HISTORY_QUEUE_POLICY = os.environ.get("HISTORY_QUEUE_POLICY", "spill")
+
+logger = logging.getLogger("medaid")
 
 
 # The following part of the code defines a class called CheckReq which is a subclass of BaseModel which comes from python's
@@ -53,11 +178,75 @@ class CheckResp(BaseModel):
     message: str | None = None
     suggest_add: bool | None = None
     how_to_add: dict | None = None 
+    did_you_mean: dict[str, list[str]] | None = None
+
+#POST /check answers are encoded once and sent as raw bytes instead of going through CheckResp and FastAPI's encoder
+# on every request. The bytes are exactly what FastAPI would send for the same CheckResp (same field order, compact
+# separators, non-ASCII kept as is). A hit is the stored bytes of the rule, a miss is filled into a template where only
+# the two drug names and did_you_mean change
+
+class RawJSONResponse(Response):
+    media_type = "application/json"
+
+def encode_json(value) -> bytes:
+    return json.dumps(value, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8")
+
+#every CheckResp field set to None, in the model's order, so a found answer can be encoded without building the model
+CHECK_RESP_EMPTY = dict.fromkeys(CheckResp.model_fields)
+
+def encode_check_found(severity: str, description: str) -> bytes:
+    return encode_json({**CHECK_RESP_EMPTY, "found": True, "severity": severity, "description": description})
+
+def _check_miss_template() -> tuple[bytes, bytes, bytes, bytes]:
+    marker_a, marker_b, marker_hint = "\x00a", "\x00b", "\x00hint"
+    text = encode_json({
+        **CheckResp(
+            found=False,
+            message="No known interaction in local DB.",
+            suggest_add=True,
+            how_to_add={
+                "endpoint": "POST /rules",
+                "body_example": {
+                    "a": marker_a, "b": marker_b,
+                    "severity": "moderate",
+                    "description": "Describe the interaction here..."
+                },
+                "note": "Pairs are order-independent; inputs are stored alphabetically."
+            }
+        ).model_dump(),
+        "did_you_mean": marker_hint,
+    })
+    head, rest = text.split(encode_json(marker_a))
+    middle, rest = rest.split(encode_json(marker_b))
+    tail, end = rest.split(encode_json(marker_hint))
+    return head, middle, tail, end
+
+CHECK_MISS_TEMPLATE = _check_miss_template()
+
+def encode_check_miss(a: str, b: str, hints: dict[str, list[str]] | None) -> bytes:
+    head, middle, tail, end = CHECK_MISS_TEMPLATE
+    return b"".join((head, encode_json(a), middle, encode_json(b), tail, encode_json(hints), end))
 
 #The fastAPI consists of the request and response, here the request is asking for 2 medications and the response
 # follows a structure that depends on whether the interaction was found or not (but that is always included, while the rest
 # like severity, description etc are optional and depend on the situation)
 
+#The regimen check takes a whole medication list instead of two drugs and answers with every interacting pair in it
+
+class RegimenReq(BaseModel):
+    drugs: list[str] = Field(..., min_length=2, max_length=REGIMEN_MAX_DRUGS, example=["Aspirin", "Ibuprofen", "Prednisone"])
+
+class RegimenInteraction(BaseModel):
+    drug_a: str
+    drug_b: str
+    severity: str
+    description: str
+
+class RegimenResp(BaseModel):
+    drugs: list[str]
+    pairs_checked: int
+    interactions: list[RegimenInteraction]
+
 class RuleIn(BaseModel):
     id: str | None = None  
     a: str
@@ -74,96 +263,2163 @@ class RuleOut(BaseModel):
 
 
 def normalize_pair(a: str, b: str) -> tuple[str, str]:
-    a = a.strip().lower()
-    b = b.strip().lower()
+    a = canonical_name(a)
+    b = canonical_name(b)
     return (a, b) if a <= b else (b, a)
 
+#Brand names and other synonyms are mapped to one canonical ingredient name (for example tylenol -> acetaminophen)
+# before anything is looked up, so a rule stored under the ingredient also matches its brand names. The map lives in
+# the aliases table and is kept in memory, so canonicalizing a name is one dict lookup. `targets` is the reverse map,
+# it is what lets us find the aliases that point at a name without going through all of them. Triggers count every
+# write to the aliases table in rule_changes_meta ('aliases'), and `version` is the count the map was loaded at, so a
+# worker notices an alias added by another process and loads the map again (see sync_aliases)
+
+class AliasIndex:
+    def __init__(self):
+        self.loaded = False
+        self.forward: dict[str, str] = {}
+        self.targets: dict[str, set[str]] = {}
+        self.version = 0
+        self.checked_at = 0.0
+
+    def load(self, rows, version: int = 0):
+        forward, targets = {}, {}
+        for alias, canonical in rows:
+            forward[alias] = canonical
+            targets.setdefault(canonical, set()).add(alias)
+        self.forward, self.targets = forward, targets
+        self.version = version
+        self.checked_at = time.monotonic()
+        self.loaded = True
+
+    def set(self, alias: str, canonical: str):
+        #the aliases that pointed at `alias` are moved to `canonical` so the map never has chains
+        for other in self.targets.pop(alias, set()):
+            self.forward[other] = canonical
+            self.targets.setdefault(canonical, set()).add(other)
+        self.remove(alias)
+        self.forward[alias] = canonical
+        self.targets.setdefault(canonical, set()).add(alias)
+
+    def remove(self, alias: str):
+        canonical = self.forward.pop(alias, None)
+        if canonical is not None:
+            self.targets.get(canonical, set()).discard(alias)
+
+
+alias_index = AliasIndex()
+
+def aliases_version(conn) -> int:
+    try:
+        row = conn.execute("SELECT value FROM rule_changes_meta WHERE key='aliases'").fetchone()
+    except sqlite3.OperationalError:
+        #a database from before the change log existed
+        return 0
+    return row[0] if row else 0
+
+def load_aliases():
+    old = alias_index.forward
+    with db_conn() as conn:
+        version = aliases_version(conn)
+        try:
+            rows = conn.execute("SELECT alias, canonical FROM aliases").fetchall()
+        except sqlite3.OperationalError:
+            #a database from before the aliases table existed
+            rows = []
+    alias_index.load(rows, version)
+    if rule_index.loaded:
+        #the alias names are suggested too
+        for alias in alias_index.forward.keys() - old.keys():
+            rule_index.names.add(alias)
+        for alias in old.keys() - alias_index.forward.keys():
+            rule_index.names.discard(alias)
+
+def sync_aliases():
+    #loads the map again when the aliases table changed since it was loaded. A write of this process holds the write
+    # lock until it has updated the map itself, so the check is skipped then instead of reading a half-done change
+    alias_index.checked_at = time.monotonic()
+    if not _rules_write_lock.acquire(blocking=False):
+        return
+    try:
+        with db_conn() as conn:
+            version = aliases_version(conn)
+        if version != alias_index.version:
+            load_aliases()
+    finally:
+        _rules_write_lock.release()
+
+def canonical_name(name: str) -> str:
+    name = name.strip().lower()
+    if not alias_index.loaded:
+        load_aliases()
+    elif time.monotonic() - alias_index.checked_at >= RULES_SYNC_INTERVAL:
+        sync_aliases()
+    return alias_index.forward.get(name, name)
+
+#Prometheus metrics are registered in the default registry that Instrumentator exposes on /metrics. The tests load
+# main.py several times, so an already registered metric is reused instead of being registered twice
+
+def get_metric(kind, name: str, documentation: str, **kwargs):
+    existing = REGISTRY._names_to_collectors.get(name)
+    if existing is not None:
+        return existing
+    return kind(name, documentation, **kwargs)
+
+def metric_buckets(default: tuple[float, ...]) -> tuple[float, ...]:
+    if not METRICS_BUCKETS:
+        return default
+    try:
+        return tuple(sorted(float(b) for b in METRICS_BUCKETS.split(",") if b.strip()))
+    except ValueError:
+        logger.warning("ignoring invalid METRICS_BUCKETS=%r", METRICS_BUCKETS)
+        return default
+
+LATENCY_BUCKETS = metric_buckets((0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5))
+
+DB_POOL_WAIT = get_metric(Histogram, "db_pool_checkout_seconds", "Time spent waiting for a pooled SQLite connection",
+                          buckets=LATENCY_BUCKETS)
+DB_POOL_OPEN = get_metric(Gauge, "db_pool_connections", "SQLite connections opened by the pool")
+DB_CONNECT_SECONDS = get_metric(Histogram, "db_connection_open_seconds", "Time to open and set up a SQLite connection",
+                                buckets=LATENCY_BUCKETS)
+DB_QUERY_SECONDS = get_metric(Histogram, "db_query_seconds", "Time to execute a SQLite statement, by statement",
+                              labelnames=["statement"], buckets=LATENCY_BUCKETS)
+CACHE_REQUESTS = get_metric(Counter, "cache_requests", "Lookups in the in-memory caches", labelnames=["cache", "result"])
+CHECK_RESULTS = get_metric(Counter, "check_results", "POST /check answers by found and severity", labelnames=["found", "severity"])
+
+RULE_INDEX_HIT = CACHE_REQUESTS.labels("rule_index", "hit")
+RULE_INDEX_MISS = CACHE_REQUESTS.labels("rule_index", "miss")
+ETAG_HIT = CACHE_REQUESTS.labels("rules_etag", "hit")
+ETAG_MISS = CACHE_REQUESTS.labels("rules_etag", "miss")
+
+#every statement is timed under a short label like "select rules" or "insert history" (the first keyword and the
+# table it works on) so the number of series stays small. The label of a SQL string is worked out once and cached
+
+_statement_labels: dict[str, str] = {}
+
+def statement_label(sql: str) -> str:
+    label = _statement_labels.get(sql)
+    if label is None:
+        words = sql.replace("(", " ").replace(")", " ").lower().split()
+        verb = words[0] if words else "unknown"
+        table = ""
+        for keyword in ("from", "into", "update", "table", "exists", "on"):
+            if keyword in words[:-1]:
+                table = words[words.index(keyword) + 1].strip('",')
+                break
+        label = f"{verb} {table}".strip()
+        if len(_statement_labels) < 1000:
+            _statement_labels[sql] = label
+    return label
+
+class TimedCursor(sqlite3.Cursor):
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            DB_QUERY_SECONDS.labels(statement_label(sql)).observe(time.perf_counter() - start)
+
+    def executemany(self, sql, seq_of_parameters):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            DB_QUERY_SECONDS.labels(statement_label(sql)).observe(time.perf_counter() - start)
+
+class TimedConnection(sqlite3.Connection):
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+#The ConnectionPool keeps up to DB_POOL_SIZE SQLite connections open and hands them out to the request threads,
+# instead of every endpoint opening (and setting up) a new connection. A connection is only used by one thread at a time.
+
+class ConnectionPool:
+    def __init__(self, path: str, size: int):
+        self.path = path
+        self.size = size
+        self._idle: queue.LifoQueue = queue.LifoQueue()
+        self._opened = 0
+        self._lock = threading.Lock()
+
+    def _open(self) -> sqlite3.Connection:
+        start = time.perf_counter()
+        factory = TimedConnection if DB_QUERY_METRICS else sqlite3.Connection
+        conn = sqlite3.connect(self.path, timeout=DB_BUSY_TIMEOUT, check_same_thread=False, factory=factory)
+        for name, value in DB_PRAGMAS.items():
+            conn.execute(f"PRAGMA {name}={value}")
+        DB_CONNECT_SECONDS.observe(time.perf_counter() - start)
+        return conn
+
+    def acquire(self) -> sqlite3.Connection:
+        start = time.perf_counter()
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            conn = None
+            with self._lock:
+                can_open = self._opened < self.size
+                if can_open:
+                    self._opened += 1
+            if can_open:
+                try:
+                    conn = self._open()
+                except Exception:
+                    with self._lock:
+                        self._opened -= 1
+                    raise
+                DB_POOL_OPEN.inc()
+            else:
+                try:
+                    conn = self._idle.get(timeout=DB_POOL_TIMEOUT)
+                except queue.Empty:
+                    raise HTTPException(503, "Database is busy, try again")
+        DB_POOL_WAIT.observe(time.perf_counter() - start)
+        return conn
+
+    def release(self, conn: sqlite3.Connection):
+        self._idle.put(conn)
+
+    def close(self):
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            DB_POOL_OPEN.dec()
+            with self._lock:
+                self._opened -= 1
+
+
+#there is one pool per database file: app.db for the rules and the history database next to the history file
+
+_pools: dict[str, ConnectionPool] = {}
+_pool_lock = threading.Lock()
+
+def get_db_pool(path: str | None = None) -> ConnectionPool:
+    path = path or DB_PATH
+    pool = _pools.get(path)
+    if pool is None:
+        with _pool_lock:
+            pool = _pools.get(path)
+            if pool is None:
+                pool = _pools[path] = ConnectionPool(path, DB_POOL_SIZE)
+    return pool
+
+def close_db_pool():
+    for pool in list(_pools.values()):
+        pool.close()
+
+#db_conn is used like sqlite3.connect in a with block: the transaction is committed at the end of the block
+# (or rolled back on an error) and the connection goes back to the pool instead of being closed
+
+@contextmanager
+def db_conn(path: str | None = None):
+    pool = get_db_pool(path)
+    conn = pool.acquire()
+    try:
+        with conn:
+            yield conn
+    finally:
+        pool.release(conn)
+
+#The rules table and its indexes. ux_rules_pair makes the pair unique no matter the order, ix_rules_pair is a plain
+# index on the stored (already normalized) pair so that lookups with a=? AND b=? don't have to scan the table.
+# ix_rules_pair also serves a=? on its own, and ix_rules_b is there for b=?, so the rules of one drug are two index lookups.
+# seed.py creates the schema through ensure_rules_schema too, so both always agree
+
+RULES_SCHEMA = """
+CREATE TABLE IF NOT EXISTS rules (
+    id TEXT PRIMARY KEY,
+    a  TEXT NOT NULL,
+    b  TEXT NOT NULL,
+    severity TEXT NOT NULL,
+    description TEXT NOT NULL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS ux_rules_pair
+ON rules(
+    CASE WHEN a < b THEN a ELSE b END,
+    CASE WHEN a < b THEN b ELSE a END
+);
+CREATE INDEX IF NOT EXISTS ix_rules_pair ON rules(a, b);
+CREATE INDEX IF NOT EXISTS ix_rules_b ON rules(b);
+CREATE TABLE IF NOT EXISTS aliases (
+    alias TEXT PRIMARY KEY,
+    canonical TEXT NOT NULL
+);
+"""
+
+#rules_fts is the full-text index behind GET /rules/search. It is an external content FTS5 table, so it only stores
+# the index and reads the text itself from the rules table (joined on rowid). The triggers keep it in sync with every
+# write to rules, whether it comes from the API, the bulk importer, an alias rename or a script. The porter tokenizer
+# lets "prolonged" find "prolongation", and the rank setting weighs a match in a drug name higher than one in the description
+
+RULES_SEARCH_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS rules_fts USING fts5(
+    a, b, description,
+    content='rules', content_rowid='rowid',
+    tokenize='porter unicode61 remove_diacritics 2'
+);
+CREATE TRIGGER IF NOT EXISTS rules_fts_insert AFTER INSERT ON rules BEGIN
+    INSERT INTO rules_fts(rowid, a, b, description) VALUES (new.rowid, new.a, new.b, new.description);
+END;
+CREATE TRIGGER IF NOT EXISTS rules_fts_delete AFTER DELETE ON rules BEGIN
+    INSERT INTO rules_fts(rules_fts, rowid, a, b, description) VALUES ('delete', old.rowid, old.a, old.b, old.description);
+END;
+CREATE TRIGGER IF NOT EXISTS rules_fts_update AFTER UPDATE OF a, b, description ON rules BEGIN
+    INSERT INTO rules_fts(rules_fts, rowid, a, b, description) VALUES ('delete', old.rowid, old.a, old.b, old.description);
+    INSERT INTO rules_fts(rowid, a, b, description) VALUES (new.rowid, new.a, new.b, new.description);
+END;
+"""
+_rules_search_ready: set[str] = set()
+_rules_schema_lock = threading.Lock()
+
+#rule_changes is the change log behind GET /rules/changes, filled by triggers so every write to the rules table is
+# in it, no matter which endpoint or script made it. A change replaces the earlier entry of the same rule (INSERT OR
+# REPLACE gives it a new seq), so the log holds one row per rule and a mirror only ever gets the latest state. Deleting
+# a rule leaves a tombstone (deleted=1). AUTOINCREMENT makes sure a seq is never handed out twice, even after deletes
+
+RULE_CHANGES_SCHEMA = """
+CREATE TABLE IF NOT EXISTS rule_changes (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    rule_id TEXT NOT NULL UNIQUE,
+    deleted INTEGER NOT NULL,
+    ts TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS rule_changes_meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL);
+CREATE TRIGGER IF NOT EXISTS rule_changes_insert AFTER INSERT ON rules BEGIN
+    INSERT OR REPLACE INTO rule_changes(rule_id, deleted, ts) VALUES (new.id, 0, strftime('%Y-%m-%dT%H:%M:%SZ', 'now'));
+END;
+CREATE TRIGGER IF NOT EXISTS rule_changes_update AFTER UPDATE ON rules BEGIN
+    INSERT OR REPLACE INTO rule_changes(rule_id, deleted, ts)
+    SELECT old.id, 1, strftime('%Y-%m-%dT%H:%M:%SZ', 'now') WHERE old.id <> new.id;
+    INSERT OR REPLACE INTO rule_changes(rule_id, deleted, ts) VALUES (new.id, 0, strftime('%Y-%m-%dT%H:%M:%SZ', 'now'));
+END;
+CREATE TRIGGER IF NOT EXISTS rule_changes_delete AFTER DELETE ON rules BEGIN
+    INSERT OR REPLACE INTO rule_changes(rule_id, deleted, ts) VALUES (old.id, 1, strftime('%Y-%m-%dT%H:%M:%SZ', 'now'));
+END;
+CREATE TRIGGER IF NOT EXISTS aliases_version_insert AFTER INSERT ON aliases BEGIN
+    INSERT INTO rule_changes_meta(key, value) VALUES ('aliases', 1) ON CONFLICT(key) DO UPDATE SET value=value+1;
+END;
+CREATE TRIGGER IF NOT EXISTS aliases_version_update AFTER UPDATE ON aliases BEGIN
+    INSERT INTO rule_changes_meta(key, value) VALUES ('aliases', 1) ON CONFLICT(key) DO UPDATE SET value=value+1;
+END;
+CREATE TRIGGER IF NOT EXISTS aliases_version_delete AFTER DELETE ON aliases BEGIN
+    INSERT INTO rule_changes_meta(key, value) VALUES ('aliases', 1) ON CONFLICT(key) DO UPDATE SET value=value+1;
+END;
+"""
+_rule_changes_ready: set[str] = set()
+_rule_changes_compacted_at = 0.0
+
+def ensure_rules_schema():
+    with db_conn() as conn:
+        conn.executescript(RULES_SCHEMA)
+    ensure_rules_search()
+    ensure_rule_changes()
+
+def ensure_rules_search():
+    #creates the search index the first time and fills it from the rules that are already there
+    if DB_PATH in _rules_search_ready:
+        return
+    with _rules_schema_lock:
+        if DB_PATH in _rules_search_ready:
+            return
+        with db_conn() as conn:
+            exists = conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='rules_fts'").fetchone()
+            if not exists:
+                conn.executescript(RULES_SCHEMA + RULES_SEARCH_SCHEMA)
+                with conn:
+                    conn.execute("INSERT INTO rules_fts(rules_fts) VALUES ('rebuild')")
+                    conn.execute("INSERT INTO rules_fts(rules_fts, rank) VALUES ('rank', 'bm25(10.0, 10.0, 1.0)')")
+        _rules_search_ready.add(DB_PATH)
+
+def ensure_rule_changes():
+    #creates the change log the first time, with an entry for every rule that is already there so a mirror starting
+    # from since=0 gets the whole rule set
+    if DB_PATH in _rule_changes_ready:
+        return
+    with _rules_schema_lock:
+        if DB_PATH in _rule_changes_ready:
+            return
+        with db_conn() as conn:
+            exists = conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='rule_changes'").fetchone()
+            #run every time so a database made before a trigger was added gets it too
+            conn.executescript(RULES_SCHEMA + RULE_CHANGES_SCHEMA)
+            if not exists:
+                with conn:
+                    conn.execute(
+                        "INSERT OR IGNORE INTO rule_changes(rule_id, deleted, ts) "
+                        "SELECT id, 0, strftime('%Y-%m-%dT%H:%M:%SZ', 'now') FROM rules ORDER BY id"
+                    )
+            with conn:
+                conn.execute("INSERT OR IGNORE INTO rule_changes_meta(key, value) VALUES ('epoch', ?)", (new_rules_epoch(),))
+        _rule_changes_ready.add(DB_PATH)
+
+def new_rules_epoch() -> int:
+    return int.from_bytes(os.urandom(4), "big")
+
+#The ETags of GET /rules and /rules/{id} come from the change log, which every worker process and every script writing
+# to app.db shares: the list's version is the last seq handed out (every create, update and delete takes a new one) and
+# a rule's version is the seq of its latest change. A rule without an entry, or a deleted one, has no version and so no
+# ETag, it is never answered with 304. `epoch` is random per database and renewed by /admin/reload-rules, so ETags from
+# before an outside change that skipped the triggers (a restored backup, a replaced file) never match
+
+def rules_etag() -> tuple[str, int]:
+    #the ETag of the whole list, and the change-log position it was made from
+    ensure_rule_changes()
+    with db_conn() as conn:
+        epoch, seq = conn.execute(
+            "SELECT (SELECT value FROM rule_changes_meta WHERE key='epoch'), "
+            "(SELECT seq FROM sqlite_sequence WHERE name='rule_changes')"
+        ).fetchone()
+    seq = seq or 0
+    return f'"rs-{epoch:08x}-{seq}"', seq
+
+def rule_etag(rule_id: str) -> str | None:
+    ensure_rule_changes()
+    with db_conn() as conn:
+        epoch, seq = conn.execute(
+            "SELECT (SELECT value FROM rule_changes_meta WHERE key='epoch'), "
+            "(SELECT seq FROM rule_changes WHERE rule_id=? AND deleted=0)",
+            (rule_id,)
+        ).fetchone()
+    return f'"r-{epoch:08x}-{seq}"' if seq is not None else None
+
+def compact_rule_changes() -> int:
+    #drops the tombstones older than RULE_CHANGES_RETENTION_DAYS and remembers the highest seq dropped, a mirror whose
+    # since= is below it could have missed a delete. Runs at most once per RULE_CHANGES_COMPACT_INTERVAL seconds
+    global _rule_changes_compacted_at
+    if RULE_CHANGES_RETENTION_DAYS <= 0 or time.time() - _rule_changes_compacted_at < RULE_CHANGES_COMPACT_INTERVAL:
+        return 0
+    _rule_changes_compacted_at = time.time()
+    cutoff = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(time.time() - RULE_CHANGES_RETENTION_DAYS * 86400))
+    with db_conn() as conn:
+        purged = conn.execute("SELECT max(seq), count(*) FROM rule_changes WHERE deleted=1 AND ts < ?", (cutoff,)).fetchone()
+        if not purged[1]:
+            return 0
+        conn.execute("DELETE FROM rule_changes WHERE deleted=1 AND seq <= ?", (purged[0],))
+        conn.execute(
+            "INSERT INTO rule_changes_meta(key, value) VALUES ('purged_seq', ?) "
+            "ON CONFLICT(key) DO UPDATE SET value=max(value, excluded.value)",
+            (purged[0],)
+        )
+    return purged[1]
+
+def read_rule_changes(since: int, limit: int) -> dict:
+    ensure_rule_changes()
+    compact_rule_changes()
+    with db_conn() as conn:
+        purged = conn.execute("SELECT value FROM rule_changes_meta WHERE key='purged_seq'").fetchone()
+        if since > 0 and purged and since < purged[0]:
+            raise HTTPException(410, "since is older than the change log, download GET /rules again and continue from its X-Rules-Seq")
+        rows = conn.execute(
+            """
+            SELECT c.seq, c.rule_id, c.deleted, r.a, r.b, r.severity, r.description
+            FROM rule_changes c LEFT JOIN rules r ON r.id = c.rule_id AND c.deleted = 0
+            WHERE c.seq > ? ORDER BY c.seq LIMIT ?
+            """,
+            (since, limit + 1)
+        ).fetchall()
+    changes = []
+    for seq, rule_id, deleted, a, b, severity, description in rows[:limit]:
+        if deleted:
+            changes.append({"seq": seq, "op": "delete", "id": rule_id})
+        else:
+            changes.append({"seq": seq, "op": "upsert", "id": rule_id, "a": a, "b": b, "severity": severity,
+                            "description": description})
+    return {"since": since, "next": changes[-1]["seq"] if changes else since, "more": len(rows) > limit,
+            "changes": changes}
+
+#ChangeNotifier wakes up the long polls of GET /rules/changes. Each waiting request registers an asyncio.Event with the
+# loop it runs on, and a rule write (RuleVersions.bump) sets all of them from whatever thread it runs on. Writes made
+# by another worker process don't come through here, the long poll also looks at the database every RULE_CHANGES_POLL_INTERVAL seconds
+
+class ChangeNotifier:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._waiters: dict[asyncio.Event, asyncio.AbstractEventLoop] = {}
+
+    def listen(self) -> asyncio.Event:
+        event = asyncio.Event()
+        with self._lock:
+            self._waiters[event] = asyncio.get_running_loop()
+        return event
+
+    def forget(self, event: asyncio.Event):
+        with self._lock:
+            self._waiters.pop(event, None)
+
+    def notify(self):
+        with self._lock:
+            waiters = list(self._waiters.items())
+        for event, loop in waiters:
+            try:
+                loop.call_soon_threadsafe(event.set)
+            except RuntimeError:
+                #the loop was closed, the request is gone
+                self.forget(event)
+
+
+rule_change_notifier = ChangeNotifier()
+
+def fts_query(q: str) -> str:
+    #every word of q is quoted, so the text is never read as FTS5 syntax (AND, NEAR, column filters, ...). All the
+    # words have to match, and a word ending in * matches every word that starts with it
+    terms = re.findall(r"\w+\*?", q)
+    return " ".join(f'"{t.rstrip("*")}"' + ("*" if t.endswith("*") else "") for t in terms)
+
+#The DrugNameIndex is a trigram index over every drug name used in a rule (and every alias), it is what the
+# "did you mean" suggestions come from. A name is split into its 3-letter pieces ("  aspirin " gives "  a", " as",
+# "asp", ...) and every piece points to the names that contain it, so near matches are found by counting shared
+# pieces instead of comparing the query with every name. Names are reference counted because many rules share them
+
+def trigrams(name: str) -> set[str]:
+    padded = f"  {name} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+class DrugNameIndex:
+    def __init__(self):
+        self.refs: dict[str, int] = {}
+        self.grams: dict[str, set[str]] = {}
+        self._sizes: dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def add(self, name: str):
+        with self._lock:
+            count = self.refs.get(name, 0)
+            self.refs[name] = count + 1
+            if count:
+                return
+            grams = trigrams(name)
+            self._sizes[name] = len(grams)
+            for gram in grams:
+                self.grams.setdefault(gram, set()).add(name)
+
+    def discard(self, name: str):
+        with self._lock:
+            count = self.refs.get(name, 0)
+            if count > 1:
+                self.refs[name] = count - 1
+                return
+            if not count:
+                return
+            del self.refs[name]
+            del self._sizes[name]
+            for gram in trigrams(name):
+                names = self.grams.get(gram)
+                if names is not None:
+                    names.discard(name)
+                    if not names:
+                        del self.grams[gram]
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.refs
+
+    def __len__(self):
+        return len(self.refs)
+
+    def suggest(self, query: str, limit: int = 10) -> list[tuple[str, float]]:
+        #names that start with the query come first (for autocomplete), then the others by trigram similarity
+        query = query.strip().lower()
+        if not query:
+            return []
+        query_grams = trigrams(query)
+        with self._lock:
+            shared: dict[str, int] = {}
+            for gram in query_grams:
+                for name in self.grams.get(gram, ()):
+                    shared[name] = shared.get(name, 0) + 1
+            scored = []
+            for name, count in shared.items():
+                score = count / (len(query_grams) + self._sizes[name] - count)
+                prefix = name.startswith(query)
+                if prefix or score >= SUGGEST_MIN_SCORE:
+                    scored.append((not prefix, -score, name))
+        return [(name, round(-neg, 3)) for _, neg, name in heapq.nsmallest(limit, scored)]
+
+#The RuleIndex keeps every rule in memory keyed by its normalized pair, so /check can be answered without
+# opening SQLite. It is loaded from the rules table once and then kept up to date by the create/update/delete
+# endpoints. Readers never take the lock, they just look up in a dict that is replaced or changed in one step.
+# Writes made by other processes are picked up from the change log: `seq` is the last rule_changes entry the index
+# has seen and `epoch` the change-log epoch it was loaded at (see sync_rule_index)
+
+class RuleIndex:
+    def __init__(self):
+        self.loaded = False
+        self.by_pair: dict[tuple[str, str], tuple[str, str, str]] = {}
+        self.by_id: dict[str, tuple[str, str]] = {}
+        #the encoded POST /check answer of every rule, next to its severity, so a hit is one dict lookup
+        self.responses: dict[tuple[str, str], tuple[str, bytes]] = {}
+        self.names = DrugNameIndex()
+        #the adjacency map: every drug points to the drugs it has a rule with, so the rules of one drug are found
+        # without going through all the pairs
+        self.neighbors: dict[str, set[str]] = {}
+        self.epoch: int | None = None
+        self.seq = 0
+        self.checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def load(self, rows, extra_names=(), epoch: int | None = None, seq: int = 0):
+        by_pair, by_id, responses, names, neighbors = {}, {}, {}, DrugNameIndex(), {}
+        for rule_id, a, b, severity, description in rows:
+            pair = normalize_pair(a, b)
+            by_pair[pair] = (rule_id, severity, description)
+            by_id[rule_id] = pair
+            responses[pair] = (severity, encode_check_found(severity, description))
+            names.add(pair[0])
+            names.add(pair[1])
+            neighbors.setdefault(pair[0], set()).add(pair[1])
+            neighbors.setdefault(pair[1], set()).add(pair[0])
+        for name in extra_names:
+            names.add(name)
+        with self._lock:
+            self.by_pair, self.by_id, self.responses, self.names = by_pair, by_id, responses, names
+            self.neighbors = neighbors
+            self.epoch, self.seq = epoch, seq
+            self.checked_at = time.monotonic()
+            self.loaded = True
+
+    def _link(self, pair: tuple[str, str]):
+        self.neighbors.setdefault(pair[0], set()).add(pair[1])
+        self.neighbors.setdefault(pair[1], set()).add(pair[0])
+
+    def _unlink(self, pair: tuple[str, str]):
+        for x, y in (pair, pair[::-1]):
+            linked = self.neighbors.get(x)
+            if linked is not None:
+                linked.discard(y)
+                if not linked:
+                    del self.neighbors[x]
+
+    def get(self, pair: tuple[str, str]):
+        return self.by_pair.get(pair)
+
+    def response(self, pair: tuple[str, str]) -> tuple[str, bytes] | None:
+        return self.responses.get(pair)
+
+    def put(self, rule_id: str, a: str, b: str, severity: str, description: str):
+        pair = normalize_pair(a, b)
+        body = encode_check_found(severity, description)
+        with self._lock:
+            old = self.by_id.get(rule_id)
+            self.by_pair[pair] = (rule_id, severity, description)
+            self.by_id[rule_id] = pair
+            self.responses[pair] = (severity, body)
+            if old != pair:
+                self.names.add(pair[0])
+                self.names.add(pair[1])
+                self._link(pair)
+                if old is not None:
+                    self.by_pair.pop(old, None)
+                    self.responses.pop(old, None)
+                    self.names.discard(old[0])
+                    self.names.discard(old[1])
+                    self._unlink(old)
+
+    def update(self, rule_id: str, severity: str, description: str) -> bool:
+        with self._lock:
+            pair = self.by_id.get(rule_id)
+            if pair is None:
+                return False
+            self.by_pair[pair] = (rule_id, severity, description)
+            self.responses[pair] = (severity, encode_check_found(severity, description))
+            return True
+
+    def remove(self, rule_id: str):
+        with self._lock:
+            pair = self.by_id.pop(rule_id, None)
+            if pair is not None:
+                self.by_pair.pop(pair, None)
+                self.responses.pop(pair, None)
+                self.names.discard(pair[0])
+                self.names.discard(pair[1])
+                self._unlink(pair)
+
+    def move(self, rule_id: str, pair: tuple[str, str]):
+        #used when an alias renames the drugs of a rule, the entry is stored under its new pair first
+        with self._lock:
+            old = self.by_id.get(rule_id)
+            if old is None:
+                return
+            self.by_pair[pair] = self.by_pair[old]
+            self.responses[pair] = self.responses[old]
+            self.by_id[rule_id] = pair
+            if old != pair:
+                self.by_pair.pop(old, None)
+                self.responses.pop(old, None)
+                self.names.add(pair[0])
+                self.names.add(pair[1])
+                self.names.discard(old[0])
+                self.names.discard(old[1])
+                self._unlink(old)
+                self._link(pair)
+
+    def __len__(self):
+        return len(self.by_pair)
+
+
+rule_index = RuleIndex()
+
+#rule writes hold this lock from the SQL statement until the index is updated, so two concurrent
+# edits can't reach the index in a different order than they reached the database
+_rules_write_lock = threading.Lock()
+
+#RuleVersions counts the rule writes made by this process. The /check coalescing keys its lookups by it, so a check
+# never shares a lookup with one that started before a write, and every bump wakes up the long polls of
+# GET /rules/changes. `epoch` is random per process and changes on /admin/reload-rules. The ETags don't use it, they
+# come from the change log in app.db that all processes share (see rules_etag)
+
+class RuleVersions:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.epoch = os.urandom(4).hex()
+            self.version = 0
+
+    def bump(self) -> int:
+        with self._lock:
+            self.version += 1
+            version = self.version
+        rule_change_notifier.notify()
+        return version
+
+
+rule_versions = RuleVersions()
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    #If-None-Match can hold several ETags or "*", and uses the weak comparison so a W/ prefix is ignored
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return any(tag.strip().removeprefix("W/") == etag for tag in if_none_match.split(","))
+
+def not_modified(request: Request, etag: str) -> Response | None:
+    headers = {"ETag": etag, "Cache-Control": RULES_CACHE_CONTROL}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        ETAG_HIT.inc()
+        return Response(status_code=304, headers=headers)
+    ETAG_MISS.inc()
+    return None
+
+#A rules snapshot is one file: a header, a table with one fixed-size entry per rule (sorted by pair), the pair keys
+# ("a\0b") and the values ("severity\0id\0" followed by the encoded /check response of the rule). The entries point
+# into the two blobs by offset, so a lookup is a binary search over the mmapped file and nothing is loaded into Python
+# objects. The generation in the header is the compile time, a worker only ever swaps to a newer one. The seq in the
+# header is the last rule_changes entry the snapshot contains: a rule changed after it is answered from the database
+# until a newer snapshot is in place, so a write is seen right away and not only once the debounced rebuild is done
+
+SNAPSHOT_MAGIC = b"MIVRULES"
+SNAPSHOT_FORMAT = 2
+SNAPSHOT_HEADER = struct.Struct("<8sIIQQQQQ")  # magic, format, count, generation, change-log seq, entries, keys, values offsets
+SNAPSHOT_ENTRY = struct.Struct("<QIQI")  # key offset, key length, value offset, value length
+
+def compile_rules_snapshot(out_path: str | Path | None = None, db_path: str | None = None) -> dict:
+    #writes the rules table to a new snapshot next to the target and renames it over the target, so readers see either
+    # the old or the new file. A compile that started before the current file was written is thrown away
+    out_path = Path(out_path or RULE_SNAPSHOT_PATH)
+    if db_path is None:
+        ensure_rule_changes()
+    generation = time.time_ns()
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = out_path.with_name(f"{out_path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        count = write_rules_snapshot(tmp, generation, db_path)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+    current = RuleSnapshot.read_generation(out_path)
+    if current is not None and current > generation:
+        tmp.unlink()
+        return {"rules": count, "generation": current, "replaced": False}
+    os.replace(tmp, out_path)
+    return {"rules": count, "generation": generation, "replaced": True}
+
+def write_rules_snapshot(path: Path, generation: int, db_path: str | None = None) -> int:
+    #the rules are stored with a normalized pair, so reading them ORDER BY a, b (along ix_rules_pair) gives them in the
+    # order of their "a\0b" keys and nothing has to be sorted. The entry table goes straight to the file and the two
+    # blobs to temporary files next to it, appended at the end, so the memory used is the same however many rules there are
+    with db_conn(db_path) as conn, open(path, "wb") as f, \
+            tempfile.TemporaryFile(dir=path.parent) as keys, tempfile.TemporaryFile(dir=path.parent) as values:
+        #one read transaction, so the counted sizes and the rows read after them agree
+        conn.execute("BEGIN")
+        try:
+            seq = rule_changes_position(conn)[1]
+        except sqlite3.OperationalError:
+            #a database without the change log, every lookup trusts the snapshot
+            seq = 0
+        count, keys_size = conn.execute(
+            "SELECT count(*), coalesce(sum(length(CAST(a AS BLOB)) + length(CAST(b AS BLOB)) + 1), 0) FROM rules"
+        ).fetchone()
+        entries_at = SNAPSHOT_HEADER.size
+        keys_at = entries_at + SNAPSHOT_ENTRY.size * count
+        values_at = keys_at + keys_size
+        f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_FORMAT, count, generation, seq, entries_at, keys_at, values_at))
+        key_pos, value_pos = keys_at, values_at
+        for rule_id, a, b, severity, description in conn.execute(
+            "SELECT id, a, b, severity, description FROM rules ORDER BY a, b"
+        ):
+            key = f"{a}\0{b}".encode("utf-8")
+            value = f"{severity}\0{rule_id}\0".encode("utf-8") + encode_check_found(severity, description)
+            f.write(SNAPSHOT_ENTRY.pack(key_pos, len(key), value_pos, len(value)))
+            keys.write(key)
+            values.write(value)
+            key_pos += len(key)
+            value_pos += len(value)
+        if key_pos != values_at:
+            raise ValueError("the rule keys don't add up to the size counted by SQLite")
+        for blob in (keys, values):
+            blob.seek(0)
+            shutil.copyfileobj(blob, f)
+        f.flush()
+        os.fsync(f.fileno())
+    return count
+
+class RuleSnapshot:
+    def __init__(self, path: Path):
+        with open(path, "rb") as f:
+            self.stat = os.fstat(f.fileno())
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if self.stat.st_size else b""
+        if len(self._mm) < SNAPSHOT_HEADER.size:
+            raise ValueError(f"{path} is not a rules snapshot")
+        magic, fmt, self.count, self.generation, self.seq, self._entries, self._keys, self._values = \
+            SNAPSHOT_HEADER.unpack_from(self._mm)
+        if magic != SNAPSHOT_MAGIC or fmt != SNAPSHOT_FORMAT:
+            raise ValueError(f"{path} is not a rules snapshot of format {SNAPSHOT_FORMAT}")
+        if self._entries + self.count * SNAPSHOT_ENTRY.size > len(self._mm):
+            raise ValueError(f"{path} is truncated")
+        #the ids and pairs of the rules changed after `seq`, up to the change-log entry `changes_seq` (see sync_snapshot_changes)
+        self.changed: tuple[frozenset[str], frozenset[tuple[str, str]]] = (frozenset(), frozenset())
+        self.changes_seq = self.seq
+        self._names: DrugNameIndex | None = None
+        self._names_lock = threading.Lock()
+
+    @staticmethod
+    def read_generation(path: Path) -> int | None:
+        try:
+            with open(path, "rb") as f:
+                head = f.read(SNAPSHOT_HEADER.size)
+        except OSError:
+            return None
+        if len(head) < SNAPSHOT_HEADER.size or head[:8] != SNAPSHOT_MAGIC:
+            return None
+        return SNAPSHOT_HEADER.unpack(head)[3]
+
+    def _entry(self, i: int) -> tuple[int, int, int, int]:
+        return SNAPSHOT_ENTRY.unpack_from(self._mm, self._entries + i * SNAPSHOT_ENTRY.size)
+
+    def get(self, pair: tuple[str, str]) -> tuple[str, str, bytes] | None:
+        #binary search for the pair, returns (severity, rule id, encoded /check response)
+        key = f"{pair[0]}\0{pair[1]}".encode("utf-8")
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            key_at, key_len, value_at, value_len = self._entry(mid)
+            probe = self._mm[key_at:key_at + key_len]
+            if probe < key:
+                lo = mid + 1
+            elif probe > key:
+                hi = mid
+            else:
+                severity, rule_id, body = self._mm[value_at:value_at + value_len].split(b"\0", 2)
+                return severity.decode("utf-8"), rule_id.decode("utf-8"), body
+        return None
+
+    def names(self) -> DrugNameIndex:
+        #the drug names for suggestions, built the first time they are needed (there are far fewer names than rules)
+        if self._names is None:
+            with self._names_lock:
+                if self._names is None:
+                    names = DrugNameIndex()
+                    for i in range(self.count):
+                        key_at, key_len, _, _ = self._entry(i)
+                        for name in self._mm[key_at:key_at + key_len].decode("utf-8").split("\0"):
+                            names.add(name)
+                    if not alias_index.loaded:
+                        load_aliases()
+                    for alias in alias_index.forward:
+                        names.add(alias)
+                    self._names = names
+        return self._names
+
+
+_snapshot: RuleSnapshot | None = None
+_snapshot_checked_at = 0.0
+_snapshot_lock = threading.Lock()
+_snapshot_timer: threading.Timer | None = None
+
+def current_snapshot() -> RuleSnapshot:
+    #returns the mapped snapshot, looking at the file at most every SNAPSHOT_CHECK_INTERVAL seconds. A newer file is
+    # opened and swapped in with one assignment, requests that still hold the old one finish with it
+    global _snapshot, _snapshot_checked_at
+    snap = _snapshot
+    now = time.monotonic()
+    if snap is not None and now - _snapshot_checked_at < SNAPSHOT_CHECK_INTERVAL:
+        return snap
+    with _snapshot_lock:
+        snap = _snapshot
+        if snap is not None and now - _snapshot_checked_at < SNAPSHOT_CHECK_INTERVAL:
+            return snap
+        path = Path(RULE_SNAPSHOT_PATH)
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            compile_rules_snapshot(path)
+            st = os.stat(path)
+        if snap is None or (st.st_ino, st.st_mtime_ns, st.st_size) != (snap.stat.st_ino, snap.stat.st_mtime_ns, snap.stat.st_size):
+            try:
+                fresh = RuleSnapshot(path)
+            except (OSError, ValueError):
+                if snap is not None:
+                    logger.exception("could not open rules snapshot %s, keeping the current one", path)
+                    fresh = snap
+                else:
+                    #for example a file of an older format left by the previous version
+                    logger.warning("could not open rules snapshot %s, compiling a new one", path)
+                    compile_rules_snapshot(path)
+                    fresh = RuleSnapshot(path)
+            if snap is None or fresh.generation >= snap.generation:
+                _snapshot = snap = fresh
+        sync_snapshot_changes(snap)
+        _snapshot_checked_at = now
+        return snap
+
+def sync_snapshot_changes(snap: RuleSnapshot):
+    #collects the rules changed since the snapshot was compiled, by this process or any other, from the change log
+    ensure_rule_changes()
+    with db_conn() as conn:
+        conn.execute("BEGIN")
+        _, seq, _ = rule_changes_position(conn)
+        if seq <= snap.changes_seq:
+            return
+        rows = conn.execute(
+            "SELECT c.rule_id, r.a, r.b FROM rule_changes c LEFT JOIN rules r ON r.id = c.rule_id AND c.deleted = 0 "
+            "WHERE c.seq > ?",
+            (snap.changes_seq,)
+        ).fetchall()
+    ids, pairs = snap.changed
+    snap.changed = (ids | {r[0] for r in rows}, pairs | {(r[1], r[2]) for r in rows if r[1] is not None})
+    snap.changes_seq = seq
+
+def snapshot_get(pair: tuple[str, str]) -> tuple[str, str, bytes] | None:
+    #the snapshot's (severity, rule id, encoded /check response) for a pair, or the database's when the rule was
+    # changed after the snapshot was compiled
+    snap = current_snapshot()
+    changed_ids, changed_pairs = snap.changed
+    if pair not in changed_pairs:
+        hit = snap.get(pair)
+        if hit is None or hit[1] not in changed_ids:
+            return hit
+    with db_conn() as conn:
+        row = conn.execute("SELECT severity, id, description FROM rules WHERE a=? AND b=?", pair).fetchone()
+    return (row[0], row[1], encode_check_found(row[0], row[2])) if row else None
+
+def schedule_snapshot_rebuild():
+    #called after every rule write, several writes in a row are compiled together once they stop for a moment. Until
+    # then the next lookup reads the change log first, so it already answers the changed rules from the database
+    global _snapshot_timer
+    if not RULE_SNAPSHOT_PATH:
+        return
+    refresh_snapshot()
+    with _snapshot_lock:
+        if _snapshot_timer is not None:
+            _snapshot_timer.cancel()
+        _snapshot_timer = threading.Timer(SNAPSHOT_REBUILD_DELAY, _rebuild_snapshot)
+        _snapshot_timer.daemon = True
+        _snapshot_timer.start()
+
+def _rebuild_snapshot():
+    try:
+        compile_rules_snapshot(RULE_SNAPSHOT_PATH)
+        refresh_snapshot()
+    except Exception:
+        logger.exception("could not rebuild the rules snapshot")
+
+def refresh_snapshot():
+    #makes the next lookup look at the file right away instead of waiting for SNAPSHOT_CHECK_INTERVAL
+    global _snapshot_checked_at
+    _snapshot_checked_at = float("-inf")
+
+def drug_names() -> DrugNameIndex:
+    if RULE_SNAPSHOT_PATH:
+        return current_snapshot().names()
+    if RULE_INDEX_ENABLED:
+        ensure_rule_index()
+        return rule_index.names
+    return ensure_name_index()
+
+#With RULE_INDEX=0 the suggestions come from a names-only index instead of the full rule index, so a /check miss
+# doesn't load every rule and its encoded answer into memory. It is built from the distinct drug names and the aliases
+# and built again when the change log or the alias count moved, looked at at most every RULES_SYNC_INTERVAL seconds
+# and right after a write of this process (refresh_name_index)
+
+_name_index: DrugNameIndex | None = None
+_name_index_at: tuple | None = None
+_name_index_checked_at = 0.0
+_name_index_lock = threading.Lock()
+
+def ensure_name_index() -> DrugNameIndex:
+    global _name_index, _name_index_at, _name_index_checked_at
+    names = _name_index
+    if names is not None and time.monotonic() - _name_index_checked_at < RULES_SYNC_INTERVAL:
+        return names
+    with _name_index_lock:
+        ensure_rule_changes()
+        with db_conn() as conn:
+            conn.execute("BEGIN")
+            epoch, seq, _ = rule_changes_position(conn)
+            position = (epoch, seq, aliases_version(conn))
+            if _name_index is None or position != _name_index_at:
+                names = DrugNameIndex()
+                for (name,) in conn.execute("SELECT a FROM rules UNION SELECT b FROM rules UNION SELECT alias FROM aliases"):
+                    names.add(name)
+                _name_index, _name_index_at = names, position
+        _name_index_checked_at = time.monotonic()
+        return _name_index
+
+def refresh_name_index():
+    global _name_index_checked_at
+    _name_index_checked_at = float("-inf")
+
+def rule_changes_position(conn) -> tuple[int, int, int]:
+    #the change-log epoch, the last seq handed out and the highest seq dropped by compact_rule_changes
+    epoch, seq, purged = conn.execute(
+        "SELECT (SELECT value FROM rule_changes_meta WHERE key='epoch'), "
+        "(SELECT seq FROM sqlite_sequence WHERE name='rule_changes'), "
+        "(SELECT value FROM rule_changes_meta WHERE key='purged_seq')"
+    ).fetchone()
+    return epoch, seq or 0, purged or 0
+
+def reload_rule_index() -> int:
+    load_aliases()
+    ensure_rule_changes()
+    with db_conn() as conn:
+        #one read transaction, so the rows are exactly the state at `seq`
+        conn.execute("BEGIN")
+        epoch, seq, _ = rule_changes_position(conn)
+        rows = conn.execute("SELECT id, a, b, severity, description FROM rules").fetchall()
+    rule_index.load(rows, extra_names=list(alias_index.forward), epoch=epoch, seq=seq)
+    return len(rows)
+
+def sync_rule_index():
+    #applies the changes logged since the index was last brought up to date, which also catches the writes of other
+    # worker processes and of scripts. A new epoch (/admin/reload-rules) or a compacted log that could hide a delete
+    # loads the whole index again. Like sync_aliases it is skipped while a write of this process holds the lock
+    rule_index.checked_at = time.monotonic()
+    if not _rules_write_lock.acquire(blocking=False):
+        return
+    try:
+        ensure_rule_changes()
+        with db_conn() as conn:
+            conn.execute("BEGIN")
+            epoch, seq, purged = rule_changes_position(conn)
+            if epoch == rule_index.epoch and seq == rule_index.seq:
+                return
+            if epoch != rule_index.epoch or purged > rule_index.seq:
+                rows = None
+            else:
+                rows = conn.execute(
+                    """
+                    SELECT c.rule_id, r.a, r.b, r.severity, r.description
+                    FROM rule_changes c LEFT JOIN rules r ON r.id = c.rule_id AND c.deleted = 0
+                    WHERE c.seq > ? ORDER BY c.seq
+                    """,
+                    (rule_index.seq,)
+                ).fetchall()
+        if rows is None:
+            reload_rule_index()
+            return
+        for rule_id, a, b, severity, description in rows:
+            if a is None:
+                rule_index.remove(rule_id)
+            else:
+                rule_index.put(rule_id, a, b, severity, description)
+        rule_index.seq = seq
+    finally:
+        _rules_write_lock.release()
+
+def ensure_rule_index():
+    if not rule_index.loaded:
+        reload_rule_index()
+    elif time.monotonic() - rule_index.checked_at >= RULES_SYNC_INTERVAL:
+        sync_rule_index()
+
+def did_you_mean(*names: str) -> dict[str, list[str]] | None:
+    #near matches for the names that no rule or alias knows about, which are most likely typos
+    known = drug_names()
+    found = {}
+    for name in names:
+        if name not in known:
+            candidates = [n for n, _ in known.suggest(name, 3)]
+            if candidates:
+                found[name] = candidates
+    return found or None
+
+def find_rule(a: str, b: str) -> tuple[str, bytes] | None:
+    #returns (severity, encoded /check response) for an already normalized pair, or None if there is no rule for it.
+    # With the index (or the snapshot) the response was encoded when the rule was written, without it it is encoded here
+    if RULE_SNAPSHOT_PATH:
+        hit = snapshot_get((a, b))
+        if hit is None:
+            RULE_INDEX_MISS.inc()
+            return None
+        RULE_INDEX_HIT.inc()
+        return hit[0], hit[2]
+    if RULE_INDEX_ENABLED:
+        ensure_rule_index()
+        hit = rule_index.response((a, b))
+        if hit is None:
+            RULE_INDEX_MISS.inc()
+            return None
+        RULE_INDEX_HIT.inc()
+        return hit
+
+    with db_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT severity, description FROM rules WHERE a=? AND b=?", (a, b))
+        row = cur.fetchone()
+    return (row[0], encode_check_found(*row)) if row else None
+
+def find_rules_among(drugs: list[str]) -> list[tuple[str, str, str, str]]:
+    #returns (a, b, severity, description) for every rule whose both drugs are in the (already normalized) list.
+    # With the index that is one dict lookup per pair, without it one query for the whole list
+    if RULE_SNAPSHOT_PATH:
+        found = []
+        for i, x in enumerate(drugs):
+            for y in drugs[i + 1:]:
+                pair = normalize_pair(x, y)
+                hit = snapshot_get(pair)
+                if hit:
+                    found.append((pair[0], pair[1], hit[0], json.loads(hit[2])["description"]))
+        return found
+    if RULE_INDEX_ENABLED:
+        ensure_rule_index()
+        found = []
+        for i, x in enumerate(drugs):
+            for y in drugs[i + 1:]:
+                pair = normalize_pair(x, y)
+                hit = rule_index.get(pair)
+                if hit:
+                    found.append((pair[0], pair[1], hit[1], hit[2]))
+        return found
+
+    marks = ",".join("?" * len(drugs))
+    with db_conn() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            f"SELECT a, b, severity, description FROM rules WHERE a IN ({marks}) AND b IN ({marks}) AND a <> b",
+            (*drugs, *drugs)
+        )
+        return cur.fetchall()
+
+def find_interactions_of(drug: str) -> list[tuple[str, str, str, str]]:
+    #returns (rule id, other drug, severity, description) for every rule of an already canonical drug. With the index
+    # it is one dict lookup per neighbor, otherwise (and with the snapshot, which is sorted by pair and can't answer
+    # for the second drug) one query that uses ix_rules_pair for a=? and ix_rules_b for b=?
+    if RULE_INDEX_ENABLED and not RULE_SNAPSHOT_PATH:
+        ensure_rule_index()
+        found = []
+        for other in list(rule_index.neighbors.get(drug, ())):
+            hit = rule_index.get(normalize_pair(drug, other))
+            if hit:
+                found.append((hit[0], other, hit[1], hit[2]))
+        return found
+
+    with db_conn() as conn:
+        return conn.execute(
+            "SELECT id, b, severity, description FROM rules WHERE a=? "
+            "UNION ALL SELECT id, a, severity, description FROM rules WHERE b=? AND a <> b",
+            (drug, drug)
+        ).fetchall()
+
 def ensure_history_file():
     HISTORY_PATH.parent.mkdir(parents=True, exist_ok=True)
     if not HISTORY_PATH.exists():
         HISTORY_PATH.write_text("[]", encoding="utf-8")
 
-def append_history(drug_a: str, drug_b: str, found: bool, severity: str | None):
-    ensure_history_file()
-    data = json.loads(HISTORY_PATH.read_text(encoding="utf-8"))
-    data.append({
+def history_entry(drug_a: str, drug_b: str, found: bool, severity: str | None, ts: str | None = None) -> dict:
+    return {
         "drug_a": drug_a,
         "drug_b": drug_b,
         "found": found,
         "severity": severity,
-        "ts": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
-    })
-    HISTORY_PATH.write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")
+        "ts": ts or time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+    }
+
+def append_history(drug_a: str, drug_b: str, found: bool, severity: str | None):
+    record_history([history_entry(drug_a, drug_b, found, severity)])
+
+#record_history writes a batch of history entries. In the sqlite format that is one INSERT transaction and in the
+# ndjson format one append to the end of the log under a lock, so the cost doesn't depend on how big the history
+# already is and concurrent checks can't overwrite each other's entries like they could with the JSON array
+
+_history_lock = threading.Lock()
+_history_ready: set[Path] = set()
+_history_compacted_at = 0.0
+_history_log_expired_at = 0.0
+
+HISTORY_WRITE_SECONDS = get_metric(Histogram, "history_write_seconds", "Time to write history entries to storage",
+                                   labelnames=["format"], buckets=LATENCY_BUCKETS)
+HISTORY_WRITE_BYTES = get_metric(Counter, "history_write_bytes", "Bytes of history written to storage", labelnames=["format"])
+HISTORY_FILE_BYTES = get_metric(Gauge, "history_file_bytes", "Size of the history file (database and WAL, or current log)")
+
+def record_history(entries: list[dict]):
+    if not entries:
+        return
+    start = time.perf_counter()
+    if HISTORY_FORMAT == "sqlite":
+        prepare_history_db()
+        prepare_history_stats()
+        path = history_db_path()
+        with db_conn(str(path)) as conn:
+            insert_history_rows(conn, entries)
+            update_history_stats(conn, entries)
+        compact_history_table()
+        #the row bytes are estimated from the text columns, the file size includes the WAL that SQLite appends to
+        written = sum(len(e["drug_a"]) + len(e["drug_b"]) + len(e.get("severity") or "") + len(e.get("ts") or "") + 1
+                      for e in entries)
+        size = sum(p.stat().st_size for p in (path, path.with_name(path.name + "-wal")) if p.exists())
+    elif HISTORY_FORMAT == "json":
+        prepare_history_stats()
+        with _history_lock:
+            ensure_history_file()
+            data = json.loads(HISTORY_PATH.read_text(encoding="utf-8"))
+            data.extend(entries)
+            payload = json.dumps(data, ensure_ascii=False, indent=2).encode("utf-8")
+            HISTORY_PATH.write_bytes(payload)
+            with db_conn(str(history_db_path())) as conn:
+                update_history_stats(conn, entries)
+        written = size = len(payload)
+    else:
+        prepare_history_log()
+        prepare_history_stats()
+        payload = "".join(json.dumps(e, ensure_ascii=False, separators=(",", ":")) + "\n" for e in entries).encode("utf-8")
+        log = history_log_path()
+        with _history_lock:
+            expire_history_log()
+            with open(log, "ab") as f:
+                f.write(payload)
+                size = f.tell()
+            if size >= HISTORY_MAX_BYTES:
+                rotate_history_log()
+            with db_conn(str(history_db_path())) as conn:
+                update_history_stats(conn, entries)
+        written = len(payload)
+    HISTORY_WRITE_SECONDS.labels(HISTORY_FORMAT).observe(time.perf_counter() - start)
+    HISTORY_WRITE_BYTES.labels(HISTORY_FORMAT).inc(written)
+    HISTORY_FILE_BYTES.set(size)
+
+HISTORY_QUEUE_DEPTH = get_metric(Gauge, "history_queue_depth", "Checks waiting in the history queue")
+HISTORY_FLUSH_SECONDS = get_metric(Histogram, "history_flush_seconds", "Time to write one batch of history",
+                                   buckets=LATENCY_BUCKETS)
+HISTORY_FLUSH_ENTRIES = get_metric(Histogram, "history_flush_entries", "History entries written per batch",
+                                   buckets=(1, 5, 10, 50, 100, 500, 1000, 5000))
+HISTORY_DROPPED = get_metric(Counter, "history_dropped_entries", "History entries dropped because the queue was full")
+HISTORY_SPILLED = get_metric(Counter, "history_spilled_entries", "History entries written on the request thread because the queue was full")
+HISTORY_WRITE_ERRORS = get_metric(Counter, "history_write_errors", "History batches that could not be written")
+
+#The HistoryWriter owns the history queue and the thread that empties it. Every item on the queue is the list of
+# entries of one request, so a regimen check is still a single queue operation.
+
+class _FlushMark:
+    #put on the queue by flush(), the writer sets `done` once the batch in front of it has been written
+    def __init__(self):
+        self.done = threading.Event()
+
+
+class HistoryWriter:
+    _STOP = object()
+
+    def __init__(self):
+        self._queue: queue.Queue = queue.Queue(maxsize=HISTORY_QUEUE_SIZE)
+        self._thread: threading.Thread | None = None
+        self._lock = threading.Lock()
+        #set by stop() while it drains the queue, no new thread is started then and submit writes on its own thread
+        self._stopping = False
+
+    def _ensure_started(self) -> bool:
+        #returns False while stop() is running
+        if self._thread is not None and not self._stopping:
+            return True
+        with self._lock:
+            if self._stopping:
+                return False
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="history-writer", daemon=True)
+                self._thread.start()
+            return True
+
+    def submit(self, entries: list[dict]):
+        if not self._ensure_started():
+            record_history(entries)
+            return
+        try:
+            if HISTORY_QUEUE_POLICY == "block":
+                self._queue.put(entries)
+            else:
+                self._queue.put_nowait(entries)
+        except queue.Full:
+            if HISTORY_QUEUE_POLICY == "drop":
+                HISTORY_DROPPED.inc(len(entries))
+            else:
+                HISTORY_SPILLED.inc(len(entries))
+                record_history(entries)
+        HISTORY_QUEUE_DEPTH.set(self._queue.qsize())
+
+    def flush(self, timeout: float | None = None) -> bool:
+        #waits until everything submitted before the call has been written, used before reading the history back.
+        # Entries submitted after it don't make it wait longer, so it returns under constant traffic too. Returns
+        # False when that took longer than `timeout` (HISTORY_FLUSH_TIMEOUT)
+        thread = self._thread
+        if thread is None:
+            return True
+        timeout = HISTORY_FLUSH_TIMEOUT if timeout is None else timeout
+        if self._stopping:
+            thread.join(timeout)
+            return not thread.is_alive()
+        mark = _FlushMark()
+        try:
+            self._queue.put(mark, timeout=timeout)
+        except queue.Full:
+            return False
+        return mark.done.wait(timeout)
+
+    def stop(self):
+        #drains the queue and stops the thread, a later submit starts a new one. The thread is only forgotten once it
+        # has taken the STOP and exited, so no second thread can be started in between and take the STOP instead
+        with self._lock:
+            thread, stopping = self._thread, self._stopping
+            if thread is None:
+                return
+            self._stopping = True
+        if stopping:
+            thread.join()
+            return
+        try:
+            self._queue.put(self._STOP)
+            thread.join()
+            #a submit or flush that checked just before _stopping was set can have queued behind the STOP
+            self._drain()
+        finally:
+            with self._lock:
+                self._thread = None
+                self._stopping = False
+
+    def _drain(self):
+        batch = []
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if isinstance(item, _FlushMark):
+                self._write(batch)
+                batch = []
+                item.done.set()
+            elif item is not self._STOP:
+                batch.extend(item)
+        self._write(batch)
+
+    def _run(self):
+        stop = False
+        while not stop:
+            batch, flushed = [], None
+            item = self._queue.get()
+            deadline = time.monotonic() + HISTORY_FLUSH_INTERVAL
+            while True:
+                if item is self._STOP:
+                    stop = True
+                    break
+                if isinstance(item, _FlushMark):
+                    flushed = item
+                    break
+                batch.extend(item)
+                timeout = deadline - time.monotonic()
+                if len(batch) >= HISTORY_FLUSH_COUNT or timeout <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+            self._write(batch)
+            if flushed is not None:
+                flushed.done.set()
+
+    def _write(self, batch: list[dict]):
+        if not batch:
+            return
+        start = time.perf_counter()
+        try:
+            record_history(batch)
+        except Exception:
+            HISTORY_WRITE_ERRORS.inc()
+            logger.exception("could not write %d history entries", len(batch))
+        HISTORY_FLUSH_SECONDS.observe(time.perf_counter() - start)
+        HISTORY_FLUSH_ENTRIES.observe(len(batch))
+        HISTORY_QUEUE_DEPTH.set(self._queue.qsize())
+
+
+history_writer = HistoryWriter()
+atexit.register(history_writer.stop)
+
+def enqueue_history(entries: list[dict]):
+    if HISTORY_ASYNC:
+        history_writer.submit(entries)
+    else:
+        record_history(entries)
+
+def history_log_path() -> Path:
+    return HISTORY_PATH.with_suffix(".ndjson")
+
+def history_db_path() -> Path:
+    return HISTORY_PATH.with_suffix(".db")
+
+#the history table gets an index on the pair (which also serves lookups by drug_a), one on drug_b and one on the
+# timestamp, the newest entries are found through the rowid so reading the tail costs the same for any history size
+
+HISTORY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS history (
+    id INTEGER PRIMARY KEY,
+    drug_a TEXT NOT NULL,
+    drug_b TEXT NOT NULL,
+    found INTEGER NOT NULL,
+    severity TEXT,
+    ts TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ix_history_pair ON history(drug_a, drug_b);
+CREATE INDEX IF NOT EXISTS ix_history_drug_b ON history(drug_b);
+CREATE INDEX IF NOT EXISTS ix_history_ts ON history(ts);
+"""
+
+def insert_history_rows(conn: sqlite3.Connection, entries: list[dict]):
+    conn.executemany(
+        "INSERT INTO history (drug_a, drug_b, found, severity, ts) VALUES (?,?,?,?,?)",
+        [(e["drug_a"], e["drug_b"], int(bool(e["found"])), e.get("severity"), e.get("ts") or "") for e in entries]
+    )
+
+def prepare_history_db():
+    path = history_db_path()
+    if path in _history_ready:
+        return
+    with _history_lock:
+        if path not in _history_ready:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with db_conn(str(path)) as conn:
+                conn.executescript(HISTORY_SCHEMA)
+                migrate_history_files(conn)
+            _history_ready.add(path)
+
+#when the history table is first created, the entries of an old history.json array and of an ndjson log are moved
+# into it and the old files are renamed with a .migrated suffix, so the migration only happens once
+
+def migrate_history_files(conn: sqlite3.Connection) -> int:
+    moved = 0
+    if HISTORY_PATH.exists():
+        data = json.loads(HISTORY_PATH.read_text(encoding="utf-8") or "[]")
+        insert_history_rows(conn, data)
+        moved += len(data)
+    for path in history_segments() + [history_log_path()]:
+        if path.exists():
+            data = [json.loads(line) for line in path.read_bytes().splitlines() if line]
+            insert_history_rows(conn, data)
+            moved += len(data)
+    conn.commit()
+    for path in [HISTORY_PATH] + history_segments() + [history_log_path()]:
+        if path.exists():
+            path.rename(path.with_name(path.name + ".migrated"))
+    return moved
+
+def compact_history_table():
+    #drops history older than HISTORY_MAX_AGE_DAYS, at most once per HISTORY_COMPACT_INTERVAL seconds
+    global _history_compacted_at
+    if HISTORY_MAX_AGE_DAYS <= 0 or time.time() - _history_compacted_at < HISTORY_COMPACT_INTERVAL:
+        return
+    _history_compacted_at = time.time()
+    cutoff = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(time.time() - HISTORY_MAX_AGE_DAYS * 86400))
+    with db_conn(str(history_db_path())) as conn:
+        conn.execute("DELETE FROM history WHERE ts < ?", (cutoff,))
+
+def history_segments() -> list[Path]:
+    #rotated segments are called history.ndjson.000001, history.ndjson.000002 ... so sorting them by name gives oldest first
+    log = history_log_path()
+    return sorted(p for p in log.parent.glob(log.name + ".*") if p.suffix[1:].isdigit())
+
+def prepare_history_log():
+    log = history_log_path()
+    if log in _history_ready:
+        return
+    with _history_lock:
+        if log not in _history_ready:
+            log.parent.mkdir(parents=True, exist_ok=True)
+            migrate_history_json()
+            _history_ready.add(log)
+
+#the first time the log is used we move the entries of an existing history.json array into it, and rename the
+# old file to history.json.migrated so the migration only ever happens once
+
+def migrate_history_json() -> int:
+    log = history_log_path()
+    if log.exists() or not HISTORY_PATH.exists():
+        return 0
+    data = json.loads(HISTORY_PATH.read_text(encoding="utf-8") or "[]")
+    tmp = HISTORY_PATH.with_suffix(".migrating")
+    with open(tmp, "w", encoding="utf-8") as f:
+        for entry in data:
+            f.write(json.dumps(entry, ensure_ascii=False, separators=(",", ":")) + "\n")
+    os.replace(tmp, log)
+    HISTORY_PATH.rename(HISTORY_PATH.with_suffix(".json.migrated"))
+    return len(data)
+
+def rotate_history_log():
+    #must be called with _history_lock held
+    log = history_log_path()
+    segments = history_segments()
+    next_no = int(segments[-1].suffix[1:]) + 1 if segments else 1
+    os.replace(log, log.with_name(f"{log.name}.{next_no:06d}"))
+    compact_history_segments()
+
+def expire_history_log():
+    #must be called with _history_lock held. Segments only expire when the log rotates, and with little traffic it
+    # may never grow to HISTORY_MAX_BYTES, so the log is also rotated once its oldest entry is older than
+    # HISTORY_MAX_AGE_DAYS. Runs on writes and reads, at most once per HISTORY_COMPACT_INTERVAL seconds
+    global _history_log_expired_at
+    if HISTORY_MAX_AGE_DAYS <= 0 or time.time() - _history_log_expired_at < HISTORY_COMPACT_INTERVAL:
+        return
+    _history_log_expired_at = time.time()
+    oldest = oldest_log_entry_time(history_log_path())
+    if oldest is not None and oldest < time.time() - HISTORY_MAX_AGE_DAYS * 86400:
+        rotate_history_log()
+    else:
+        compact_history_segments()
+
+def oldest_log_entry_time(log: Path) -> float | None:
+    try:
+        with open(log, "rb") as f:
+            first = f.readline()
+        return calendar.timegm(time.strptime(json.loads(first)["ts"], "%Y-%m-%dT%H:%M:%SZ"))
+    except (OSError, ValueError, KeyError, TypeError):
+        #no log yet, or an entry without a usable timestamp
+        return None
+
+def compact_history_segments():
+    segments = history_segments()
+    if HISTORY_MAX_AGE_DAYS > 0:
+        cutoff = time.time() - HISTORY_MAX_AGE_DAYS * 86400
+        for path in [p for p in segments if p.stat().st_mtime < cutoff]:
+            path.unlink()
+            segments.remove(path)
+    for path in segments[:max(len(segments) - HISTORY_MAX_SEGMENTS, 0)]:
+        path.unlink()
+
+def _tail_lines(path: Path, n: int) -> list[bytes]:
+    #reads the file backwards in 64 KB blocks until it has n complete lines, so the cost depends on n and not on the file size
+    with open(path, "rb") as f:
+        pos = f.seek(0, os.SEEK_END)
+        buf = b""
+        while pos > 0 and buf.count(b"\n") <= n:
+            step = min(64 * 1024, pos)
+            pos -= step
+            f.seek(pos)
+            buf = f.read(step) + buf
+    return [line for line in buf.splitlines() if line][-n:]
+
+def read_history(limit: int) -> list[dict]:
+    if HISTORY_FORMAT == "sqlite":
+        return query_history(limit)[0]
+    if HISTORY_FORMAT == "json":
+        ensure_history_file()
+        data = json.loads(HISTORY_PATH.read_text(encoding="utf-8"))
+        return data[-limit:] if limit > 0 else data
+    prepare_history_log()
+    lines: list[bytes] = []
+    with _history_lock:
+        expire_history_log()
+        for path in reversed(history_segments() + [history_log_path()]):
+            if not path.exists():
+                continue
+            if limit <= 0:
+                lines = [l for l in path.read_bytes().splitlines() if l] + lines
+                continue
+            lines = _tail_lines(path, limit - len(lines)) + lines
+            if len(lines) >= limit:
+                break
+    return [json.loads(line) for line in lines]
+
+def history_row(r) -> dict:
+    return {"drug_a": r[1], "drug_b": r[2], "found": bool(r[3]), "severity": r[4], "ts": r[5]}
+
+#query_history returns the last `limit` entries (oldest first) that match the filters and come before the `before`
+# id, together with the id to use as the cursor for the next (older) page, or None when there is nothing older.
+# In the sqlite format this is one indexed query. The file formats have no index, so filtered queries read the whole history
+
+def query_history(limit: int, drug: str | None = None, found: bool | None = None, severity: str | None = None,
+                  since: str | None = None, until: str | None = None, before: int | None = None) -> tuple[list[dict], int | None]:
+    if HISTORY_FORMAT == "sqlite":
+        prepare_history_db()
+        where, params = [], []
+        if drug:
+            where.append("(drug_a = ? OR drug_b = ?)")
+            params += [drug, drug]
+        if found is not None:
+            where.append("found = ?")
+            params.append(int(found))
+        if severity:
+            where.append("severity = ?")
+            params.append(severity)
+        if since:
+            where.append("ts >= ?")
+            params.append(since)
+        if until:
+            where.append("ts < ?")
+            params.append(until)
+        if before is not None:
+            where.append("id < ?")
+            params.append(before)
+        sql = "SELECT id, drug_a, drug_b, found, severity, ts FROM history"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY id DESC"
+        if limit > 0:
+            sql += " LIMIT ?"
+            params.append(limit + 1)
+        with db_conn(str(history_db_path())) as conn:
+            rows = conn.execute(sql, params).fetchall()
+        more = limit > 0 and len(rows) > limit
+        rows = rows[:limit] if more else rows
+        rows.reverse()
+        return [history_row(r) for r in rows], (rows[0][0] if more else None)
+
+    no_filters = drug is None and found is None and severity is None and since is None and until is None
+    if no_filters and before is None and HISTORY_FORMAT == "ndjson":
+        return read_history(limit), None
+    matches = [
+        (i, e) for i, e in enumerate(read_history(0), start=1)
+        if (before is None or i < before)
+        and (not drug or drug in (e.get("drug_a"), e.get("drug_b")))
+        and (found is None or bool(e.get("found")) == found)
+        and (not severity or e.get("severity") == severity)
+        and (not since or (e.get("ts") or "") >= since)
+        and (not until or (e.get("ts") or "") < until)
+    ]
+    more = limit > 0 and len(matches) > limit
+    matches = matches[-limit:] if more else matches
+    return [e for _, e in matches], (matches[0][0] if more else None)
+
+def parse_history_ts(value: str | None, name: str) -> str | None:
+    #accepts any ISO 8601 date or time and turns it into the UTC format the history is stored in
+    if not value:
+        return None
+    try:
+        dt = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        raise HTTPException(400, f"Invalid {name} timestamp")
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(timezone.utc)
+    return dt.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+#The history statistics are rollup tables in the history database that every history write updates in the same
+# transaction: hits per pair (split into found and not found), checks per severity ("none" for the misses) and checks
+# per hour. So GET /history/stats only reads the rows it returns instead of scanning the history. With the ndjson and
+# json formats the tables live in history.db as well. They count everything since they were created (old entries
+# dropped by HISTORY_MAX_AGE_DAYS stay counted); rebuild_history_stats() recomputes them from the stored history.
+
+HISTORY_STATS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS history_pairs (
+    drug_a TEXT NOT NULL,
+    drug_b TEXT NOT NULL,
+    found INTEGER NOT NULL,
+    hits INTEGER NOT NULL,
+    last_ts TEXT NOT NULL,
+    PRIMARY KEY (drug_a, drug_b, found)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS ix_history_pairs_hits ON history_pairs(found, hits);
+CREATE TABLE IF NOT EXISTS history_severity (severity TEXT PRIMARY KEY, hits INTEGER NOT NULL) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS history_hourly (hour TEXT PRIMARY KEY, checks INTEGER NOT NULL, found INTEGER NOT NULL) WITHOUT ROWID;
+"""
+HISTORY_STATS_REBUILD_CHUNK = 5000
+
+def prepare_history_stats():
+    #creates the rollup tables the first time, and fills them from the history that is already there
+    key = history_db_path().with_suffix(".stats")
+    if key in _history_ready:
+        return
+    with _history_lock:
+        if key in _history_ready:
+            return
+        history_db_path().parent.mkdir(parents=True, exist_ok=True)
+        with db_conn(str(history_db_path())) as conn:
+            exists = conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='history_pairs'").fetchone()
+            conn.executescript(HISTORY_STATS_SCHEMA)
+        if not exists:
+            _rebuild_history_stats()
+        _history_ready.add(key)
+
+def update_history_stats(conn: sqlite3.Connection, entries: list[dict]):
+    #the batch is summed up in Python first, so each distinct pair, severity and hour is one upsert
+    pairs: dict[tuple[str, str, int], list] = {}
+    severities: dict[str, int] = {}
+    hours: dict[str, list[int]] = {}
+    for e in entries:
+        found = int(bool(e["found"]))
+        ts = e.get("ts") or ""
+        pair = pairs.setdefault((e["drug_a"], e["drug_b"], found), [0, ""])
+        pair[0] += 1
+        pair[1] = max(pair[1], ts)
+        severity = (e.get("severity") or "unknown") if found else "none"
+        severities[severity] = severities.get(severity, 0) + 1
+        if len(ts) >= 13:
+            hour = hours.setdefault(ts[:13], [0, 0])
+            hour[0] += 1
+            hour[1] += found
+    conn.executemany(
+        "INSERT INTO history_pairs (drug_a, drug_b, found, hits, last_ts) VALUES (?,?,?,?,?) "
+        "ON CONFLICT(drug_a, drug_b, found) DO UPDATE SET hits = hits + excluded.hits, last_ts = max(last_ts, excluded.last_ts)",
+        [(*key, hits, last) for key, (hits, last) in pairs.items()]
+    )
+    conn.executemany(
+        "INSERT INTO history_severity (severity, hits) VALUES (?,?) "
+        "ON CONFLICT(severity) DO UPDATE SET hits = hits + excluded.hits",
+        list(severities.items())
+    )
+    conn.executemany(
+        "INSERT INTO history_hourly (hour, checks, found) VALUES (?,?,?) "
+        "ON CONFLICT(hour) DO UPDATE SET checks = checks + excluded.checks, found = found + excluded.found",
+        [(hour, checks, found) for hour, (checks, found) in hours.items()]
+    )
+
+def iter_history_files():
+    #every entry of the json or ndjson history, oldest first, read one file at a time
+    if HISTORY_FORMAT == "json":
+        if HISTORY_PATH.exists():
+            yield from json.loads(HISTORY_PATH.read_text(encoding="utf-8") or "[]")
+        return
+    for path in history_segments() + [history_log_path()]:
+        if path.exists():
+            with open(path, "rb") as f:
+                for line in f:
+                    if line.strip():
+                        yield json.loads(line)
+
+def _rebuild_history_stats():
+    #the caller holds _history_lock, so no file-format write can land between reading the files and the commit.
+    # With the sqlite format the history table has to exist already (prepare_history_db)
+    with db_conn(str(history_db_path())) as conn:
+        for table in ("history_pairs", "history_severity", "history_hourly"):
+            conn.execute(f"DELETE FROM {table}")
+        if HISTORY_FORMAT == "sqlite":
+            conn.execute(
+                "INSERT INTO history_pairs (drug_a, drug_b, found, hits, last_ts) "
+                "SELECT drug_a, drug_b, found, COUNT(*), MAX(ts) FROM history GROUP BY drug_a, drug_b, found"
+            )
+            conn.execute(
+                "INSERT INTO history_severity (severity, hits) "
+                "SELECT CASE WHEN found THEN COALESCE(severity, 'unknown') ELSE 'none' END, COUNT(*) FROM history GROUP BY 1"
+            )
+            conn.execute(
+                "INSERT INTO history_hourly (hour, checks, found) "
+                "SELECT substr(ts, 1, 13), COUNT(*), SUM(found) FROM history WHERE length(ts) >= 13 GROUP BY 1"
+            )
+            return
+        chunk = []
+        for entry in iter_history_files():
+            chunk.append(entry)
+            if len(chunk) >= HISTORY_STATS_REBUILD_CHUNK:
+                update_history_stats(conn, chunk)
+                chunk = []
+        update_history_stats(conn, chunk)
+
+def rebuild_history_stats() -> int:
+    #recomputes the rollups from the stored history (after the queue is written out) and returns the number of checks
+    history_writer.flush()
+    if HISTORY_FORMAT == "sqlite":
+        prepare_history_db()
+    prepare_history_stats()
+    with _history_lock:
+        _rebuild_history_stats()
+    with db_conn(str(history_db_path())) as conn:
+        return conn.execute("SELECT COALESCE(SUM(hits), 0) FROM history_severity").fetchone()[0]
+
+def has_rule(a: str, b: str) -> bool:
+    if RULE_SNAPSHOT_PATH:
+        return current_snapshot().get(normalize_pair(a, b)) is not None
+    if RULE_INDEX_ENABLED:
+        ensure_rule_index()
+        return rule_index.get(normalize_pair(a, b)) is not None
+    return rule_exists_for_pair(a, b)
+
+def top_history_pairs(found: bool, limit: int, skip_known: bool = False) -> list[dict]:
+    #reads the pair rollup from the most to the least checked. For the misses, pairs that got a rule since can be
+    # skipped, then rows are read in pages until `limit` pairs are left
+    out = []
+    offset = 0
+    page = limit if not skip_known else limit * 2 + 10
+    with db_conn(str(history_db_path())) as conn:
+        while len(out) < limit:
+            rows = conn.execute(
+                "SELECT drug_a, drug_b, hits, last_ts FROM history_pairs WHERE found=? ORDER BY hits DESC LIMIT ? OFFSET ?",
+                (int(found), page, offset)
+            ).fetchall()
+            for a, b, hits, last_ts in rows:
+                if skip_known and has_rule(a, b):
+                    continue
+                out.append({"drug_a": a, "drug_b": b, "hits": hits, "last_ts": last_ts or None})
+                if len(out) == limit:
+                    break
+            if len(rows) < page:
+                break
+            offset += page
+    return out
 
 def rule_exists_for_pair(a: str, b: str) -> bool:
     a, b = normalize_pair(a, b)
-    with sqlite3.connect(DB_PATH) as conn:
+    with db_conn() as conn:
         cur = conn.cursor()
         cur.execute("SELECT 1 FROM rules WHERE a=? AND b=?", (a, b))
         return cur.fetchone() is not None
 
 #The post /check endpoint checks if there is an interaction between two drugs
 # if it doesn't find any interaction it tells it to the user and explains how to add a new interaction
-# but if it finds it, it logs it in the history json file and returns the severity and description to the user
+# but if it finds it, it logs it in the history log and returns the severity and description to the user
+
+CHECK_FOUND = {severity: CHECK_RESULTS.labels("true", severity) for severity in VALID_SEVERITIES}
+CHECK_NOT_FOUND = CHECK_RESULTS.labels("false", "none")
+CHECK_COALESCED = get_metric(Counter, "check_coalesced_requests", "POST /check requests that shared another request's lookup")
+
+#SingleFlight lets concurrent callers with the same key share one call: the first one runs it, the others wait for
+# its result (or its exception) instead of running it again. A key is only shared while its call is running
+
+class _Flight:
+    __slots__ = ("done", "result", "error", "waiters")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error: BaseException | None = None
+        self.waiters = 0
+
+class SingleFlight:
+    def __init__(self):
+        self._calls: dict = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn) -> tuple[object, bool]:
+        #returns (result, shared), shared is True when the result came from another caller's call
+        with self._lock:
+            flight = self._calls.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._calls[key] = _Flight()
+            else:
+                flight.waiters += 1
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result, True
+        try:
+            flight.result = fn()
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            flight.done.set()
+        return flight.result, False
+
+
+check_flights = SingleFlight()
+
+def check_lookup(a: str, b: str) -> tuple[str | None, bytes]:
+    #(severity, response body) for a normalized pair, severity is None when there is no rule
+    row = find_rule(a, b)
+    if not row:
+        #same body as CheckResp(found=False, message=..., suggest_add=True, how_to_add={... a, b ...}, did_you_mean=...)
+        return None, encode_check_miss(a, b, did_you_mean(a, b))
+    return row
+
+#Concurrent checks of the same pair share one lookup. The key includes the rule-set version, which every rule write
+# bumps once the new rule is visible, so a request that arrives after a write finished never gets an answer that was
+# looked up before it. The history and the metrics are still recorded for every request
 
 @app.post("/check", response_model=CheckResp)
 def check_interaction(req: CheckReq):
     a, b = normalize_pair(req.drug_a, req.drug_b)
+    if CHECK_COALESCE:
+        key = (a, b, rule_versions.epoch, rule_versions.version)
+        (severity, body), shared = check_flights.do(key, lambda: check_lookup(a, b))
+        if shared:
+            CHECK_COALESCED.inc()
+    else:
+        severity, body = check_lookup(a, b)
 
-    with sqlite3.connect(DB_PATH) as conn:
-        cur = conn.cursor()
-        cur.execute("SELECT severity, description FROM rules WHERE a=? AND b=?", (a, b))
-        row = cur.fetchone()
+    enqueue_history([history_entry(a, b, severity is not None, severity)])
+    if severity is None:
+        CHECK_NOT_FOUND.inc()
+    else:
+        (CHECK_FOUND.get(severity) or CHECK_RESULTS.labels("true", str(severity))).inc()
+    return RawJSONResponse(body)
 
-    if not row:
-        append_history(a, b, False, None)
+#The post /check/regimen endpoint checks every pair of a medication list in one request. Duplicates are removed,
+# the interacting pairs are returned from the most to the least severe, and all the checked pairs go to the history
+# in one batch
 
-        return CheckResp(
-            found=False,
-            message="No known interaction in local DB.",
-            suggest_add=True,
-            how_to_add={
-                "endpoint": "POST /rules",
-                "body_example": {
-                    "a": a, "b": b,
-                    "severity": "moderate",
-                    "description": "Describe the interaction here..."
-                },
-                "note": "Pairs are order-independent; inputs are stored alphabetically."
-            }
-        )
+@app.post("/check/regimen", response_model=RegimenResp)
+def check_regimen(req: RegimenReq):
+    drugs = list(dict.fromkeys(canonical_name(d) for d in req.drugs if d.strip()))
+    if len(drugs) < 2:
+        raise HTTPException(400, "At least two different drugs are needed")
 
-    severity, description = row
-    append_history(a, b, True, severity)
-    return CheckResp(found=True, severity=severity, description=description)
+    rows = find_rules_among(drugs)
+    rows.sort(key=lambda r: (SEVERITY_RANK.get(r[2], len(SEVERITY_RANK)), r[0], r[1]))
+    found = {(r[0], r[1]): r[2] for r in rows}
 
-#the get /history endpoint checks if a history file exists, if yes it reads it and if not creates an empty one
+    ts = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+    entries = []
+    for i, x in enumerate(drugs):
+        for y in drugs[i + 1:]:
+            a, b = normalize_pair(x, y)
+            severity = found.get((a, b))
+            entries.append(history_entry(a, b, severity is not None, severity, ts))
+    enqueue_history(entries)
+
+    return RegimenResp(
+        drugs=drugs,
+        pairs_checked=len(entries),
+        interactions=[RegimenInteraction(drug_a=a, drug_b=b, severity=sev, description=desc) for a, b, sev, desc in rows]
+    )
+
+#the get /history endpoint returns the last `limit` checks (oldest first), or all of them when limit is 0.
+# It can be filtered by drug (either side of the pair), found, severity and a since/until time range (until is exclusive).
+# When there are older matching entries the X-Next-Cursor header has the cursor to pass back for the previous page
 
 @app.get("/history")
-def get_history(limit: int = 50):
-    ensure_history_file()
-    data = json.loads(HISTORY_PATH.read_text(encoding="utf-8"))
-    return data[-limit:] if limit > 0 else data
+def get_history(limit: int = 50, drug: str | None = None, found: bool | None = None, severity: str | None = None,
+                since: str | None = None, until: str | None = None, cursor: int | None = None,
+                response: Response = None):
+    history_writer.flush()
+    entries, next_cursor = query_history(
+        limit,
+        drug=canonical_name(drug) if drug else None,
+        found=found,
+        severity=severity,
+        since=parse_history_ts(since, "since"),
+        until=parse_history_ts(until, "until"),
+        before=cursor,
+    )
+    if response is not None and next_cursor is not None:
+        response.headers["X-Next-Cursor"] = str(next_cursor)
+    return entries
+
+#get /history/stats answers from the rollup tables: the total number of checks and the miss rate, checks per severity,
+# the most checked pairs that have a rule, the most checked pairs that still have none (the ones worth adding next)
+# and the checks per hour of the last `hours` hours
 
-#get /rules lists all the rules in the database but we can also call it with an id to get one specific rule from the database
+@app.get("/history/stats")
+def get_history_stats(limit: int = 10, hours: int = 24):
+    if limit < 1 or hours < 0:
+        raise HTTPException(400, "limit must be positive and hours can't be negative")
+    limit = min(limit, RULES_PAGE_MAX)
+    history_writer.flush()
+    if HISTORY_FORMAT == "sqlite":
+        prepare_history_db()
+    prepare_history_stats()
+
+    since = time.strftime("%Y-%m-%dT%H", time.gmtime(time.time() - hours * 3600))
+    with db_conn(str(history_db_path())) as conn:
+        severity = dict(conn.execute("SELECT severity, hits FROM history_severity ORDER BY severity").fetchall())
+        hourly = conn.execute(
+            "SELECT hour, checks, found FROM history_hourly WHERE hour >= ? ORDER BY hour", (since,)
+        ).fetchall() if hours else []
+    total = sum(severity.values())
+    missed = severity.get("none", 0)
+    return {
+        "total": total,
+        "found": total - missed,
+        "missed": missed,
+        "miss_rate": round(missed / total, 4) if total else 0.0,
+        "severity": severity,
+        "top_pairs": top_history_pairs(True, limit),
+        "top_missing": top_history_pairs(False, limit, skip_known=True),
+        "hourly": [{"hour": f"{hour}:00:00Z", "checks": checks, "found": found} for hour, checks, found in hourly],
+    }
+
+#The rules are paginated by id (keyset pagination): a page is "the next `limit` rules with an id bigger than the
+# cursor", so every page costs the same no matter how deep into the table it is. The cursor is the last id of the
+# previous page, base64 encoded so it is safe to put into a header and a URL
+
+def encode_cursor(rule_id: str) -> str:
+    return base64.urlsafe_b64encode(rule_id.encode("utf-8")).decode("ascii")
+
+def decode_cursor(cursor: str) -> str:
+    try:
+        return base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8")
+    except (binascii.Error, UnicodeError, ValueError):
+        raise HTTPException(400, "Invalid cursor")
+
+def parse_rule_fields(fields: str | None) -> list[str]:
+    #the id is always included because it is what the cursor is made of
+    if not fields:
+        return list(RULE_FIELDS)
+    wanted = {f.strip() for f in fields.split(",") if f.strip()}
+    unknown = wanted - set(RULE_FIELDS)
+    if unknown:
+        raise HTTPException(400, f"Unknown fields: {', '.join(sorted(unknown))}")
+    return [f for f in RULE_FIELDS if f == "id" or f in wanted]
+
+def fetch_rules_page(columns: list[str], after_id: str | None, limit: int) -> list[tuple]:
+    sql = f"SELECT {', '.join(columns)} FROM rules"
+    params: list = []
+    if after_id is not None:
+        sql += " WHERE id > ?"
+        params.append(after_id)
+    sql += " ORDER BY id"
+    if limit > 0:
+        sql += " LIMIT ?"
+        params.append(limit)
+    with db_conn() as conn:
+        return conn.execute(sql, params).fetchall()
+
+def stream_rules_ndjson(columns: list[str], after_id: str | None, limit: int):
+    #yields the rules in chunks of RULES_STREAM_CHUNK rows, each chunk is its own short query so a slow client
+    # doesn't keep a connection (and a read transaction) busy for the whole download
+    sent = 0
+    while limit <= 0 or sent < limit:
+        chunk = RULES_STREAM_CHUNK if limit <= 0 else min(RULES_STREAM_CHUNK, limit - sent)
+        rows = fetch_rules_page(columns, after_id, chunk)
+        if not rows:
+            return
+        yield "".join(json.dumps(dict(zip(columns, r)), ensure_ascii=False) + "\n" for r in rows).encode("utf-8")
+        sent += len(rows)
+        after_id = rows[-1][0]
+        if len(rows) < chunk:
+            return
+
+#get /rules lists all the rules in the database but we can also call it with an id to get one specific rule from the database.
+# Without a limit the whole table is returned like before. With ?limit=N only one page is returned and the X-Next-Cursor
+# header has the cursor of the next page (it is missing on the last page). ?format=ndjson streams the rules one per line
+# instead of building one big array, and ?fields=id,a,b,severity leaves out the long descriptions
+
+#Both endpoints send an ETag (the rule-set version for the list, the rule's own version for one rule, see rules_etag).
+# A client that sends it back in If-None-Match gets an empty 304 when nothing changed, which costs one indexed read
+# instead of the whole query. The version is read before the query, so a write that lands in between only makes the
+# ETag older than the data and the client fetches again next time
 
 @app.get("/rules", response_model=list[RuleOut])
-def list_rules():
-    with sqlite3.connect(DB_PATH) as conn:
-        cur = conn.cursor()
-        cur.execute("SELECT id, a, b, severity, description FROM rules ORDER BY id")
-        rows = cur.fetchall()
-    return [RuleOut(id=r[0], a=r[1], b=r[2], severity=r[3], description=r[4]) for r in rows]
+def list_rules(request: Request, limit: int = 0, cursor: str | None = None, fields: str | None = None, format: str = "json"):
+    etag, seq = rules_etag()
+    cached = not_modified(request, etag)
+    if cached is not None:
+        return cached
+
+    columns = parse_rule_fields(fields)
+    after_id = decode_cursor(cursor) if cursor else None
+    #X-Rules-Seq is where a mirror that copies this list continues with GET /rules/changes. It is read before the
+    # rules, so a change made during the download is sent again by the feed instead of being missed
+    headers = {"ETag": etag, "Cache-Control": RULES_CACHE_CONTROL, "X-Rules-Seq": str(seq)}
+
+    if format == "ndjson":
+        return StreamingResponse(stream_rules_ndjson(columns, after_id, limit), media_type="application/x-ndjson",
+                                 headers=headers)
+    if format != "json":
+        raise HTTPException(400, "format must be json or ndjson")
+
+    limit = min(limit, RULES_PAGE_MAX) if limit > 0 else 0
+    rows = fetch_rules_page(columns, after_id, limit + 1 if limit else 0)
+    if limit and len(rows) > limit:
+        rows = rows[:limit]
+        headers["X-Next-Cursor"] = encode_cursor(rows[-1][0])
+    return JSONResponse([dict(zip(columns, r)) for r in rows], headers=headers)
+
+#get /rules/changes?since=<seq> returns the rules changed after `since`, in the order of their seq: "upsert" entries
+# carry the whole rule and "delete" entries only the id. A mirror stores `next` and passes it as since= on the next call,
+# while `more` is true it can call again right away. With ?wait=30 the request waits up to 30 seconds for a change
+# instead of returning an empty list. A 410 means the mirror was away longer than the tombstones are kept
+
+@app.get("/rules/changes")
+async def rule_changes(since: int = 0, limit: int = RULES_PAGE_MAX, wait: float = 0):
+    limit = max(1, min(limit, RULES_PAGE_MAX))
+    deadline = time.monotonic() + min(max(wait, 0), RULE_CHANGES_MAX_WAIT)
+    while True:
+        #listen before reading, so a write that commits right after the read still wakes us up
+        event = rule_change_notifier.listen()
+        try:
+            result = await run_in_threadpool(read_rule_changes, since, limit)
+            remaining = deadline - time.monotonic()
+            if result["changes"] or remaining <= 0:
+                return result
+            try:
+                await asyncio.wait_for(event.wait(), min(remaining, RULE_CHANGES_POLL_INTERVAL))
+            except asyncio.TimeoutError:
+                pass
+        finally:
+            rule_change_notifier.forget(event)
+
+#get /rules/search?q=qt prolongation finds the rules whose drugs or description contain all the words of q, best
+# matches first. Every result has a snippet of the description with the matching words in <mark> tags. The results
+# come in pages of `limit` (SEARCH_PAGE_SIZE by default), `next_offset` is the offset of the next page (null on the last one)
+
+@app.get("/rules/search")
+def search_rules(q: str, limit: int = SEARCH_PAGE_SIZE, offset: int = 0):
+    match = fts_query(q)
+    if not match:
+        raise HTTPException(400, "q must contain at least one word")
+    limit = max(1, min(limit, RULES_PAGE_MAX))
+    offset = max(0, offset)
+
+    ensure_rules_search()
+    with db_conn() as conn:
+        total = conn.execute("SELECT count(*) FROM rules_fts WHERE rules_fts MATCH ?", (match,)).fetchone()[0]
+        #the page is picked inside the FTS table (ORDER BY rank lets FTS5 sort it itself), and only the rows of that
+        # page are joined with rules
+        rows = conn.execute(
+            """
+            SELECT r.id, r.a, r.b, r.severity, m.snippet, m.rank
+            FROM (
+                SELECT rowid, snippet(rules_fts, 2, '<mark>', '</mark>', '…', ?) AS snippet, rank
+                FROM rules_fts WHERE rules_fts MATCH ? ORDER BY rank LIMIT ? OFFSET ?
+            ) m JOIN rules r ON r.rowid = m.rowid
+            ORDER BY m.rank, r.id
+            """,
+            (SEARCH_SNIPPET_TOKENS, match, limit, offset)
+        ).fetchall()
+    return {
+        "q": q,
+        "total": total,
+        "next_offset": offset + limit if offset + limit < total else None,
+        "results": [
+            {"id": r[0], "a": r[1], "b": r[2], "severity": r[3], "snippet": r[4], "score": round(-r[5], 4)}
+            for r in rows
+        ],
+    }
 
 @app.get("/rules/{rule_id}", response_model=RuleOut)
-def get_rule(rule_id: str):
-    with sqlite3.connect(DB_PATH) as conn:
+def get_rule(rule_id: str, request: Request):
+    etag = rule_etag(rule_id)
+    if etag is not None:
+        cached = not_modified(request, etag)
+        if cached is not None:
+            return cached
+
+    with db_conn() as conn:
         cur = conn.cursor()
         cur.execute("SELECT id, a, b, severity, description FROM rules WHERE id=?", (rule_id,))
         r = cur.fetchone()
     if not r:
         raise HTTPException(404, "Rule not found")
-    return RuleOut(id=r[0], a=r[1], b=r[2], severity=r[3], description=r[4])
+    headers = {"Cache-Control": RULES_CACHE_CONTROL}
+    if etag is not None:
+        headers["ETag"] = etag
+    return JSONResponse({"id": r[0], "a": r[1], "b": r[2], "severity": r[3], "description": r[4]}, headers=headers)
 
 #app.post creates a new rule but before that normalizes the pair and if it exists already yields a 409 error
 
@@ -178,16 +2434,22 @@ def create_rule(rule: RuleIn):
     if rule_exists_for_pair(a, b):
         raise HTTPException(409, "Pair already exists (order-independent)")
 
-    with sqlite3.connect(DB_PATH) as conn:
-        cur = conn.cursor()
-        try:
-            cur.execute(
-                "INSERT INTO rules (id,a,b,severity,description) VALUES (?,?,?,?,?)",
-                (rule_id, a, b, rule.severity, rule.description)
-            )
-            conn.commit()
-        except sqlite3.IntegrityError as e:
-            raise HTTPException(409, f"Conflict: {e}")
+    with _rules_write_lock:
+        with db_conn() as conn:
+            cur = conn.cursor()
+            try:
+                cur.execute(
+                    "INSERT INTO rules (id,a,b,severity,description) VALUES (?,?,?,?,?)",
+                    (rule_id, a, b, rule.severity, rule.description)
+                )
+                conn.commit()
+            except sqlite3.IntegrityError as e:
+                raise HTTPException(409, f"Conflict: {e}")
+        if rule_index.loaded:
+            rule_index.put(rule_id, a, b, rule.severity, rule.description)
+        rule_versions.bump()
+        schedule_snapshot_rebuild()
+        refresh_name_index()
     return {"ok": True, "id": rule_id}
 
 #app.put updates a rule based on its id and if it is not found it yiekds a 404 error
@@ -196,11 +2458,18 @@ def create_rule(rule: RuleIn):
 def update_rule(rule_id: str, severity: str, description: str):
     if severity not in VALID_SEVERITIES:
         raise HTTPException(400, "Invalid severity")
-    with sqlite3.connect(DB_PATH) as conn:
-        cur = conn.cursor()
-        cur.execute("UPDATE rules SET severity=?, description=? WHERE id=?", (severity, description, rule_id))
-        changed = cur.rowcount
-        conn.commit()
+    with _rules_write_lock:
+        with db_conn() as conn:
+            cur = conn.cursor()
+            cur.execute("UPDATE rules SET severity=?, description=? WHERE id=?", (severity, description, rule_id))
+            changed = cur.rowcount
+            conn.commit()
+        if changed and rule_index.loaded and not rule_index.update(rule_id, severity, description):
+            reload_rule_index()
+        if changed:
+            rule_versions.bump()
+            schedule_snapshot_rebuild()
+            refresh_name_index()
     if not changed:
         raise HTTPException(404, "Rule not found")
     return {"ok": True}
@@ -209,19 +2478,786 @@ def update_rule(rule_id: str, severity: str, description: str):
 
 @app.delete("/rules/{rule_id}")
 def delete_rule(rule_id: str):
-    with sqlite3.connect(DB_PATH) as conn:
-        cur = conn.cursor()
-        cur.execute("DELETE FROM rules WHERE id=?", (rule_id,))
-        changed = cur.rowcount
-        conn.commit()
+    with _rules_write_lock:
+        with db_conn() as conn:
+            cur = conn.cursor()
+            cur.execute("DELETE FROM rules WHERE id=?", (rule_id,))
+            changed = cur.rowcount
+            conn.commit()
+        if changed and rule_index.loaded:
+            rule_index.remove(rule_id)
+        if changed:
+            rule_versions.bump()
+            schedule_snapshot_rebuild()
+            refresh_name_index()
     if not changed:
         raise HTTPException(404, "Rule not found")
     return {"ok": True}
 
+#The RuleImporter loads many rules in one transaction. It works in two steps so that a slow upload never holds up
+# other rule writes: add_chunk() checks the rows that don't need the database (required fields, severity) and spools
+# the good ones to a temporary file while the upload is still arriving, without any lock. commit() then takes the write
+# lock and one transaction only for the merge: it reads the spool back in chunks, normalizes the pairs, checks them
+# against the existing rules with one query per chunk and writes them with executemany. `mode` decides what happens to
+# a pair that already exists: "insert" reports it as an error, "upsert" updates its severity and description,
+# "skip-existing" skips it. seed.py uses it too.
+
+class RuleImporter:
+    def __init__(self, mode: str = "insert"):
+        if mode not in BULK_MODES:
+            raise ValueError(f"mode must be one of {', '.join(BULK_MODES)}")
+        self.mode = mode
+        self.inserted = self.updated = self.skipped = 0
+        self.errors: list[dict] = []
+        self.error_count = 0
+        self._seen_pairs: set[tuple[str, str]] = set()
+        self._changes: list[tuple[str, str, str, str, str]] = []
+        self._spool = tempfile.TemporaryFile("w+", encoding="utf-8")
+        self._conn = None
+
+    def error(self, line: int, message: str):
+        self.error_count += 1
+        if len(self.errors) < BULK_MAX_ERRORS:
+            self.errors.append({"line": line, "error": message})
+
+    def add_chunk(self, records: list[tuple[int, dict]]):
+        for line, rec in records:
+            a, b, severity, description = rec.get("a"), rec.get("b"), rec.get("severity"), rec.get("description")
+            if not all(isinstance(v, str) and v.strip() for v in (a, b, severity, description)):
+                self.error(line, "a, b, severity and description are required")
+                continue
+            severity = severity.strip().lower()
+            if severity not in VALID_SEVERITIES:
+                self.error(line, f"Invalid severity: {severity}")
+                continue
+            rule_id = str(rec.get("id") or "").strip()
+            self._spool.write(json.dumps([line, rule_id, a, b, severity, description]) + "\n")
+
+    def _spooled_chunks(self):
+        self._spool.seek(0)
+        chunk = []
+        for text in self._spool:
+            chunk.append(json.loads(text))
+            if len(chunk) >= BULK_CHUNK_SIZE:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def _merge_chunk(self, rows: list[list]):
+        #pairs are normalized here, under the lock, so an alias added during the upload is still applied
+        valid = []
+        for line, rule_id, a, b, severity, description in rows:
+            a, b = normalize_pair(a, b)
+            if (a, b) in self._seen_pairs:
+                self.error(line, "Pair appears more than once in the upload")
+                continue
+            self._seen_pairs.add((a, b))
+            valid.append((line, rule_id or f"{a}_{b}", a, b, severity, description))
+        if not valid:
+            return
+
+        pairs_sql = ",".join("(?,?)" for _ in valid)
+        by_pair = {
+            (r[1], r[2]): r[0] for r in self._conn.execute(
+                f"WITH wanted(a, b) AS (VALUES {pairs_sql}) "
+                "SELECT r.id, r.a, r.b FROM rules r JOIN wanted w ON r.a = w.a AND r.b = w.b",
+                [x for v in valid for x in (v[2], v[3])]
+            )
+        }
+        taken_ids = {
+            r[0] for r in self._conn.execute(
+                f"SELECT id FROM rules WHERE id IN ({','.join('?' * len(valid))})", [v[1] for v in valid]
+            )
+        }
+
+        inserts, updates = [], []
+        for line, rule_id, a, b, severity, description in valid:
+            existing_id = by_pair.get((a, b))
+            if existing_id is not None:
+                if self.mode == "insert":
+                    self.error(line, "Pair already exists (order-independent)")
+                elif self.mode == "skip-existing":
+                    self.skipped += 1
+                else:
+                    updates.append((severity, description, existing_id))
+                    self._changes.append((existing_id, a, b, severity, description))
+            elif rule_id in taken_ids:
+                self.error(line, f"Id already used by another pair: {rule_id}")
+            else:
+                taken_ids.add(rule_id)
+                inserts.append((rule_id, a, b, severity, description))
+                self._changes.append((rule_id, a, b, severity, description))
+
+        self._conn.executemany("INSERT INTO rules (id,a,b,severity,description) VALUES (?,?,?,?,?)", inserts)
+        self._conn.executemany("UPDATE rules SET severity=?, description=? WHERE id=?", updates)
+        self.inserted += len(inserts)
+        self.updated += len(updates)
+
+    def commit(self):
+        try:
+            ensure_rules_schema()
+            with _rules_write_lock:
+                with db_conn() as conn:
+                    self._conn = conn
+                    try:
+                        conn.execute("BEGIN IMMEDIATE")
+                        for rows in self._spooled_chunks():
+                            self._merge_chunk(rows)
+                        conn.commit()
+                    finally:
+                        self._conn = None
+                if rule_index.loaded:
+                    for change in self._changes:
+                        rule_index.put(*change)
+                if self._changes:
+                    rule_versions.bump()
+                    schedule_snapshot_rebuild()
+                    refresh_name_index()
+        finally:
+            self.discard()
+
+    def discard(self):
+        #drops the spooled rows, for an upload that failed before commit()
+        self._spool.close()
+
+    def report(self) -> dict:
+        return {
+            "ok": True,
+            "mode": self.mode,
+            "inserted": self.inserted,
+            "updated": self.updated,
+            "skipped": self.skipped,
+            "error_count": self.error_count,
+            "errors": sorted(self.errors, key=lambda e: e["line"]),
+        }
+
+def import_rules(records, mode: str = "insert") -> dict:
+    #loads an iterable of rule dicts (with keys id, a, b, severity, description), used by seed.py
+    importer = RuleImporter(mode)
+    try:
+        chunk = []
+        for line, rec in enumerate(records, start=1):
+            chunk.append((line, rec))
+            if len(chunk) >= BULK_CHUNK_SIZE:
+                importer.add_chunk(chunk)
+                chunk = []
+        if chunk:
+            importer.add_chunk(chunk)
+    except BaseException:
+        importer.discard()
+        raise
+    importer.commit()
+    return importer.report()
+
+#the upload is read line by line while it arrives instead of being loaded into memory first. A CSV record can span
+# several lines when a quoted description has line breaks in it, so lines are joined until the quotes are balanced
+
+async def iter_upload_lines(stream):
+    buf = b""
+    line_no = 0
+    async for chunk in stream:
+        buf += chunk
+        *lines, buf = buf.split(b"\n")
+        for line in lines:
+            line_no += 1
+            yield line_no, line
+    if buf:
+        yield line_no + 1, buf
+
+async def iter_bulk_records(stream, fmt: str):
+    #yields (line number, record dict) or (line number, error message)
+    header = None
+    pending, start = "", 0
+    async for line_no, raw in iter_upload_lines(stream):
+        try:
+            text = raw.decode("utf-8").rstrip("\r")
+        except UnicodeDecodeError:
+            yield line_no, "Line is not valid UTF-8"
+            continue
+        if fmt == "ndjson":
+            if not text.strip():
+                continue
+            try:
+                record = json.loads(text)
+            except ValueError:
+                yield line_no, "Invalid JSON"
+                continue
+            yield line_no, record if isinstance(record, dict) else "Each line must be a JSON object"
+            continue
+
+        if not pending:
+            start = line_no
+        pending = pending + "\n" + text if pending else text
+        if pending.count('"') % 2:
+            continue
+        record_text, pending = pending, ""
+        if not record_text.strip():
+            continue
+        values = next(csv.reader([record_text]))
+        if header is None:
+            header = [h.strip().lower() for h in values]
+            continue
+        yield start, dict(zip(header, values))
+    if pending:
+        yield start, "Unterminated quoted field"
+
+#app.post /rules/bulk imports many rules from one streamed upload, either CSV with a header line (id,a,b,severity,description,
+# the id column is optional) or NDJSON with one rule object per line. All the valid rows are committed in one transaction
+# and the rows that could not be imported are listed with their line number in the response
+
+@app.post("/rules/bulk")
+async def bulk_import_rules(request: Request, mode: str = "insert", format: str | None = None):
+    if mode not in BULK_MODES:
+        raise HTTPException(400, f"mode must be one of {', '.join(BULK_MODES)}")
+    fmt = format or ("csv" if "csv" in request.headers.get("content-type", "") else "ndjson")
+    if fmt not in ("csv", "ndjson"):
+        raise HTTPException(400, "format must be csv or ndjson")
+
+    importer = RuleImporter(mode)
+    try:
+        chunk = []
+        async for line, record in iter_bulk_records(request.stream(), fmt):
+            if isinstance(record, str):
+                importer.error(line, record)
+                continue
+            chunk.append((line, record))
+            if len(chunk) >= BULK_CHUNK_SIZE:
+                await run_in_threadpool(importer.add_chunk, chunk)
+                chunk = []
+        if chunk:
+            await run_in_threadpool(importer.add_chunk, chunk)
+    except BaseException:
+        importer.discard()
+        raise
+    await run_in_threadpool(importer.commit)
+    return importer.report()
+
+#set_alias adds or changes an alias. The rules stored under the alias are renamed to the canonical name in the same
+# transaction (and moved in the rule index), so every rule is always stored under canonical names. If renaming would
+# give two rules for the same pair the alias is refused with a 409
+
+def set_alias(alias: str, canonical: str) -> list[str]:
+    alias = alias.strip().lower()
+    canonical = canonical_name(canonical)
+    if not alias or not canonical:
+        raise HTTPException(400, "alias and canonical can't be empty")
+    if alias == canonical:
+        raise HTTPException(400, "An alias can't point to itself")
+
+    with _rules_write_lock:
+        ensure_rules_schema()
+        if not alias_index.loaded:
+            load_aliases()
+        renamed = []
+        with db_conn() as conn:
+            conn.execute(
+                "INSERT INTO aliases (alias, canonical) VALUES (?,?) ON CONFLICT(alias) DO UPDATE SET canonical=excluded.canonical",
+                (alias, canonical)
+            )
+            conn.execute("UPDATE aliases SET canonical=? WHERE canonical=?", (canonical, alias))
+            rows = conn.execute("SELECT id, a, b FROM rules WHERE a=? OR b=?", (alias, alias)).fetchall()
+            for rule_id, a, b in rows:
+                x, y = (canonical if a == alias else a), (canonical if b == alias else b)
+                if x == y:
+                    raise HTTPException(409, f"Rule {rule_id} would pair {canonical} with itself")
+                pair = (x, y) if x <= y else (y, x)
+                clash = conn.execute("SELECT id FROM rules WHERE a=? AND b=? AND id<>?", (*pair, rule_id)).fetchone()
+                if clash:
+                    raise HTTPException(409, f"Rule {rule_id} would duplicate rule {clash[0]}")
+                conn.execute("UPDATE rules SET a=?, b=? WHERE id=?", (*pair, rule_id))
+                renamed.append((rule_id, pair))
+            version = aliases_version(conn)
+        if rule_index.loaded:
+            for rule_id, pair in renamed:
+                rule_index.move(rule_id, pair)
+            if alias not in alias_index.forward:
+                rule_index.names.add(alias)
+        if renamed:
+            rule_versions.bump()
+        alias_index.set(alias, canonical)
+        alias_index.version = version
+    schedule_snapshot_rebuild()
+    refresh_name_index()
+    return [rule_id for rule_id, _ in renamed]
+
+def delete_alias(alias: str) -> bool:
+    alias = alias.strip().lower()
+    with _rules_write_lock:
+        with db_conn() as conn:
+            changed = conn.execute("DELETE FROM aliases WHERE alias=?", (alias,)).rowcount
+            version = aliases_version(conn)
+        if rule_index.loaded and alias in alias_index.forward:
+            rule_index.names.discard(alias)
+        alias_index.remove(alias)
+        alias_index.version = version
+    schedule_snapshot_rebuild()
+    refresh_name_index()
+    return bool(changed)
+
+#the alias endpoints list, add/change and delete aliases. Changing one only touches that alias in the in-memory map
+# and the rules stored under it, nothing is rebuilt from scratch
+
+@app.get("/aliases")
+def list_aliases():
+    if not alias_index.loaded:
+        load_aliases()
+    return [{"alias": alias, "canonical": canonical} for alias, canonical in sorted(alias_index.forward.items())]
+
+@app.put("/aliases/{alias}")
+def put_alias(alias: str, canonical: str):
+    renamed = set_alias(alias, canonical)
+    return {"ok": True, "alias": alias.strip().lower(), "canonical": canonical_name(canonical), "renamed_rules": renamed}
+
+@app.delete("/aliases/{alias}")
+def remove_alias(alias: str):
+    if not delete_alias(alias):
+        raise HTTPException(404, "Alias not found")
+    return {"ok": True}
+
+#get /drugs/suggest returns the known drug names closest to `q`, it is used for autocomplete on the home page and
+# answers from the trigram index in memory, which the rule and alias endpoints keep up to date
+
+@app.get("/drugs/suggest")
+def suggest_drugs(q: str, limit: int = 10):
+    limit = max(1, min(limit, SUGGEST_MAX))
+    return {
+        "query": q,
+        "suggestions": [{"name": name, "score": score} for name, score in drug_names().suggest(q, limit)]
+    }
+
+#get /drugs/{name}/interactions lists every rule of one drug (brand names are looked up under their ingredient).
+# ?severity=major,contraindicated keeps only those severities, ?order=severity (the default) puts the most serious
+# first and ?order=drug sorts by the other drug's name. ?limit=N returns only the first N, `total` is the count before it
+
+@app.get("/drugs/{name}/interactions")
+def drug_interactions(name: str, severity: str | None = None, order: str = "severity", limit: int = 0):
+    drug = canonical_name(name)
+    if not drug:
+        raise HTTPException(400, "name can't be empty")
+    if order not in ("severity", "drug"):
+        raise HTTPException(400, "order must be severity or drug")
+    wanted = None
+    if severity:
+        wanted = {s.strip().lower() for s in severity.split(",") if s.strip()}
+        if not wanted <= VALID_SEVERITIES:
+            raise HTTPException(400, f"Unknown severity: {', '.join(sorted(wanted - VALID_SEVERITIES))}")
+
+    rows = [r for r in find_interactions_of(drug) if wanted is None or r[2] in wanted]
+    if order == "severity":
+        key = lambda r: (SEVERITY_RANK.get(r[2], len(SEVERITY_RANK)), r[1])
+    else:
+        key = lambda r: r[1]
+    total = len(rows)
+    #for a hub drug with thousands of rules and a small limit only the first `limit` are sorted
+    rows = heapq.nsmallest(limit, rows, key=key) if 0 < limit < total else sorted(rows, key=key)
+    return {
+        "drug": drug,
+        "total": total,
+        "interactions": [
+            {"id": rule_id, "drug": other, "severity": sev, "description": description}
+            for rule_id, other, sev, description in rows
+        ],
+    }
+
+#The pharmacy lookup goes through the server instead of every browser calling Overpass itself. The world is cut into
+# square tiles of PHARMACY_TILE_DEG degrees (about 5.5 km north-south by default). A request needs the tiles its
+# circle touches, keeps the pharmacies inside the radius and sorts them by distance. The tiles that are not cached yet
+# are fetched with one upstream query for the box around them, which is then split into tiles and cached, so a request
+# makes at most one upstream call however many tiles it needs. When several requests need the same tile at the same
+# time they share that call, and PHARMACY_UPSTREAM_CONCURRENCY caps the calls running at once
+
+class OverpassUpstream:
+    #the upstream client, anything with an async fetch(south, west, north, east) returning compact pharmacy dicts works.
+    # `transport` is there so the tests can answer the HTTP calls locally
+    def __init__(self, url: str, timeout: float = 30, transport=None):
+        self.url = url
+        self.timeout = timeout
+        self.transport = transport
+
+    async def fetch(self, south: float, west: float, north: float, east: float) -> list[dict]:
+        bbox = f"{south:.6f},{west:.6f},{north:.6f},{east:.6f}"
+        query = (
+            f'[out:json][timeout:25];(node["amenity"="pharmacy"]({bbox});way["amenity"="pharmacy"]({bbox});'
+            f'relation["amenity"="pharmacy"]({bbox}););out center tags;'
+        )
+        async with httpx.AsyncClient(timeout=self.timeout, transport=self.transport) as client:
+            resp = await client.post(self.url, data={"data": query})
+            resp.raise_for_status()
+            data = resp.json()
+        return [p for p in (compact_pharmacy(e) for e in data.get("elements", [])) if p is not None]
+
+def compact_pharmacy(element: dict) -> dict | None:
+    lat = element.get("lat", (element.get("center") or {}).get("lat"))
+    lon = element.get("lon", (element.get("center") or {}).get("lon"))
+    if lat is None or lon is None:
+        return None
+    tags = element.get("tags") or {}
+    addr = ", ".join(filter(None, (tags.get(k) for k in ("addr:street", "addr:housenumber", "addr:postcode", "addr:city"))))
+    place = {
+        "id": f"{element.get('type', 'node')}/{element.get('id')}",
+        "name": tags.get("name") or "Pharmacy",
+        "lat": round(lat, 6),
+        "lon": round(lon, 6),
+        "addr": addr or tags.get("addr:full"),
+        "phone": tags.get("phone") or tags.get("contact:phone"),
+        "hours": tags.get("opening_hours"),
+    }
+    return {k: v for k, v in place.items() if v is not None}
+
+class TileCache:
+    def __init__(self, max_tiles: int, ttl: float):
+        self.max_tiles = max_tiles
+        self.ttl = ttl
+        self._tiles: OrderedDict[tuple[int, int], tuple[float, list[dict]]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: tuple[int, int]) -> list[dict] | None:
+        with self._lock:
+            hit = self._tiles.get(key)
+            if hit is None:
+                return None
+            if time.monotonic() - hit[0] > self.ttl:
+                del self._tiles[key]
+                return None
+            self._tiles.move_to_end(key)
+            return hit[1]
+
+    def put(self, key: tuple[int, int], places: list[dict]):
+        with self._lock:
+            self._tiles[key] = (time.monotonic(), places)
+            self._tiles.move_to_end(key)
+            while len(self._tiles) > self.max_tiles:
+                self._tiles.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._tiles.clear()
+
+    def __len__(self):
+        return len(self._tiles)
+
+
+pharmacy_upstream = OverpassUpstream(PHARMACY_UPSTREAM_URL, PHARMACY_UPSTREAM_TIMEOUT)
+pharmacy_tiles = TileCache(PHARMACY_CACHE_TILES, PHARMACY_CACHE_TTL)
+_pharmacy_inflight: dict[tuple[int, int], asyncio.Task] = {}
+#asyncio semaphores belong to one event loop, so there is one per loop (the tests run several)
+_pharmacy_slots: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Semaphore]" = weakref.WeakKeyDictionary()
+
+PHARMACY_TILE_HIT = CACHE_REQUESTS.labels("pharmacy_tiles", "hit")
+PHARMACY_TILE_MISS = CACHE_REQUESTS.labels("pharmacy_tiles", "miss")
+PHARMACY_TILE_SHARED = CACHE_REQUESTS.labels("pharmacy_tiles", "coalesced")
+
+def tiles_for_circle(lat: float, lon: float, radius: float) -> list[tuple[int, int]]:
+    dlat = radius / 111320
+    dlon = radius / (111320 * max(math.cos(math.radians(lat)), 0.01))
+    south, north = max(lat - dlat, -90), min(lat + dlat, 90)
+    west, east = max(lon - dlon, -180), min(lon + dlon, 180)
+    rows = range(math.floor(south / PHARMACY_TILE_DEG), math.floor(north / PHARMACY_TILE_DEG) + 1)
+    cols = range(math.floor(west / PHARMACY_TILE_DEG), math.floor(east / PHARMACY_TILE_DEG) + 1)
+    return [(row, col) for row in rows for col in cols]
+
+def pharmacy_slots() -> asyncio.Semaphore:
+    loop = asyncio.get_running_loop()
+    slots = _pharmacy_slots.get(loop)
+    if slots is None:
+        slots = _pharmacy_slots[loop] = asyncio.Semaphore(max(1, PHARMACY_UPSTREAM_CONCURRENCY))
+    return slots
+
+async def fetch_pharmacy_block(keys: list[tuple[int, int]]) -> dict[tuple[int, int], list[dict]]:
+    #one upstream query for the box around `keys`, every tile of the box is cached from it
+    rows, cols = [k[0] for k in keys], [k[1] for k in keys]
+    south, west = min(rows) * PHARMACY_TILE_DEG, min(cols) * PHARMACY_TILE_DEG
+    north, east = (max(rows) + 1) * PHARMACY_TILE_DEG, (max(cols) + 1) * PHARMACY_TILE_DEG
+    async with pharmacy_slots():
+        places = await pharmacy_upstream.fetch(south, west, north, east)
+    tiles = {(row, col): [] for row in range(min(rows), max(rows) + 1) for col in range(min(cols), max(cols) + 1)}
+    for place in places:
+        key = (math.floor(place["lat"] / PHARMACY_TILE_DEG), math.floor(place["lon"] / PHARMACY_TILE_DEG))
+        if key in tiles:
+            tiles[key].append(place)
+    for key, tile in tiles.items():
+        pharmacy_tiles.put(key, tile)
+    return tiles
+
+async def fetch_pharmacy_tiles(keys: list[tuple[int, int]]) -> list[list[dict]]:
+    loop = asyncio.get_running_loop()
+    found: dict[tuple[int, int], list[dict]] = {}
+    waiting: dict[tuple[int, int], asyncio.Task] = {}
+    missing = []
+    for key in keys:
+        cached = pharmacy_tiles.get(key)
+        if cached is not None:
+            PHARMACY_TILE_HIT.inc()
+            found[key] = cached
+            continue
+        task = _pharmacy_inflight.get(key)
+        if task is not None and task.get_loop() is loop:
+            PHARMACY_TILE_SHARED.inc()
+            waiting[key] = task
+        else:
+            missing.append(key)
+
+    if missing:
+        PHARMACY_TILE_MISS.inc(len(missing))
+        task = loop.create_task(fetch_pharmacy_block(missing))
+        for key in missing:
+            _pharmacy_inflight[key] = task
+            waiting[key] = task
+        try:
+            await asyncio.shield(task)
+        finally:
+            for key in missing:
+                if _pharmacy_inflight.get(key) is task:
+                    del _pharmacy_inflight[key]
+    for key, task in waiting.items():
+        found[key] = (await asyncio.shield(task))[key]
+    return [found[key] for key in keys]
+
+def distance_m(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    dlat, dlon = math.radians(lat2 - lat1), math.radians(lon2 - lon1)
+    a = math.sin(dlat / 2) ** 2 + math.cos(math.radians(lat1)) * math.cos(math.radians(lat2)) * math.sin(dlon / 2) ** 2
+    return 6371000 * 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
+
+#get /pharmacies returns the pharmacies within `radius` meters of lat/lon, nearest first, with the distance in meters.
+# Fields without data are left out to keep the answer small
+
+@app.get("/pharmacies")
+async def get_pharmacies(lat: float, lon: float, radius: float = 2000):
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        raise HTTPException(400, "lat must be between -90 and 90 and lon between -180 and 180")
+    if not 0 < radius <= PHARMACY_MAX_RADIUS:
+        raise HTTPException(400, f"radius must be between 1 and {PHARMACY_MAX_RADIUS} meters")
+    keys = tiles_for_circle(lat, lon, radius)
+
+    try:
+        tiles = await fetch_pharmacy_tiles(keys)
+    except (httpx.HTTPError, ValueError) as e:
+        logger.warning("pharmacy upstream failed: %s", e)
+        raise HTTPException(502, "Pharmacy lookup is not available right now")
+
+    found = {}
+    for places in tiles:
+        for place in places:
+            if place["id"] in found:
+                continue
+            dist = distance_m(lat, lon, place["lat"], place["lon"])
+            if dist <= radius:
+                found[place["id"]] = {**place, "dist": round(dist)}
+    pharmacies = sorted(found.values(), key=lambda p: p["dist"])
+    return RawJSONResponse(
+        encode_json({"count": len(pharmacies), "pharmacies": pharmacies}),
+        headers={"Cache-Control": "public, max-age=300"}
+    )
+
+#app.post /admin/reload-rules rebuilds the in-memory index (and the alias map) from the database. Writes through the
+# API or scripts reach every worker by the change log anyway, this is for when app.db was changed in a way the triggers
+# don't see (a replaced file, a restored backup). It starts a new change-log epoch, which makes the other workers
+# reload as well and invalidates the ETags, because the API can't know which rules were changed
+
+@app.post("/admin/reload-rules")
+def reload_rules():
+    #the new epoch is written first, so the reloaded index is at it and the other workers reload too
+    ensure_rule_changes()
+    with db_conn() as conn:
+        conn.execute("UPDATE rule_changes_meta SET value=? WHERE key='epoch'", (new_rules_epoch(),))
+    if RULE_SNAPSHOT_PATH:
+        load_aliases()
+        count = compile_rules_snapshot()["rules"]
+        refresh_snapshot()
+    elif RULE_INDEX_ENABLED:
+        count = reload_rule_index()
+    else:
+        load_aliases()
+        refresh_name_index()
+        with db_conn() as conn:
+            count = conn.execute("SELECT count(*) FROM rules").fetchone()[0]
+    rule_versions.reset()
+    return {"ok": True, "rules": count}
+
+#app.post /admin/rebuild-history-stats recomputes the /history/stats rollups from the stored history, for example
+# after the history files were edited by hand or restored from a backup
+
+@app.post("/admin/rebuild-history-stats")
+def rebuild_stats():
+    return {"ok": True, "checks": rebuild_history_stats()}
+
+#GET /admin/export streams the rules, the aliases and the whole history as gzip compressed NDJSON, one object per line
+# with a "type" of "export" (the first line), "alias", "rule" or "history". Everything is read in chunks of
+# RULES_STREAM_CHUNK rows, each with its own short query, and compressed as it goes, so the memory used doesn't grow
+# with the size of the data and no transaction stays open while a slow client downloads. The export is not one
+# snapshot (a rule written during the download may or may not be in it), the backup below is. restore.py loads it back
+
+def iter_export_lines():
+    history_writer.flush()
+    with db_conn() as conn:
+        aliases = conn.execute("SELECT alias, canonical FROM aliases ORDER BY alias").fetchall()
+    yield {"type": "export", "version": EXPORT_VERSION, "created": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())}
+    for alias, canonical in aliases:
+        yield {"type": "alias", "alias": alias, "canonical": canonical}
+
+    after_id = None
+    while True:
+        rows = fetch_rules_page(list(RULE_FIELDS), after_id, RULES_STREAM_CHUNK)
+        for r in rows:
+            yield {"type": "rule", **dict(zip(RULE_FIELDS, r))}
+        if len(rows) < RULES_STREAM_CHUNK:
+            break
+        after_id = rows[-1][0]
+
+    if HISTORY_FORMAT != "sqlite":
+        for entry in iter_history_files():
+            yield {"type": "history", **entry}
+        return
+    prepare_history_db()
+    last = 0
+    while True:
+        with db_conn(str(history_db_path())) as conn:
+            rows = conn.execute(
+                "SELECT id, drug_a, drug_b, found, severity, ts FROM history WHERE id > ? ORDER BY id LIMIT ?",
+                (last, RULES_STREAM_CHUNK)
+            ).fetchall()
+        for r in rows:
+            yield {"type": "history", **history_row(r)}
+        if len(rows) < RULES_STREAM_CHUNK:
+            return
+        last = rows[-1][0]
+
+def stream_export():
+    #wbits=31 makes zlib write the gzip format, the lines are collected until there are EXPORT_CHUNK_BYTES to compress
+    gz = zlib.compressobj(6, zlib.DEFLATED, 31)
+    buf = []
+    size = 0
+    for record in iter_export_lines():
+        line = json.dumps(record, ensure_ascii=False).encode("utf-8") + b"\n"
+        buf.append(line)
+        size += len(line)
+        if size >= EXPORT_CHUNK_BYTES:
+            data = gz.compress(b"".join(buf))
+            buf, size = [], 0
+            if data:
+                yield data
+    yield gz.compress(b"".join(buf)) + gz.flush()
+
+@app.get("/admin/export")
+def export_data():
+    name = time.strftime("export-%Y%m%dT%H%M%SZ.ndjson.gz", time.gmtime())
+    return StreamingResponse(stream_export(), media_type="application/gzip",
+                             headers={"Content-Disposition": f'attachment; filename="{name}"'})
+
+def restore_export(path: str | Path, mode: str = "upsert") -> dict:
+    #loads an export file back: the aliases first (so the rules are stored under their ingredient), then the rules with
+    # the bulk importer and then the history in batches. The file is read once per part instead of being held in
+    # memory. Rules are upserted, so restoring twice is safe, but the history is only loaded into an empty history,
+    # otherwise it would be there twice
+    def records(kind: str):
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    if record.get("type") == kind:
+                        record.pop("type")
+                        yield record
+
+    header = next(records("export"), None)
+    if header is None or header.get("version") != EXPORT_VERSION:
+        raise ValueError(f"{path} is not an export of version {EXPORT_VERSION}")
+
+    aliases = 0
+    for record in records("alias"):
+        set_alias(record["alias"], record["canonical"])
+        aliases += 1
+    report = import_rules(records("rule"), mode=mode)
+
+    history_writer.flush()
+    history = 0
+    if query_history(1)[0]:
+        report["history_skipped"] = True
+    else:
+        batch = []
+        for entry in records("history"):
+            batch.append(history_entry(entry["drug_a"], entry["drug_b"], entry["found"], entry.get("severity"), entry.get("ts")))
+            if len(batch) >= HISTORY_STATS_REBUILD_CHUNK:
+                record_history(batch)
+                history += len(batch)
+                batch = []
+        record_history(batch)
+        history += len(batch)
+    return {**report, "aliases": aliases, "history": history}
+
+#backup_database copies one SQLite file with the online backup API. The source connection holds a read transaction for
+# the whole copy, so with WAL every step reads the same snapshot: writers keep committing (to the WAL) and the copy
+# doesn't restart when they do. The copy goes to a temporary name and is renamed when it is complete
+
+def backup_database(src_path: str | Path, dest: Path) -> int:
+    tmp = dest.with_name(dest.name + ".tmp")
+    tmp.unlink(missing_ok=True)
+    src = sqlite3.connect(str(src_path), isolation_level=None, timeout=DB_BUSY_TIMEOUT)
+    dst = sqlite3.connect(str(tmp))
+    pages = 0
+    try:
+        src.execute("BEGIN")
+        src.execute("SELECT count(*) FROM sqlite_master").fetchone()
+
+        def step(status, remaining, total):
+            nonlocal pages
+            pages = total
+            if remaining and BACKUP_STEP_PAUSE > 0:
+                time.sleep(BACKUP_STEP_PAUSE)
+
+        src.backup(dst, pages=BACKUP_PAGES, progress=step)
+        src.execute("COMMIT")
+    finally:
+        dst.close()
+        src.close()
+    os.replace(tmp, dest)
+    return pages
+
+def backup_databases(target: str | Path | None = None) -> dict:
+    #backs up app.db and the history (the database, or the log files for the other history formats) into one folder
+    folder = Path(target) if target else Path(BACKUP_DIR or HISTORY_PATH.parent / "backups") / time.strftime("%Y%m%dT%H%M%SZ", time.gmtime())
+    folder.mkdir(parents=True, exist_ok=True)
+    ensure_rules_schema()
+    backup_database(DB_PATH, folder / Path(DB_PATH).name)
+
+    history_writer.flush()
+    if HISTORY_FORMAT == "sqlite":
+        prepare_history_db()
+        path = history_db_path()
+        backup_database(path, folder / path.name)
+    else:
+        #the log files are only appended to under _history_lock, so holding it gives a consistent copy
+        with _history_lock:
+            paths = [HISTORY_PATH] if HISTORY_FORMAT == "json" else history_segments() + [history_log_path()]
+            for path in paths:
+                if path.exists():
+                    shutil.copyfile(path, folder / path.name)
+    #the size of every file in the backup, in bytes
+    return {"path": str(folder), "files": {p.name: p.stat().st_size for p in sorted(folder.iterdir()) if not p.name.endswith(".tmp")}}
+
+#app.post /admin/backup takes a consistent copy of the databases while the server keeps answering, see backup_databases.
+# Every call writes a full copy to disk, so it needs BACKUP_TOKEN and only one backup runs at a time
+
+_backup_lock = threading.Lock()
+
+@app.post("/admin/backup")
+def backup(request: Request):
+    if not BACKUP_TOKEN:
+        raise HTTPException(404, "Backups over HTTP are off, set BACKUP_TOKEN or run backup.py")
+    sent = request.headers.get("x-backup-token")
+    if sent is None or not hmac.compare_digest(sent.encode(), BACKUP_TOKEN.encode()):
+        raise HTTPException(403, "X-Backup-Token is missing or wrong")
+    if not _backup_lock.acquire(blocking=False):
+        raise HTTPException(409, "A backup is already running")
+    try:
+        return {"ok": True, **backup_databases()}
+    finally:
+        _backup_lock.release()
+
 @app.get("/health")
 def health():
     try:
-        with sqlite3.connect(DB_PATH) as conn:
+        with db_conn() as conn:
             conn.execute("SELECT 1")
         db_status = "ok"
     except Exception as e:
@@ -230,4 +3266,182 @@ def health():
         "status" : "ok",
         "db": db_status,
         "version": "1.0.0"
-    }
\ No newline at end of file
+    }
+
+#Request profiling. A profiled request runs with cProfile for as long as it takes, and the time spent in sqlite3, in the
+# history queue and in pydantic validation and serialization shows up next to our own functions. Since Python 3.12
+# cProfile is one profiler for the whole process (sys.monitoring), so it also sees the worker thread FastAPI runs the
+# sync endpoints on, and a second profiler can't be started next to it. Before 3.12 it only sees the thread that
+# started it, so there (PROFILE_PER_THREAD) the sync endpoints are wrapped to profile the worker thread too, and both
+# profiles are merged into one .prof file. Work of other requests that runs at the same time is in the profile as
+# well. Only one request per process is profiled at a time. When profiling is off nothing is installed at all
+
+PROFILE_PER_THREAD = sys.version_info < (3, 12)
+_request_profile: contextvars.ContextVar = contextvars.ContextVar("request_profile", default=None)
+_profile_busy = threading.Lock()
+_profile_counter = itertools.count(1)
+PROFILE_NAME = re.compile(r"^(\d{16})_([A-Z]+)_([A-Za-z0-9-]+)_(\d{3})_(\d+\.\d)ms\.prof$")
+
+class RequestProfile:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.profilers: list[cProfile.Profile] = []
+
+    def start(self) -> cProfile.Profile:
+        #raises ValueError when another profiling tool (a debugger, coverage, ...) already holds the profiler
+        profiler = cProfile.Profile()
+        profiler.enable()
+        return profiler
+
+    def stop(self, profiler: cProfile.Profile):
+        profiler.disable()
+        with self._lock:
+            self.profilers.append(profiler)
+
+    @contextmanager
+    def running(self):
+        profiler = self.start()
+        try:
+            yield
+        finally:
+            self.stop(profiler)
+
+    def dump(self, path: Path):
+        pstats.Stats(*self.profilers).dump_stats(path)
+
+#ProfileStore is the ring buffer on disk: every profile is one file whose name holds the time, the method, the path,
+# the status and the duration, so listing them doesn't open any. After a write the oldest files beyond PROFILE_KEEP are deleted
+
+class ProfileStore:
+    def __init__(self):
+        self._lock = threading.Lock()
+
+    def directory(self) -> Path:
+        return Path(PROFILE_DIR) if PROFILE_DIR else HISTORY_PATH.parent / "profiles"
+
+    def files(self) -> list[Path]:
+        folder = self.directory()
+        if not folder.exists():
+            return []
+        return sorted(p for p in folder.iterdir() if PROFILE_NAME.match(p.name))
+
+    def save(self, profile: RequestProfile, method: str, path: str, status: int, seconds: float) -> str:
+        folder = self.directory()
+        folder.mkdir(parents=True, exist_ok=True)
+        slug = re.sub(r"[^A-Za-z0-9]+", "-", path).strip("-") or "root"
+        name = f"{time.time_ns() // 1000:016d}_{method}_{slug[:80]}_{status:03d}_{seconds * 1000:.1f}ms.prof"
+        tmp = folder / (name + ".tmp")
+        profile.dump(tmp)
+        os.replace(tmp, folder / name)
+        with self._lock:
+            for old in self.files()[:-PROFILE_KEEP] if PROFILE_KEEP > 0 else []:
+                old.unlink(missing_ok=True)
+        return name
+
+    def entries(self) -> list[dict]:
+        found = []
+        for path in reversed(self.files()):
+            m = PROFILE_NAME.match(path.name)
+            try:
+                size = path.stat().st_size
+            except FileNotFoundError:
+                continue
+            found.append({
+                "id": path.name,
+                "ts": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(int(m[1]) / 1e6)),
+                "method": m[2],
+                "path": m[3],
+                "status": int(m[4]),
+                "ms": float(m[5]),
+                "bytes": size,
+            })
+        return found
+
+    def get(self, profile_id: str) -> Path:
+        path = self.directory() / profile_id
+        if not PROFILE_NAME.match(profile_id) or not path.exists():
+            raise HTTPException(404, "Profile not found")
+        return path
+
+
+profile_store = ProfileStore()
+
+def profile_wanted(request: Request) -> bool:
+    if PROFILE_TOKEN:
+        sent = request.headers.get("x-profile")
+        if sent is not None and hmac.compare_digest(sent.encode(), PROFILE_TOKEN.encode()):
+            return True
+    return PROFILE_SAMPLE_EVERY > 0 and next(_profile_counter) % PROFILE_SAMPLE_EVERY == 0
+
+async def profile_requests(request: Request, call_next):
+    if request.url.path.startswith("/admin/profiles") or not profile_wanted(request):
+        return await call_next(request)
+    if not _profile_busy.acquire(blocking=False):
+        return await call_next(request)
+    profile = RequestProfile()
+    try:
+        profiler = profile.start()
+    except ValueError:
+        _profile_busy.release()
+        return await call_next(request)
+    try:
+        token = _request_profile.set(profile)
+        start = time.perf_counter()
+        try:
+            response = await call_next(request)
+        finally:
+            profile.stop(profiler)
+            _request_profile.reset(token)
+        elapsed = time.perf_counter() - start
+        name = await run_in_threadpool(profile_store.save, profile, request.method, request.url.path,
+                                       response.status_code, elapsed)
+    finally:
+        _profile_busy.release()
+    response.headers["X-Profile-Id"] = name
+    return response
+
+def profiled_endpoint(call):
+    @functools.wraps(call)
+    def run(*args, **kwargs):
+        profile = _request_profile.get()
+        if profile is None:
+            return call(*args, **kwargs)
+        with profile.running():
+            return call(*args, **kwargs)
+    return run
+
+def install_profiling():
+    #FastAPI decides whether an endpoint is sync when the route is built, and calls dependant.call on the worker
+    # thread, so wrapping it here keeps the endpoint running where it did
+    app.middleware("http")(profile_requests)
+    if not PROFILE_PER_THREAD:
+        return
+    for route in app.routes:
+        dependant = getattr(route, "dependant", None)
+        if dependant is not None and dependant.call is not None and not asyncio.iscoroutinefunction(dependant.call):
+            dependant.call = profiled_endpoint(dependant.call)
+
+#get /admin/profiles lists the stored profiles, newest first. get /admin/profiles/{id} downloads one (open it with
+# python -m pstats, snakeviz, ...), ?format=text returns the `limit` most expensive functions by cumulative time instead
+
+@app.get("/admin/profiles")
+def list_profiles():
+    return {
+        "enabled": bool(PROFILE_TOKEN or PROFILE_SAMPLE_EVERY > 0),
+        "keep": PROFILE_KEEP,
+        "profiles": profile_store.entries(),
+    }
+
+@app.get("/admin/profiles/{profile_id}")
+def get_profile(profile_id: str, format: str = "prof", limit: int = 40):
+    path = profile_store.get(profile_id)
+    if format == "prof":
+        return FileResponse(path, media_type="application/octet-stream", filename=profile_id)
+    if format != "text":
+        raise HTTPException(400, "format must be prof or text")
+    out = io.StringIO()
+    pstats.Stats(str(path), stream=out).sort_stats("cumulative").print_stats(max(1, limit))
+    return PlainTextResponse(out.getvalue())
+
+if PROFILE_TOKEN or PROFILE_SAMPLE_EVERY > 0:
+    install_profiling()
@@ -0,0 +1,10 @@
+from main import close_db_pool, history_writer, rebuild_history_stats
+
+#Recomputes the rollup tables behind GET /history/stats from the stored history (data/history.db, or the ndjson/json
+# files when HISTORY_FORMAT says so). The server does the same on POST /admin/rebuild-history-stats
+
+checks = rebuild_history_stats()
+history_writer.stop()
+close_db_pool()
+
+print(f"History stats rebuilt from {checks} checks")
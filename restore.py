@@ -0,0 +1,23 @@
+import sys
+
+from main import close_db_pool, history_writer, restore_export
+
+#Loads an export from GET /admin/export back into app.db and the history:
+#
+#   python restore.py export-20250101T000000Z.ndjson.gz
+#
+# Rules that already exist are updated, so it can be run again. The history is only loaded when the history is empty
+
+if len(sys.argv) != 2:
+    sys.exit("usage: python restore.py <export.ndjson.gz>")
+
+report = restore_export(sys.argv[1])
+history_writer.stop()
+close_db_pool()
+
+print(f"Restored {report['aliases']} aliases, {report['inserted']} rules added, {report['updated']} updated, "
+      f"{len(report['errors'])} rejected")
+if report.get("history_skipped"):
+    print("The history is not empty, the exported history was not loaded")
+else:
+    print(f"Restored {report['history']} history entries")
@@ -1,41 +1,34 @@
-import sqlite3
-
-DB_PATH = "app.db"
-
-conn = sqlite3.connect(DB_PATH)
-cur = conn.cursor()
-
-#We first create a table if it does not exist already, its schema consists of an id, medications a and b which are strings
-# and the severity and description of the interaction between the two medications which are also strings
-
-cur.execute("""
-CREATE TABLE IF NOT EXISTS rules (
-    id TEXT PRIMARY KEY,
-    a  TEXT NOT NULL,
-    b  TEXT NOT NULL,
-    severity TEXT NOT NULL,
-    description TEXT NOT NULL
-);
-""")
-
-#In the following code we create a unique index on the pair of medications in a way that is independent of their order
-
-cur.execute("""
-CREATE UNIQUE INDEX IF NOT EXISTS ux_rules_pair
-ON rules(
-    CASE WHEN a < b THEN a ELSE b END,
-    CASE WHEN a < b THEN b ELSE a END
-);
-""")
-
-#We need to ensure that the pairs of medications will be trimmed and all in lowercase, and in alphabetical order
-# so we don't have duplicates like ibuprofen_aspirin and aspirin_ibuprofen
-
-
-def canon(a: str, b: str):
-    a = a.strip().lower()
-    b = b.strip().lower()
-    return (a, b) if a <= b else (b, a)
+from main import close_db_pool, ensure_rules_schema, import_rules, set_alias
+
+#We first create the rules table if it does not exist already, its schema consists of an id, medications a and b which are strings
+# and the severity and description of the interaction between the two medications which are also strings.
+# The schema (RULES_SCHEMA in main.py) also has a unique index on the pair of medications in a way that is independent of their order
+# It also creates rules_fts, the full-text index used by GET /rules/search, and the triggers that fill it as the rules below are written
+
+ensure_rules_schema()
+
+#Brand names are aliases of their active ingredient, so checking tylenol finds the rules stored under acetaminophen.
+# They are added before the rules so the rules below are stored under the ingredient names (rules already in app.db are renamed)
+
+seed_aliases = {
+    "tylenol": "acetaminophen",
+    "zoloft": "sertraline",
+    "lexapro": "escitalopram",
+    "voltaren": "diclofenac",
+    "xanax": "alprazolam",
+    "benadryl": "diphenhydramine",
+    "advil": "ibuprofen",
+    "motrin": "ibuprofen",
+    "alcohol": "ethanol",
+    "vitamind3": "cholecalciferol",
+}
+
+for alias, canonical in seed_aliases.items():
+    set_alias(alias, canonical)
+
+#The rules are loaded with the same bulk importer as POST /rules/bulk. It trims and lowercases the medications and puts them
+# in alphabetical order so we don't have duplicates like ibuprofen_aspirin and aspirin_ibuprofen, and in "upsert" mode
+# running this file again updates the existing rules instead of failing
 
 seed_rules = [
     ("ibuprofen_aspirin", "ibuprofen", "aspirin", "major",
@@ -57,14 +50,10 @@ seed_rules = [
     ("lorazepam_zoloft", "lorazepam", "zoloft", "moderate", "Using LORazepam together with sertraline may increase side effects such as dizziness, drowsiness, confusion, and difficulty concentrating. Some people, especially the elderly, may also experience impairment in thinking, judgment, and motor coordination. You should avoid or limit the use of alcohol while being treated with these medications. Also avoid activities requiring mental alertness such as driving or operating hazardous machinery until you know how the medications affect you. Talk to your doctor if you have any questions or concerns. It is important to tell your doctor about all other medications you use, including vitamins and herbs. Do not stop using any medications without first talking to your doctor.")
 ]
 
-rows = []
-for id_, A, B, sev, desc in seed_rules:
-    a, b = canon(A, B)
-    rows.append((id_, a, b, sev, desc))
-
-cur.executemany("INSERT OR REPLACE INTO rules (id,a,b,severity,description) VALUES (?,?,?,?,?)", rows)
-
-conn.commit()
-conn.close()
+report = import_rules(
+    ({"id": id_, "a": A, "b": B, "severity": sev, "description": desc} for id_, A, B, sev, desc in seed_rules),
+    mode="upsert",
+)
+close_db_pool()
 
-print(f"app.db is ready.")
+print(f"app.db is ready: {report['inserted']} rules added, {report['updated']} updated.")
@@ -0,0 +1,25 @@
+import importlib.util
+import pathlib
+import sys
+
+import pytest
+
+
+def load_main():
+    #loads main.py as a fresh 'main' module, so pools, indexes and caches don't carry over from another test
+    root = pathlib.Path(__file__).resolve().parents[1]
+    spec = importlib.util.spec_from_file_location("main", root / "main.py")
+    main = importlib.util.module_from_spec(spec)
+    sys.modules["main"] = main
+    spec.loader.exec_module(main)
+    return main
+
+
+@pytest.fixture
+def main_app(tmp_path):
+    #main.py with its database and history log in tmp_path, and the rules schema created the same way seed.py does
+    main = load_main()
+    main.DB_PATH = str(tmp_path / "rules.db")
+    main.HISTORY_PATH = tmp_path / "history.json"
+    main.ensure_rules_schema()
+    return main
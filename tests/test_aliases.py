@@ -0,0 +1,64 @@
+from fastapi.testclient import TestClient
+from conftest import load_main
+
+
+def get_client(main):
+    main.import_rules([
+        {"id": "ethanol_acetaminophen", "a": "ethanol", "b": "acetaminophen", "severity": "major", "description": "liver"},
+        {"id": "tylenol_warfarin", "a": "tylenol", "b": "warfarin", "severity": "moderate", "description": "bleeding"},
+    ])
+    main.reload_rule_index()
+    return TestClient(main.app), main
+
+
+def test_alias_resolves_brand_names(main_app):
+    client, main = get_client(main_app)
+    assert client.post("/check", json={"drug_a": "Tylenol", "drug_b": "ethanol"}).json()["found"] is False
+
+    resp = client.put("/aliases/Tylenol", params={"canonical": "Acetaminophen"})
+    assert resp.json()["renamed_rules"] == ["tylenol_warfarin"]
+
+    assert client.post("/check", json={"drug_a": "Tylenol", "drug_b": "ethanol"}).json()["severity"] == "major"
+    assert client.post("/check", json={"drug_a": "acetaminophen", "drug_b": "warfarin"}).json()["found"] is True
+    assert client.get("/rules/tylenol_warfarin").json()["a"] == "acetaminophen"
+    assert client.get("/aliases").json() == [{"alias": "tylenol", "canonical": "acetaminophen"}]
+
+
+def test_regimen_and_rule_creation_use_canonical_names(main_app):
+    client, _ = get_client(main_app)
+    client.put("/aliases/tylenol", params={"canonical": "acetaminophen"})
+    client.put("/aliases/paracetamol", params={"canonical": "tylenol"})
+
+    data = client.post("/check/regimen", json={"drugs": ["Tylenol", "paracetamol", "acetaminophen", "ethanol"]}).json()
+    assert data["drugs"] == ["acetaminophen", "ethanol"]
+    assert len(data["interactions"]) == 1
+
+    assert client.post("/rules", json={"a": "paracetamol", "b": "ethanol", "severity": "minor", "description": "dup"}).status_code == 409
+
+
+def test_alias_that_would_duplicate_a_rule_is_refused(main_app):
+    client, main = get_client(main_app)
+    main.import_rules([{"a": "paracetamol", "b": "warfarin", "severity": "minor", "description": "x"}])
+
+    resp = client.put("/aliases/paracetamol", params={"canonical": "tylenol"})
+    assert resp.status_code == 409
+    assert "paracetamol" not in main.alias_index.forward
+
+    assert client.delete("/aliases/paracetamol").status_code == 404
+
+
+def test_alias_set_by_another_worker_is_picked_up(main_app):
+    writer_client, writer = get_client(main_app)
+    reader = load_main()
+    reader.DB_PATH = writer.DB_PATH
+    reader.HISTORY_PATH = writer.HISTORY_PATH
+    reader.RULE_INDEX_ENABLED = False
+    reader.RULES_SYNC_INTERVAL = 0
+    reader_client = TestClient(reader.app)
+    check = {"drug_a": "tylenol", "drug_b": "warfarin"}
+    assert reader_client.post("/check", json=check).json()["found"] is True
+
+    writer_client.put("/aliases/tylenol", params={"canonical": "acetaminophen"})
+
+    assert reader_client.post("/check", json=check).json()["found"] is True
+    assert reader.canonical_name("Tylenol") == "acetaminophen"
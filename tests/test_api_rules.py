@@ -1,17 +1,5 @@
-import importlib.util
-import pathlib
-import sys
 from fastapi.testclient import TestClient
-
-def load_main():
-    root = pathlib.Path(__file__).resolve().parents[1]
-    main_path = root / "main.py"
-
-    spec = importlib.util.spec_from_file_location("main", main_path)
-    main = importlib.util.module_from_spec(spec)
-    sys.modules["main"] = main
-    spec.loader.exec_module(main)
-    return main
+from conftest import load_main
 
 
 def get_client_and_main():
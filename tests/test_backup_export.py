@@ -0,0 +1,113 @@
+import gzip
+import json
+import pathlib
+import sqlite3
+import threading
+from fastapi.testclient import TestClient
+from conftest import load_main
+
+
+def get_client(main, tmp_path):
+    main.BACKUP_DIR = str(tmp_path / "backups")
+    with main.db_conn() as conn:
+        conn.executemany("INSERT INTO rules VALUES (?,?,?,?,?)", [
+            (f"drug{i:03d}_other", f"drug{i:03d}", "other", "minor", f"Description {i} ✓") for i in range(120)
+        ])
+    main.set_alias("tylenol", "acetaminophen")
+    return TestClient(main.app), main
+
+
+def test_export_streams_rules_aliases_and_history(tmp_path, main_app):
+    client, main = get_client(main_app, tmp_path)
+    main.RULES_STREAM_CHUNK = 50
+    for i in range(130):
+        client.post("/check", json={"drug_a": f"drug{i % 7:03d}", "drug_b": "other"})
+
+    resp = client.get("/admin/export")
+    assert resp.status_code == 200
+    assert resp.headers["content-disposition"].startswith('attachment; filename="export-')
+    lines = [json.loads(line) for line in gzip.decompress(resp.content).splitlines()]
+
+    assert lines[0]["type"] == "export" and lines[0]["version"] == main.EXPORT_VERSION
+    kinds = [line["type"] for line in lines[1:]]
+    assert kinds == ["alias"] + ["rule"] * 120 + ["history"] * 130
+    assert lines[1] == {"type": "alias", "alias": "tylenol", "canonical": "acetaminophen"}
+    assert lines[2]["description"] == "Description 0 ✓"
+    assert lines[-1]["drug_a"] == "drug003" and lines[-1]["found"] is True
+
+
+def test_restore_loads_an_export_into_an_empty_install(tmp_path, main_app):
+    client, main = get_client(main_app, tmp_path)
+    client.post("/check", json={"drug_a": "drug001", "drug_b": "other"})
+    client.post("/check", json={"drug_a": "tylenol", "drug_b": "other"})
+    export = tmp_path / "export.ndjson.gz"
+    export.write_bytes(client.get("/admin/export").content)
+
+    fresh = load_main()
+    (tmp_path / "b").mkdir()
+    fresh.DB_PATH = str(tmp_path / "b" / "rules.db")
+    fresh.HISTORY_PATH = tmp_path / "b" / "history.json"
+    report = fresh.restore_export(export)
+    assert (report["aliases"], report["inserted"], report["history"]) == (1, 120, 2)
+
+    client = TestClient(fresh.app)
+    assert len(client.get("/rules").json()) == 120
+    assert [h["drug_a"] for h in client.get("/history").json()] == ["drug001", "acetaminophen"]
+    assert client.post("/check", json={"drug_a": "other", "drug_b": "drug005"}).json()["found"] is True
+
+    again = fresh.restore_export(export)
+    assert again["updated"] == 120 and again["history_skipped"]
+    assert len(client.get("/history", params={"limit": 0}).json()) == 3
+
+
+def test_backup_is_consistent_while_history_is_written(tmp_path, main_app):
+    client, main = get_client(main_app, tmp_path)
+    main.BACKUP_TOKEN = "secret"
+    main.BACKUP_PAGES = 1
+    main.HISTORY_ASYNC = False
+    for i in range(200):
+        main.append_history(f"drug{i:03d}", "other", True, "minor")
+
+    stop = threading.Event()
+
+    def writer():
+        while not stop.is_set():
+            main.append_history("x", "y", False, None)
+
+    t = threading.Thread(target=writer)
+    t.start()
+    try:
+        result = client.post("/admin/backup", headers={"X-Backup-Token": "secret"}).json()
+    finally:
+        stop.set()
+        t.join()
+
+    folder = pathlib.Path(result["path"])
+    assert folder.parent == tmp_path / "backups"
+    assert set(result["files"]) == {"rules.db", "history.db"}
+    with sqlite3.connect(folder / "rules.db") as conn:
+        assert conn.execute("PRAGMA integrity_check").fetchone() == ("ok",)
+        assert conn.execute("SELECT count(*) FROM rules").fetchone() == (120,)
+    with sqlite3.connect(folder / "history.db") as conn:
+        assert conn.execute("PRAGMA integrity_check").fetchone() == ("ok",)
+        assert conn.execute("SELECT count(*) FROM history WHERE drug_b='other'").fetchone() == (200,)
+        #the rollups were copied from the same moment as the history
+        checks = conn.execute("SELECT sum(checks) FROM history_hourly").fetchone()[0]
+        assert checks == conn.execute("SELECT count(*) FROM history").fetchone()[0]
+
+
+def test_backup_endpoint_needs_the_token(tmp_path, main_app):
+    client, main = get_client(main_app, tmp_path)
+    assert client.post("/admin/backup").status_code == 404
+
+    main.BACKUP_TOKEN = "secret"
+    assert client.post("/admin/backup").status_code == 403
+    assert client.post("/admin/backup", headers={"X-Backup-Token": "guess"}).status_code == 403
+    assert not (tmp_path / "backups").exists()
+
+    main._backup_lock.acquire()
+    try:
+        assert client.post("/admin/backup", headers={"X-Backup-Token": "secret"}).status_code == 409
+    finally:
+        main._backup_lock.release()
+    assert client.post("/admin/backup", headers={"X-Backup-Token": "secret"}).status_code == 200
@@ -0,0 +1,44 @@
+import importlib.util
+import json
+import pathlib
+import sys
+
+
+def load_module(name):
+    root = pathlib.Path(__file__).resolve().parents[1]
+    spec = importlib.util.spec_from_file_location(name, root / f"{name}.py")
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def test_benchmark_reports_every_endpoint(tmp_path):
+    load_module("main")
+    bench = load_module("bench")
+    traffic = tmp_path / "traffic.ndjson"
+    traffic.write_text(
+        json.dumps({"drug_a": "aspirin", "drug_b": "ibuprofen", "found": True}) + "\nnot json\n"
+        + json.dumps({"drug_a": "aerius", "drug_b": "ibuprofen", "found": False}) + "\n",
+        encoding="utf-8"
+    )
+
+    report = bench.run_benchmark(rules=16, requests=150, concurrency=4, traffic=[str(traffic)], warmup=10,
+                                 workdir=str(tmp_path))
+
+    assert report["config"]["rules"] == 17
+    results = report["results"]
+    assert results["total"]["requests"] >= 150
+    assert results["total"]["errors"] == 0
+    assert {"POST /check", "GET /rules", "GET /history"} <= set(results["endpoints"])
+    check = results["endpoints"]["POST /check"]
+    assert check["p50_ms"] <= check["p95_ms"] <= check["p99_ms"] <= check["max_ms"]
+    json.dumps(report)
+
+
+def test_percentile_uses_nearest_rank():
+    bench = load_module("bench")
+    values = [float(v) for v in range(1, 101)]
+    assert bench.percentile(values, 50) == 50.0
+    assert bench.percentile(values, 99) == 99.0
+    assert bench.percentile([], 95) == 0.0
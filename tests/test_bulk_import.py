@@ -0,0 +1,83 @@
+import json
+from fastapi.testclient import TestClient
+
+
+def get_client(main):
+    main.import_rules([{"id": "aspirin_ibuprofen", "a": "Ibuprofen", "b": "aspirin", "severity": "major", "description": "old"}])
+    return TestClient(main.app), main
+
+
+def test_csv_insert_reports_bad_rows(main_app):
+    client, main = get_client(main_app)
+    body = (
+        "a,b,severity,description\r\n"
+        "Warfarin,Voltaren,major,\"Bleeding, GI tract\"\r\n"
+        "x,y,terrible,nope\r\n"
+        "aspirin,ibuprofen,minor,already there\r\n"
+        "lorazepam,benadryl,moderate,\"Drowsiness.\nAvoid driving.\"\r\n"
+        "voltaren,warfarin,minor,duplicate in upload\r\n"
+    )
+
+    resp = client.post("/rules/bulk", content=body.encode(), headers={"Content-Type": "text/csv"})
+    assert resp.status_code == 200
+    report = resp.json()
+
+    assert report["inserted"] == 2
+    assert [e["line"] for e in report["errors"]] == [3, 4, 7]
+    rule = client.get("/rules/benadryl_lorazepam").json()
+    assert rule["description"] == "Drowsiness.\nAvoid driving."
+    assert client.post("/check", json={"drug_a": "voltaren", "drug_b": "warfarin"}).json()["found"] is True
+
+
+def test_ndjson_upsert_and_skip_existing(main_app):
+    client, main = get_client(main_app)
+    lines = [
+        {"a": "aspirin", "b": "ibuprofen", "severity": "minor", "description": "new"},
+        {"id": "custom", "a": "a", "b": "b", "severity": "moderate", "description": "d"},
+    ]
+    body = "\n".join(json.dumps(l) for l in lines) + "\nnot json\n"
+
+    skipped = client.post("/rules/bulk", params={"mode": "skip-existing"}, content=body).json()
+    assert (skipped["inserted"], skipped["skipped"], skipped["error_count"]) == (1, 1, 1)
+    assert client.get("/rules/aspirin_ibuprofen").json()["description"] == "old"
+
+    upserted = client.post("/rules/bulk", params={"mode": "upsert"}, content=body).json()
+    assert (upserted["inserted"], upserted["updated"]) == (0, 2)
+    data = client.post("/check", json={"drug_a": "aspirin", "drug_b": "ibuprofen"}).json()
+    assert (data["severity"], data["description"]) == ("minor", "new")
+
+
+def test_rejects_unknown_mode(main_app):
+    client, _ = get_client(main_app)
+    assert client.post("/rules/bulk", params={"mode": "replace"}, content=b"").status_code == 400
+
+
+def test_stalled_upload_does_not_block_rule_writes(main_app):
+    import asyncio
+    import httpx
+
+    _, main = get_client(main_app)
+
+    async def run():
+        release = asyncio.Event()
+
+        async def upload():
+            yield b'{"a": "warfarin", "b": "voltaren", "severity": "major", "description": "bleeding"}\n'
+            await release.wait()
+            yield b'{"a": "lorazepam", "b": "benadryl", "severity": "moderate", "description": "drowsiness"}\n'
+
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            bulk = asyncio.create_task(client.post("/rules/bulk", content=upload()))
+            await asyncio.sleep(0.1)
+            created = await asyncio.wait_for(client.post("/rules", json={
+                "a": "metformin", "b": "alcohol", "severity": "moderate", "description": "lactic acidosis"
+            }), timeout=5)
+            release.set()
+            return created, await bulk
+
+    created, bulk = asyncio.run(run())
+    assert created.status_code == 200
+    assert bulk.json()["inserted"] == 2
+    client = TestClient(main.app)
+    assert client.post("/check", json={"drug_a": "benadryl", "drug_b": "lorazepam"}).json()["found"] is True
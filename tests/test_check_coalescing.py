@@ -0,0 +1,114 @@
+import threading
+import time
+from fastapi.testclient import TestClient
+from conftest import load_main
+
+
+def get_client(main):
+    with main.db_conn() as conn:
+        conn.execute("INSERT INTO rules VALUES ('aspirin_ibuprofen', 'aspirin', 'ibuprofen', 'major', 'Bleeding risk')")
+    main.reload_rule_index()
+    return TestClient(main.app), main
+
+
+def block_first_lookup(main, monkeypatch):
+    #the first lookup waits until `release` is set, so other requests can pile up behind it
+    real = main.find_rule
+    entered, release = threading.Event(), threading.Event()
+    calls = []
+
+    def slow(a, b):
+        calls.append((a, b))
+        if len(calls) == 1:
+            result = real(a, b)
+            entered.set()
+            release.wait(5)
+            return result
+        return real(a, b)
+
+    monkeypatch.setattr(main, "find_rule", slow)
+    return entered, release, calls
+
+
+def wait_for(condition):
+    deadline = time.time() + 5
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    assert condition()
+
+
+def run_check(main, results, a="aspirin", b="ibuprofen"):
+    results.append(main.check_interaction(main.CheckReq(drug_a=a, drug_b=b)).body)
+
+
+def test_concurrent_checks_share_one_lookup(main_app, monkeypatch):
+    client, main = get_client(main_app)
+    entered, release, calls = block_first_lookup(main, monkeypatch)
+    coalesced = main.REGISTRY.get_sample_value("check_coalesced_requests_total") or 0.0
+    results = []
+
+    threads = [threading.Thread(target=run_check, args=(main, results, "Aspirin", " ibuprofen"))]
+    threads[0].start()
+    entered.wait(5)
+    threads += [threading.Thread(target=run_check, args=(main, results, "ibuprofen", "aspirin")) for _ in range(4)]
+    for t in threads[1:]:
+        t.start()
+    key = ("aspirin", "ibuprofen", main.rule_versions.epoch, main.rule_versions.version)
+    wait_for(lambda: main.check_flights._calls[key].waiters == 4)
+    release.set()
+    for t in threads:
+        t.join()
+
+    assert len(calls) == 1
+    assert len(set(results)) == 1 and len(results) == 5
+    assert main.REGISTRY.get_sample_value("check_coalesced_requests_total") == coalesced + 4
+    assert len(client.get("/history", params={"limit": 0}).json()) == 5
+
+
+def test_check_after_a_mutation_does_not_join_an_older_lookup(main_app, monkeypatch):
+    client, main = get_client(main_app)
+    entered, release, calls = block_first_lookup(main, monkeypatch)
+    before, after = [], []
+
+    slow = threading.Thread(target=run_check, args=(main, before))
+    slow.start()
+    entered.wait(5)
+    client.put("/rules/aspirin_ibuprofen", params={"severity": "minor", "description": "updated"})
+    run_check(main, after)
+    release.set()
+    slow.join()
+
+    assert len(calls) == 2
+    assert b'"severity":"major"' in before[0]
+    assert b'"severity":"minor"' in after[0]
+
+
+def test_errors_reach_every_waiter():
+    main = load_main()
+    flights = main.SingleFlight()
+    started, release = threading.Event(), threading.Event()
+    errors = []
+
+    def failing():
+        started.set()
+        release.wait(5)
+        raise RuntimeError("lookup failed")
+
+    def call():
+        try:
+            flights.do("k", failing)
+        except RuntimeError as e:
+            errors.append(str(e))
+
+    threads = [threading.Thread(target=call)]
+    threads[0].start()
+    started.wait(5)
+    threads.append(threading.Thread(target=call))
+    threads[1].start()
+    wait_for(lambda: flights._calls["k"].waiters == 1)
+    release.set()
+    for t in threads:
+        t.join()
+
+    assert errors == ["lookup failed", "lookup failed"]
+    assert flights._calls == {}
@@ -0,0 +1,59 @@
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from fastapi.testclient import TestClient
+
+
+def get_client(main):
+    with main.db_conn() as conn:
+        conn.execute("INSERT INTO rules VALUES ('aspirin_ibuprofen', 'aspirin', 'ibuprofen', 'major', 'Bleeding \"risk\" – über\nline')")
+    return TestClient(main.app), main
+
+
+def model_bytes(main, **fields):
+    #what FastAPI sends when the endpoint returns CheckResp(**fields)
+    return JSONResponse(jsonable_encoder(main.CheckResp(**fields))).body
+
+
+def test_hit_and_miss_match_the_model_encoding(main_app):
+    client, main = get_client(main_app)
+
+    hit = client.post("/check", json={"drug_a": "Ibuprofen", "drug_b": "aspirin"})
+    assert hit.headers["content-type"] == "application/json"
+    assert hit.content == model_bytes(main, found=True, severity="major", description='Bleeding "risk" – über\nline')
+
+    miss = client.post("/check", json={"drug_a": "asprin", "drug_b": 'wät"er'})
+    assert miss.content == model_bytes(
+        main,
+        found=False,
+        message="No known interaction in local DB.",
+        suggest_add=True,
+        how_to_add={
+            "endpoint": "POST /rules",
+            "body_example": {"a": "asprin", "b": 'wät"er', "severity": "moderate",
+                             "description": "Describe the interaction here..."},
+            "note": "Pairs are order-independent; inputs are stored alphabetically."
+        },
+        did_you_mean={"asprin": ["aspirin"]}
+    )
+
+
+def test_cached_response_follows_updates_and_deletes(main_app):
+    client, main = get_client(main_app)
+    main.reload_rule_index()
+
+    client.put("/rules/aspirin_ibuprofen", params={"severity": "minor", "description": "changed"})
+    assert client.post("/check", json={"drug_a": "aspirin", "drug_b": "ibuprofen"}).json()["description"] == "changed"
+    assert main.rule_index.response(("aspirin", "ibuprofen"))[0] == "minor"
+
+    client.delete("/rules/aspirin_ibuprofen")
+    assert main.rule_index.response(("aspirin", "ibuprofen")) is None
+    assert client.post("/check", json={"drug_a": "aspirin", "drug_b": "ibuprofen"}).json()["found"] is False
+
+
+def test_sql_path_sends_the_same_bytes(main_app):
+    client, main = get_client(main_app)
+    body = {"drug_a": "aspirin", "drug_b": "ibuprofen"}
+
+    with_index = client.post("/check", json=body).content
+    main.RULE_INDEX_ENABLED = False
+    assert client.post("/check", json=body).content == with_index
@@ -0,0 +1,48 @@
+import pytest
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+
+
+def test_connections_are_reused_and_tuned(main_app):
+    main = main_app
+
+    with main.db_conn() as first:
+        assert first.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+        assert first.execute("PRAGMA synchronous").fetchone()[0] == 1
+    with main.db_conn() as second:
+        pass
+
+    assert first is second
+
+
+def test_pool_is_bounded(main_app, tmp_path):
+    main = main_app
+    #the schema is already created through the default pool, so the bounded one is opened on its own file
+    main.DB_PATH = str(tmp_path / "bounded.db")
+    main.DB_POOL_SIZE = 1
+    main.DB_POOL_TIMEOUT = 0.05
+
+    with main.db_conn():
+        with pytest.raises(HTTPException) as exc:
+            with main.db_conn():
+                pass
+    assert exc.value.status_code == 503
+
+
+def test_readers_are_not_blocked_by_an_open_write(main_app):
+    main = main_app
+
+    with main.db_conn() as writer:
+        writer.execute("INSERT INTO rules VALUES ('a_b', 'a', 'b', 'minor', 'x')")
+        with main.db_conn() as reader:
+            assert reader.execute("SELECT COUNT(*) FROM rules").fetchone()[0] == 0
+    with main.db_conn() as reader:
+        assert reader.execute("SELECT COUNT(*) FROM rules").fetchone()[0] == 1
+
+
+def test_checkout_wait_is_exported(main_app):
+    main = main_app
+    client = TestClient(main.app)
+
+    client.get("/health")
+    assert "db_pool_checkout_seconds_count" in client.get("/metrics").text
@@ -0,0 +1,60 @@
+from fastapi.testclient import TestClient
+
+
+def get_client(main):
+    with main.db_conn() as conn:
+        conn.executemany("INSERT INTO rules VALUES (?,?,?,?,?)", [
+            ("aspirin_warfarin", "aspirin", "warfarin", "major", "Bleeding"),
+            ("acetaminophen_warfarin", "acetaminophen", "warfarin", "moderate", "INR"),
+            ("warfarin_zafirlukast", "warfarin", "zafirlukast", "moderate", "CYP2C9"),
+            ("miconazole_warfarin", "miconazole", "warfarin", "contraindicated", "Large INR rise"),
+            ("aspirin_ibuprofen", "aspirin", "ibuprofen", "major", "Less cardioprotection"),
+        ])
+    return TestClient(main.app), main
+
+
+def interactions(client, name, **params):
+    resp = client.get(f"/drugs/{name}/interactions", params=params)
+    assert resp.status_code == 200
+    return resp.json()
+
+
+def test_lists_the_rules_of_one_drug_on_both_sides_of_the_pair(main_app):
+    client, _ = get_client(main_app)
+
+    data = interactions(client, " Warfarin")
+    assert data["drug"] == "warfarin" and data["total"] == 4
+    assert [(i["drug"], i["severity"]) for i in data["interactions"]] == [
+        ("miconazole", "contraindicated"), ("aspirin", "major"), ("acetaminophen", "moderate"), ("zafirlukast", "moderate"),
+    ]
+    assert data["interactions"][0] == {"id": "miconazole_warfarin", "drug": "miconazole", "severity": "contraindicated",
+                                       "description": "Large INR rise"}
+    assert interactions(client, "nothing")["interactions"] == []
+
+
+def test_filter_order_and_limit(main_app):
+    client, _ = get_client(main_app)
+
+    data = interactions(client, "warfarin", severity="moderate,major", order="drug", limit=2)
+    assert data["total"] == 3
+    assert [i["drug"] for i in data["interactions"]] == ["acetaminophen", "aspirin"]
+    assert client.get("/drugs/warfarin/interactions", params={"severity": "mild"}).status_code == 400
+    assert client.get("/drugs/warfarin/interactions", params={"order": "id"}).status_code == 400
+
+
+def test_adjacency_follows_rule_writes_and_matches_sql(main_app):
+    client, main = get_client(main_app)
+    interactions(client, "warfarin")
+
+    client.post("/rules", json={"a": "lexapro", "b": "warfarin", "severity": "minor", "description": "x"})
+    client.delete("/rules/aspirin_warfarin")
+    main.set_alias("tylenol", "acetaminophen")
+    main.set_alias("acetaminophen", "paracetamol")
+
+    with_index = interactions(client, "warfarin")
+    assert [i["drug"] for i in with_index["interactions"]] == ["miconazole", "paracetamol", "zafirlukast", "lexapro"]
+    assert interactions(client, "tylenol")["drug"] == "paracetamol"
+    assert interactions(client, "aspirin")["total"] == 1
+
+    main.RULE_INDEX_ENABLED = False
+    assert interactions(client, "warfarin") == with_index
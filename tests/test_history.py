@@ -1,19 +1,6 @@
-import importlib.util
 import json
-import pathlib
-import sys
 from fastapi.testclient import TestClient
-
-def load_main():
-    """Dynamically load main.py as the 'main' module."""
-    root = pathlib.Path(__file__).resolve().parents[1]
-    main_path = root / "main.py"
-
-    spec = importlib.util.spec_from_file_location("main", main_path)
-    main = importlib.util.module_from_spec(spec)
-    sys.modules["main"] = main
-    spec.loader.exec_module(main)
-    return main
+from conftest import load_main
 
 
 def test_ensure_history_creates_file(tmp_path):
@@ -0,0 +1,86 @@
+import json
+import threading
+from conftest import load_main
+
+
+def test_append_writes_one_line_per_check(tmp_path):
+    main = load_main()
+    main.HISTORY_PATH = tmp_path / "history.json"
+    main.HISTORY_FORMAT = "ndjson"
+
+    main.append_history("aspirin", "ibuprofen", True, "major")
+    main.append_history("a", "b", False, None)
+
+    lines = main.history_log_path().read_text(encoding="utf-8").splitlines()
+    assert len(lines) == 2
+    assert json.loads(lines[1])["drug_a"] == "a"
+
+    result = main.get_history(limit=1)
+    assert [h["drug_a"] for h in result] == ["a"]
+    assert set(result[0]) == {"drug_a", "drug_b", "found", "severity", "ts"}
+
+
+def test_concurrent_appends_are_not_lost(tmp_path):
+    main = load_main()
+    main.HISTORY_PATH = tmp_path / "history.json"
+    main.HISTORY_FORMAT = "ndjson"
+
+    def worker(n):
+        for i in range(50):
+            main.append_history(f"d{n}", f"e{i}", False, None)
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert len(main.get_history(limit=0)) == 400
+
+
+def test_migrates_json_array_once(tmp_path):
+    main = load_main()
+    main.HISTORY_PATH = tmp_path / "history.json"
+    main.HISTORY_FORMAT = "ndjson"
+    old = [{"drug_a": "x", "drug_b": "y", "found": False, "severity": None, "ts": "2025-01-01T00:00:00Z"}]
+    main.HISTORY_PATH.write_text(json.dumps(old, indent=2), encoding="utf-8")
+
+    main.append_history("aspirin", "ibuprofen", True, "major")
+
+    assert not main.HISTORY_PATH.exists()
+    assert (tmp_path / "history.json.migrated").exists()
+    assert [h["drug_a"] for h in main.get_history(limit=0)] == ["x", "aspirin"]
+
+
+def test_rotation_keeps_tail_reads_across_segments(tmp_path):
+    main = load_main()
+    main.HISTORY_PATH = tmp_path / "history.json"
+    main.HISTORY_FORMAT = "ndjson"
+    main.HISTORY_MAX_BYTES = 500
+    main.HISTORY_MAX_SEGMENTS = 2
+
+    for i in range(60):
+        main.append_history("drug", f"n{i:02d}", False, None)
+
+    assert len(main.history_segments()) == 2
+    tail = main.get_history(limit=12)
+    assert [h["drug_b"] for h in tail] == [f"n{i:02d}" for i in range(48, 60)]
+
+
+def test_old_entries_expire_without_size_rotation(tmp_path):
+    import os
+    import time
+
+    main = load_main()
+    main.HISTORY_PATH = tmp_path / "history.json"
+    main.HISTORY_FORMAT = "ndjson"
+    main.record_history([main.history_entry("old", f"n{i}", False, None, ts="2020-01-01T00:00:00Z") for i in range(3)])
+    log = main.history_log_path()
+    month_ago = time.time() - 30 * 86400
+    os.utime(log, (month_ago, month_ago))
+
+    main.HISTORY_MAX_AGE_DAYS = 7
+    main.append_history("new", "x", False, None)
+
+    assert [h["drug_a"] for h in main.get_history(limit=10)] == ["new"]
+    assert main.history_segments() == []
@@ -0,0 +1,77 @@
+import json
+from fastapi.testclient import TestClient
+from conftest import load_main
+
+
+def get_client(main):
+    main.record_history([
+        main.history_entry("aspirin", "ibuprofen", True, "major", "2025-09-15T10:00:00Z"),
+        main.history_entry("aerius", "ibuprofen", False, None, "2025-09-15T11:00:00Z"),
+        main.history_entry("aspirin", "prednisone", True, "moderate", "2025-09-16T09:00:00Z"),
+        main.history_entry("insulin", "prednisone", True, "moderate", "2025-09-17T09:00:00Z"),
+        main.history_entry("aspirin", "xyz", False, None, "2025-09-18T09:00:00Z"),
+    ])
+    return TestClient(main.app), main
+
+
+def test_filters_by_drug_outcome_and_severity(main_app):
+    client, _ = get_client(main_app)
+
+    by_drug = client.get("/history", params={"drug": " Ibuprofen"}).json()
+    assert [h["drug_a"] for h in by_drug] == ["aspirin", "aerius"]
+
+    misses = client.get("/history", params={"found": "false"}).json()
+    assert [h["drug_b"] for h in misses] == ["ibuprofen", "xyz"]
+
+    moderate = client.get("/history", params={"severity": "moderate", "drug": "aspirin"}).json()
+    assert moderate == [{"drug_a": "aspirin", "drug_b": "prednisone", "found": True, "severity": "moderate", "ts": "2025-09-16T09:00:00Z"}]
+
+
+def test_drug_filter_finds_checks_made_with_a_brand_name(main_app):
+    client, main = get_client(main_app)
+    main.ensure_rules_schema()
+    main.set_alias("tylenol", "acetaminophen")
+
+    client.post("/check", json={"drug_a": "Tylenol", "drug_b": "warfarin"})
+
+    by_brand = client.get("/history", params={"drug": " Tylenol"}).json()
+    assert [(h["drug_a"], h["drug_b"]) for h in by_brand] == [("acetaminophen", "warfarin")]
+    assert client.get("/history", params={"drug": "acetaminophen"}).json() == by_brand
+
+
+def test_time_range_and_cursor_pages(main_app):
+    client, _ = get_client(main_app)
+
+    window = client.get("/history", params={"since": "2025-09-15T10:30:00Z", "until": "2025-09-17"}).json()
+    assert [h["ts"][:10] for h in window] == ["2025-09-15", "2025-09-16"]
+
+    first = client.get("/history", params={"limit": 2})
+    assert [h["drug_b"] for h in first.json()] == ["prednisone", "xyz"]
+    second = client.get("/history", params={"limit": 2, "cursor": first.headers["X-Next-Cursor"]})
+    assert [h["drug_a"] for h in second.json()] == ["aerius", "aspirin"]
+    last = client.get("/history", params={"limit": 2, "cursor": second.headers["X-Next-Cursor"]})
+    assert [h["drug_b"] for h in last.json()] == ["ibuprofen"]
+    assert "X-Next-Cursor" not in last.headers
+
+    assert client.get("/history", params={"since": "yesterday"}).status_code == 400
+
+
+def test_tail_read_uses_the_rowid(main_app):
+    _, main = get_client(main_app)
+
+    with main.db_conn(str(main.history_db_path())) as conn:
+        plan = conn.execute("EXPLAIN QUERY PLAN SELECT * FROM history ORDER BY id DESC LIMIT 50").fetchall()
+        by_drug = conn.execute("EXPLAIN QUERY PLAN SELECT * FROM history WHERE drug_a = 'x' OR drug_b = 'x'").fetchall()
+    assert "SCAN history" in plan[0][3] and "TEMP B-TREE" not in " ".join(p[3] for p in plan)
+    assert all("INDEX" in p[3] for p in by_drug if "history" in p[3])
+
+
+def test_migrates_ndjson_log_into_table(tmp_path):
+    main = load_main()
+    main.HISTORY_PATH = tmp_path / "history.json"
+    log = tmp_path / "history.ndjson"
+    log.write_text(json.dumps(main.history_entry("a", "b", False, None)) + "\n", encoding="utf-8")
+
+    assert [h["drug_a"] for h in main.get_history(limit=0)] == ["a"]
+    assert not log.exists()
+    assert (tmp_path / "history.ndjson.migrated").exists()
@@ -0,0 +1,65 @@
+import sqlite3
+from fastapi.testclient import TestClient
+
+
+def get_client(main, history_format="sqlite"):
+    main.HISTORY_FORMAT = history_format
+    with main.db_conn() as conn:
+        conn.executemany("INSERT INTO rules VALUES (?,?,?,?,?)", [
+            ("aspirin_ibuprofen", "aspirin", "ibuprofen", "major", "Bleeding risk"),
+            ("insulin_prednisone", "insulin", "prednisone", "minor", "Glucose control"),
+        ])
+    return TestClient(main.app), main
+
+
+def check(client, a, b, times=1):
+    for _ in range(times):
+        client.post("/check", json={"drug_a": a, "drug_b": b})
+
+
+def test_stats_are_counted_as_checks_happen(main_app):
+    client, main = get_client(main_app)
+    check(client, "aspirin", "ibuprofen", 3)
+    check(client, "insulin", "prednisone")
+    check(client, "x", "y", 2)
+    check(client, "water", "salt")
+
+    stats = client.get("/history/stats", params={"limit": 5}).json()
+    assert (stats["total"], stats["found"], stats["missed"]) == (7, 4, 3)
+    assert stats["severity"] == {"major": 3, "minor": 1, "none": 3}
+    assert [(p["drug_a"], p["drug_b"], p["hits"]) for p in stats["top_pairs"]] == [
+        ("aspirin", "ibuprofen", 3), ("insulin", "prednisone", 1)]
+    assert [(p["drug_a"], p["drug_b"], p["hits"]) for p in stats["top_missing"]] == [("x", "y", 2), ("salt", "water", 1)]
+    assert sum(h["checks"] for h in stats["hourly"]) == 7
+
+    client.post("/rules", json={"a": "x", "b": "y", "severity": "minor", "description": "now known"})
+    stats = client.get("/history/stats").json()
+    assert [p["drug_a"] for p in stats["top_missing"]] == ["salt"]
+
+
+def test_rebuild_matches_incremental_counts(main_app):
+    client, main = get_client(main_app, "ndjson")
+    check(client, "aspirin", "ibuprofen", 2)
+    check(client, "x", "y")
+    before = client.get("/history/stats").json()
+
+    with sqlite3.connect(main.history_db_path()) as conn:
+        conn.execute("DELETE FROM history_pairs")
+        conn.execute("UPDATE history_severity SET hits = 100")
+    assert client.post("/admin/rebuild-history-stats").json() == {"ok": True, "checks": 3}
+    assert client.get("/history/stats").json() == before
+
+
+def test_existing_history_is_counted_on_first_use(main_app):
+    client, main = get_client(main_app)
+    main.HISTORY_ASYNC = False
+    main.append_history("a", "b", False, None)
+    with sqlite3.connect(main.history_db_path()) as conn:
+        conn.execute("DROP TABLE history_pairs")
+        conn.execute("DROP TABLE history_severity")
+        conn.execute("DROP TABLE history_hourly")
+    main._history_ready.clear()
+
+    stats = client.get("/history/stats").json()
+    assert stats["total"] == 1
+    assert stats["top_missing"][0]["drug_a"] == "a"
@@ -0,0 +1,107 @@
+import threading
+from fastapi.testclient import TestClient
+
+
+def test_checks_are_written_in_batches(main_app, monkeypatch):
+    main = main_app
+    main.HISTORY_FLUSH_INTERVAL = 30
+    batches = []
+    real_record = main.record_history
+    monkeypatch.setattr(main, "record_history", lambda entries: (batches.append(len(entries)), real_record(entries)))
+    client = TestClient(main.app)
+
+    for i in range(5):
+        client.post("/check", json={"drug_a": "x", "drug_b": f"y{i}"})
+    history = client.get("/history").json()
+
+    assert batches == [5]
+    assert [h["drug_b"] for h in history] == [f"y{i}" for i in range(5)]
+
+
+def test_full_queue_drops_and_counts(main_app, monkeypatch):
+    main = main_app
+    main.HISTORY_QUEUE_POLICY = "drop"
+    main.HISTORY_FLUSH_COUNT = 1
+    writing, release = threading.Event(), threading.Event()
+
+    def slow_record(entries):
+        writing.set()
+        release.wait(5)
+
+    monkeypatch.setattr(main, "record_history", slow_record)
+    writer = main.HistoryWriter()
+    writer._queue.maxsize = 1
+    before = main.HISTORY_DROPPED._value.get()
+
+    writer.submit([main.history_entry("a", "b", False, None)])
+    assert writing.wait(5)
+    writer.submit([main.history_entry("a", "c", False, None)])
+    writer.submit([main.history_entry("a", "d", False, None)])
+
+    assert main.HISTORY_DROPPED._value.get() - before == 1
+    release.set()
+    writer.stop()
+
+
+def test_stop_drains_the_queue(main_app):
+    main = main_app
+    main.HISTORY_FLUSH_INTERVAL = 30
+    writer = main.HistoryWriter()
+
+    for i in range(20):
+        writer.submit([main.history_entry("a", f"b{i}", False, None)])
+    writer.stop()
+
+    assert len(main.read_history(0)) == 20
+
+
+def test_flush_returns_while_entries_keep_arriving(main_app):
+    main = main_app
+    main.HISTORY_FLUSH_INTERVAL = 0.05
+    writer = main.HistoryWriter()
+    writer.submit([main.history_entry("a", "first", False, None)])
+    stop = threading.Event()
+
+    def traffic():
+        while not stop.is_set():
+            writer.submit([main.history_entry("a", "more", False, None)])
+
+    threads = [threading.Thread(target=traffic) for _ in range(4)]
+    for t in threads:
+        t.start()
+    try:
+        assert writer.flush(timeout=5)
+        #entries that don't fit in the queue are spilled straight to disk, so "first" isn't always the oldest one
+        assert "first" in [e["drug_b"] for e in main.read_history(0)]
+    finally:
+        stop.set()
+        for t in threads:
+            t.join()
+        writer.stop()
+
+
+def test_submit_during_stop_does_not_start_a_second_writer(main_app):
+    import queue
+
+    main = main_app
+    writer = main.HistoryWriter()
+    late = []
+
+    class RacingQueue(queue.Queue):
+        def put(self, item, *args, **kwargs):
+            if item is writer._STOP and not late:
+                #a request finishing while the server shuts down
+                late.append(True)
+                writer.submit([main.history_entry("a", "late", False, None)])
+            super().put(item, *args, **kwargs)
+
+    writer._queue = RacingQueue()
+    before = set(threading.enumerate())
+    writer.submit([main.history_entry("a", "first", False, None)])
+    stopper = threading.Thread(target=writer.stop, daemon=True)
+    stopper.start()
+    stopper.join(5)
+
+    assert not stopper.is_alive()
+    assert sorted(e["drug_b"] for e in main.read_history(0)) == ["first", "late"]
+    assert [t for t in set(threading.enumerate()) - before if t.name == "history-writer"] == []
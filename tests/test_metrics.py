@@ -0,0 +1,43 @@
+from fastapi.testclient import TestClient
+from conftest import load_main
+
+
+def get_client(main):
+    main.HISTORY_ASYNC = False
+    with main.db_conn() as conn:
+        conn.execute("INSERT INTO rules VALUES ('aspirin_ibuprofen', 'aspirin', 'ibuprofen', 'major', 'Bleeding risk')")
+    return TestClient(main.app), main
+
+
+def sample(main, name, **labels):
+    return main.REGISTRY.get_sample_value(name, labels) or 0.0
+
+
+def test_check_and_history_metrics(main_app):
+    client, main = get_client(main_app)
+    found = sample(main, "check_results_total", found="true", severity="major")
+    missed = sample(main, "check_results_total", found="false", severity="none")
+    hits = sample(main, "cache_requests_total", cache="rule_index", result="hit")
+    written = sample(main, "history_write_bytes_total", format="sqlite")
+
+    client.post("/check", json={"drug_a": "aspirin", "drug_b": "ibuprofen"})
+    client.post("/check", json={"drug_a": "aspirin", "drug_b": "water"})
+
+    assert sample(main, "check_results_total", found="true", severity="major") == found + 1
+    assert sample(main, "check_results_total", found="false", severity="none") == missed + 1
+    assert sample(main, "cache_requests_total", cache="rule_index", result="hit") == hits + 1
+    assert sample(main, "history_write_bytes_total", format="sqlite") > written
+    assert sample(main, "history_file_bytes") > 0
+    assert sample(main, "db_query_seconds_count", statement="select rules") > 0
+
+    body = client.get("/metrics").text
+    assert "db_connection_open_seconds_bucket" in body
+    assert 'history_write_seconds_count{format="sqlite"}' in body
+
+
+def test_statement_labels_stay_short():
+    main = load_main()
+    assert main.statement_label("SELECT id, a, b FROM rules WHERE id > ? ORDER BY id") == "select rules"
+    assert main.statement_label("INSERT INTO history (drug_a) VALUES (?)") == "insert history"
+    assert main.statement_label("UPDATE rules SET severity=? WHERE id=?") == "update rules"
+    assert main.statement_label("PRAGMA journal_mode=WAL") == "pragma"
@@ -0,0 +1,146 @@
+import asyncio
+import httpx
+from fastapi.testclient import TestClient
+from conftest import load_main
+
+
+OVERPASS_ANSWER = {"elements": [
+    {"type": "node", "id": 1, "lat": 40.4170, "lon": -3.7040,
+     "tags": {"amenity": "pharmacy", "name": "Farmacia Sol", "addr:street": "Calle Mayor", "addr:housenumber": "1"}},
+    {"type": "way", "id": 2, "center": {"lat": 40.4200, "lon": -3.7000}, "tags": {"amenity": "pharmacy", "phone": "123"}},
+    {"type": "node", "id": 3, "lat": 40.5000, "lon": -3.7000, "tags": {"amenity": "pharmacy", "name": "Far away"}},
+]}
+
+
+def fake_overpass(calls):
+    def handler(request):
+        calls.append(request.content.decode())
+        return httpx.Response(200, json=OVERPASS_ANSWER)
+    return httpx.MockTransport(handler)
+
+
+def test_pharmacies_are_filtered_sorted_and_cached(tmp_path):
+    main = load_main()
+    calls = []
+    main.pharmacy_upstream = main.OverpassUpstream("http://overpass.test/api", transport=fake_overpass(calls))
+    client = TestClient(main.app)
+
+    resp = client.get("/pharmacies", params={"lat": 40.4168, "lon": -3.7038, "radius": 1000})
+    assert resp.status_code == 200
+    data = resp.json()
+    assert data["count"] == 2
+    assert [p["id"] for p in data["pharmacies"]] == ["node/1", "way/2"]
+    assert data["pharmacies"][0] == {"id": "node/1", "name": "Farmacia Sol", "lat": 40.417, "lon": -3.704,
+                                     "addr": "Calle Mayor, 1", "dist": 28}
+    assert data["pharmacies"][1]["name"] == "Pharmacy"
+    assert "amenity" in calls[0]
+
+    upstream_calls = len(calls)
+    client.get("/pharmacies", params={"lat": 40.4169, "lon": -3.7037, "radius": 900})
+    assert len(calls) == upstream_calls
+
+
+def test_concurrent_requests_share_one_upstream_call():
+    main = load_main()
+
+    class SlowUpstream:
+        calls = 0
+
+        async def fetch(self, south, west, north, east):
+            SlowUpstream.calls += 1
+            await asyncio.sleep(0.05)
+            return [{"id": f"node/{south}_{west}", "name": "P", "lat": south + 0.01, "lon": west + 0.01}]
+
+    main.pharmacy_upstream = SlowUpstream()
+    main.PHARMACY_TILE_DEG = 1.0
+
+    async def run():
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            return await asyncio.gather(*(
+                client.get("/pharmacies", params={"lat": 10.5, "lon": 20.5, "radius": 500}) for _ in range(5)
+            ))
+
+    responses = asyncio.run(run())
+    assert all(r.status_code == 200 for r in responses)
+    assert SlowUpstream.calls == 1
+
+
+def test_tile_cache_expires_and_evicts():
+    main = load_main()
+    cache = main.TileCache(max_tiles=2, ttl=60)
+    cache.put((0, 0), [])
+    cache.put((0, 1), [])
+    cache.get((0, 0))
+    cache.put((0, 2), [])
+    assert cache.get((0, 1)) is None
+    assert cache.get((0, 0)) == []
+
+    cache.ttl = -1
+    assert cache.get((0, 0)) is None
+
+
+def test_bad_input_and_upstream_errors():
+    main = load_main()
+    main.pharmacy_upstream = main.OverpassUpstream(
+        "http://overpass.test/api", transport=httpx.MockTransport(lambda request: httpx.Response(429))
+    )
+    client = TestClient(main.app)
+
+    assert client.get("/pharmacies", params={"lat": 100, "lon": 0}).status_code == 400
+    assert client.get("/pharmacies", params={"lat": 0, "lon": 0, "radius": 50000}).status_code == 400
+    assert client.get("/pharmacies", params={"lat": 0, "lon": 0}).status_code == 502
+
+
+def test_cold_request_makes_one_upstream_call_at_high_latitude():
+    main = load_main()
+    boxes = []
+
+    class BoxUpstream:
+        async def fetch(self, south, west, north, east):
+            boxes.append((south, west, north, east))
+            return [{"id": "node/1", "name": "Apotek", "lat": 64.01, "lon": 10.01},
+                    {"id": "node/2", "name": "Far", "lat": 64.2, "lon": 10.3}]
+
+    main.pharmacy_upstream = BoxUpstream()
+    client = TestClient(main.app)
+
+    resp = client.get("/pharmacies", params={"lat": 64.0, "lon": 10.0, "radius": main.PHARMACY_MAX_RADIUS})
+    assert resp.status_code == 200
+    assert [p["id"] for p in resp.json()["pharmacies"]] == ["node/1"]
+    assert len(boxes) == 1
+    assert len(main.tiles_for_circle(64.0, 10.0, main.PHARMACY_MAX_RADIUS)) > 36
+
+    client.get("/pharmacies", params={"lat": 64.0, "lon": 10.0, "radius": 5000})
+    assert len(boxes) == 1
+
+
+def test_upstream_concurrency_is_capped():
+    main = load_main()
+    main.PHARMACY_TILE_DEG = 1.0
+    main.PHARMACY_UPSTREAM_CONCURRENCY = 2
+    running = []
+
+    class CountingUpstream:
+        active = 0
+
+        async def fetch(self, south, west, north, east):
+            CountingUpstream.active += 1
+            running.append(CountingUpstream.active)
+            await asyncio.sleep(0.02)
+            CountingUpstream.active -= 1
+            return []
+
+    main.pharmacy_upstream = CountingUpstream()
+
+    async def run():
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            return await asyncio.gather(*(
+                client.get("/pharmacies", params={"lat": 10.5 + 3 * i, "lon": 20.5, "radius": 500}) for i in range(6)
+            ))
+
+    responses = asyncio.run(run())
+    assert all(r.status_code == 200 for r in responses)
+    assert len(running) == 6
+    assert max(running) == 2
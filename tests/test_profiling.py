@@ -0,0 +1,68 @@
+from fastapi.testclient import TestClient
+from conftest import load_main
+
+
+def get_client(tmp_path, monkeypatch, **env):
+    #the profiling middleware is only installed when main.py is imported with it turned on, so this can't use main_app
+    monkeypatch.setenv("PROFILE_DIR", str(tmp_path / "profiles"))
+    for key, value in env.items():
+        monkeypatch.setenv(key, value)
+    main = load_main()
+    main.DB_PATH = str(tmp_path / "rules.db")
+    main.HISTORY_PATH = tmp_path / "history.json"
+    main.ensure_rules_schema()
+    with main.db_conn() as conn:
+        conn.execute("INSERT INTO rules VALUES ('aspirin_ibuprofen', 'aspirin', 'ibuprofen', 'major', 'Bleeding risk')")
+    return TestClient(main.app), main
+
+
+def check(client, **headers):
+    return client.post("/check", json={"drug_a": "aspirin", "drug_b": "ibuprofen"}, headers=headers)
+
+
+def test_admin_header_profiles_the_request_including_the_worker_thread(tmp_path, monkeypatch):
+    client, main = get_client(tmp_path, monkeypatch, PROFILE_TOKEN="secret")
+    main.RULE_INDEX_ENABLED = False
+    #since 3.12 the one process-wide profiler already sees the worker thread, so the endpoints are left as they are
+    route = next(r for r in main.app.routes if getattr(r, "path", None) == "/check")
+    assert (route.dependant.call is main.check_interaction) == (not main.PROFILE_PER_THREAD)
+
+    assert "X-Profile-Id" not in check(client).headers
+    assert "X-Profile-Id" not in check(client, **{"X-Profile": "wrong"}).headers
+    resp = check(client, **{"X-Profile": "secret"})
+    assert resp.json()["found"] is True
+    profile_id = resp.headers["X-Profile-Id"]
+
+    listed = client.get("/admin/profiles").json()
+    assert listed["enabled"] and [p["id"] for p in listed["profiles"]] == [profile_id]
+    assert listed["profiles"][0]["method"] == "POST" and listed["profiles"][0]["path"] == "check"
+    assert listed["profiles"][0]["status"] == 200
+
+    text = client.get(f"/admin/profiles/{profile_id}", params={"format": "text", "limit": 400}).text
+    assert "check_interaction" in text and "find_rule" in text and "execute" in text
+
+    raw = client.get(f"/admin/profiles/{profile_id}")
+    assert raw.status_code == 200 and raw.content == (tmp_path / "profiles" / profile_id).read_bytes()
+    assert client.get("/admin/profiles/..%2Fhistory.json").status_code == 404
+
+
+def test_sampling_keeps_a_bounded_ring_of_profiles(tmp_path, monkeypatch):
+    client, main = get_client(tmp_path, monkeypatch, PROFILE_SAMPLE_EVERY="2", PROFILE_KEEP="2")
+
+    ids = [check(client).headers.get("X-Profile-Id") for _ in range(8)]
+    taken = [i for i in ids if i]
+    assert len(taken) == 4
+    assert [p["id"] for p in client.get("/admin/profiles").json()["profiles"]] == taken[:-3:-1]
+    assert len(list((tmp_path / "profiles").iterdir())) == 2
+
+
+def test_nothing_is_installed_when_profiling_is_off(tmp_path, monkeypatch):
+    monkeypatch.delenv("PROFILE_TOKEN", raising=False)
+    monkeypatch.delenv("PROFILE_SAMPLE_EVERY", raising=False)
+    client, main = get_client(tmp_path, monkeypatch)
+
+    assert not any(m.kwargs.get("dispatch") is main.profile_requests for m in main.app.user_middleware)
+    route = next(r for r in main.app.routes if getattr(r, "path", None) == "/check")
+    assert route.dependant.call is main.check_interaction
+    assert "X-Profile-Id" not in check(client, **{"X-Profile": ""}).headers
+    assert client.get("/admin/profiles").json() == {"enabled": False, "keep": 50, "profiles": []}
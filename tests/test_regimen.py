@@ -0,0 +1,50 @@
+from fastapi.testclient import TestClient
+
+
+def get_client(main):
+    with main.db_conn() as conn:
+        conn.executemany("INSERT INTO rules VALUES (?,?,?,?,?)", [
+            ("aspirin_prednisone", "aspirin", "prednisone", "moderate", "GI bleeding"),
+            ("aspirin_ibuprofen", "aspirin", "ibuprofen", "major", "Less cardioprotection"),
+            ("insulin_prednisone", "insulin", "prednisone", "minor", "Glucose control"),
+        ])
+    return TestClient(main.app), main
+
+
+def test_regimen_returns_interactions_sorted_by_severity(main_app):
+    client, main = get_client(main_app)
+
+    resp = client.post("/check/regimen", json={"drugs": ["Prednisone", "insulin", " ASPIRIN", "ibuprofen", "aspirin"]})
+    assert resp.status_code == 200
+    data = resp.json()
+
+    assert data["drugs"] == ["prednisone", "insulin", "aspirin", "ibuprofen"]
+    assert data["pairs_checked"] == 6
+    assert [(i["drug_a"], i["drug_b"], i["severity"]) for i in data["interactions"]] == [
+        ("aspirin", "ibuprofen", "major"),
+        ("aspirin", "prednisone", "moderate"),
+        ("insulin", "prednisone", "minor"),
+    ]
+
+    history = main.get_history(limit=0)
+    assert len(history) == 6
+    assert sum(h["found"] for h in history) == 3
+
+
+def test_regimen_sql_path_matches_index(main_app):
+    client, main = get_client(main_app)
+    drugs = ["aspirin", "ibuprofen", "prednisone", "insulin"] + [f"other{i}" for i in range(40)]
+
+    with_index = client.post("/check/regimen", json={"drugs": drugs}).json()
+    main.RULE_INDEX_ENABLED = False
+    without_index = client.post("/check/regimen", json={"drugs": drugs}).json()
+
+    assert with_index == without_index
+    assert with_index["pairs_checked"] == 44 * 43 // 2
+
+
+def test_regimen_needs_two_distinct_drugs(main_app):
+    client, _ = get_client(main_app)
+
+    assert client.post("/check/regimen", json={"drugs": ["aspirin", "Aspirin "]}).status_code == 400
+    assert client.post("/check/regimen", json={"drugs": ["aspirin"]}).status_code == 422
@@ -0,0 +1,117 @@
+import sqlite3
+import threading
+import time
+from fastapi.testclient import TestClient
+from conftest import load_main
+
+
+RULES = [
+    ("aspirin_ibuprofen", "aspirin", "ibuprofen", "major", "Bleeding risk"),
+    ("insulin_prednisone", "insulin", "prednisone", "moderate", "Glucose control"),
+]
+
+
+def get_client(main):
+    with main.db_conn() as conn:
+        conn.executemany("INSERT INTO rules VALUES (?,?,?,?,?)", RULES)
+    return TestClient(main.app), main
+
+
+def changes(client, **params):
+    resp = client.get("/rules/changes", params=params)
+    assert resp.status_code == 200
+    return resp.json()
+
+
+def test_feed_starts_with_existing_rules_and_sends_only_deltas(tmp_path):
+    #a database filled before the change log existed: only the rules table is there
+    main = load_main()
+    main.DB_PATH = str(tmp_path / "rules.db")
+    main.HISTORY_PATH = tmp_path / "history.json"
+    with sqlite3.connect(main.DB_PATH) as conn:
+        conn.executescript(main.RULES_SCHEMA)
+        conn.executemany("INSERT INTO rules VALUES (?,?,?,?,?)", RULES)
+    client = TestClient(main.app)
+
+    first = changes(client)
+    assert [(c["op"], c["id"]) for c in first["changes"]] == [("upsert", "aspirin_ibuprofen"), ("upsert", "insulin_prednisone")]
+    assert first["changes"][0]["description"] == "Bleeding risk"
+    since = first["next"]
+
+    client.post("/rules", json={"a": "warfarin", "b": "lexapro", "severity": "moderate", "description": "x"})
+    client.put("/rules/lexapro_warfarin", params={"severity": "major", "description": "y"})
+    client.put("/rules/aspirin_ibuprofen", params={"severity": "minor", "description": "z"})
+    client.delete("/rules/insulin_prednisone")
+
+    delta = changes(client, since=since)
+    assert [(c["op"], c["id"]) for c in delta["changes"]] == [
+        ("upsert", "lexapro_warfarin"), ("upsert", "aspirin_ibuprofen"), ("delete", "insulin_prednisone"),
+    ]
+    assert delta["changes"][0]["severity"] == "major"
+    assert delta["changes"][2] == {"seq": delta["next"], "op": "delete", "id": "insulin_prednisone"}
+    assert changes(client, since=delta["next"])["changes"] == []
+
+
+def test_feed_pages_and_follows_bulk_and_alias_writes(main_app):
+    client, main = get_client(main_app)
+    since = changes(client)["next"]
+
+    main.import_rules([{"a": f"drug{i}", "b": "other", "severity": "minor", "description": "d"} for i in range(5)])
+    main.set_alias("aspirin", "acetylsalicylic")
+
+    page = changes(client, since=since, limit=4)
+    assert page["more"] and len(page["changes"]) == 4
+    rest = changes(client, since=page["next"], limit=4)
+    assert not rest["more"]
+    ids = [c["id"] for c in page["changes"] + rest["changes"]]
+    assert ids[-1] == "aspirin_ibuprofen" and len(ids) == 6
+    assert rest["changes"][-1]["a"] == "acetylsalicylic"
+
+
+def test_full_download_header_gives_the_feed_position(main_app):
+    client, _ = get_client(main_app)
+
+    resp = client.get("/rules")
+    since = int(resp.headers["X-Rules-Seq"])
+    client.delete("/rules/aspirin_ibuprofen")
+    assert [c["id"] for c in changes(client, since=since)["changes"]] == ["aspirin_ibuprofen"]
+
+
+def test_long_poll_returns_when_a_rule_changes(main_app):
+    client, _ = get_client(main_app)
+    since = changes(client)["next"]
+    result = {}
+
+    def poll():
+        start = time.monotonic()
+        result["data"] = changes(client, since=since, wait=10)
+        result["took"] = time.monotonic() - start
+
+    t = threading.Thread(target=poll)
+    t.start()
+    time.sleep(0.3)
+    client.delete("/rules/aspirin_ibuprofen")
+    t.join()
+
+    assert [c["op"] for c in result["data"]["changes"]] == ["delete"]
+    assert result["took"] < 5
+
+    start = time.monotonic()
+    assert changes(client, since=result["data"]["next"], wait=0.2)["changes"] == []
+    assert time.monotonic() - start >= 0.2
+
+
+def test_compaction_drops_old_tombstones(main_app):
+    client, main = get_client(main_app)
+    since = changes(client)["next"]
+    client.delete("/rules/aspirin_ibuprofen")
+    client.put("/rules/insulin_prednisone", params={"severity": "minor", "description": "x"})
+    with sqlite3.connect(main.DB_PATH) as conn:
+        conn.execute("UPDATE rule_changes SET ts='2000-01-01T00:00:00Z' WHERE deleted=1")
+
+    main._rule_changes_compacted_at = 0.0
+    latest = changes(client)
+    assert [c["id"] for c in latest["changes"]] == ["insulin_prednisone"]
+
+    assert client.get("/rules/changes", params={"since": since}).status_code == 410
+    assert changes(client, since=latest["next"])["changes"] == []
@@ -0,0 +1,79 @@
+import sqlite3
+from fastapi.testclient import TestClient
+from conftest import load_main
+
+
+def get_client(main):
+    with main.db_conn() as conn:
+        conn.execute("INSERT INTO rules VALUES ('aspirin_ibuprofen', 'aspirin', 'ibuprofen', 'major', 'Bleeding risk')")
+    return TestClient(main.app), main
+
+
+def test_check_is_served_from_index_without_sqlite(main_app, monkeypatch):
+    client, main = get_client(main_app)
+    main.reload_rule_index()
+
+    def no_db(*args, **kwargs):
+        raise AssertionError("check should not open the database")
+
+    monkeypatch.setattr(main.sqlite3, "connect", no_db)
+    resp = client.post("/check", json={"drug_a": "Ibuprofen", "drug_b": " aspirin"})
+    assert resp.status_code == 200
+    assert resp.json()["severity"] == "major"
+
+
+def test_rule_mutations_update_index_in_place(main_app):
+    client, main = get_client(main_app)
+    main.reload_rule_index()
+
+    rule = {"id": "x_y", "a": "Y", "b": "x", "severity": "minor", "description": "first"}
+    assert client.post("/rules", json=rule).status_code == 200
+    assert main.rule_index.get(("x", "y")) == ("x_y", "minor", "first")
+
+    client.put("/rules/x_y", params={"severity": "major", "description": "second"})
+    data = client.post("/check", json={"drug_a": "x", "drug_b": "y"}).json()
+    assert (data["severity"], data["description"]) == ("major", "second")
+
+    client.delete("/rules/x_y")
+    assert client.post("/check", json={"drug_a": "x", "drug_b": "y"}).json()["found"] is False
+
+
+def test_reload_picks_up_external_edits(main_app):
+    client, main = get_client(main_app)
+    main.RULES_SYNC_INTERVAL = 3600
+    main.reload_rule_index()
+
+    with sqlite3.connect(main.DB_PATH) as conn:
+        conn.execute("INSERT INTO rules VALUES ('a_b', 'a', 'b', 'minor', 'added by seed')")
+        conn.commit()
+
+    assert client.post("/check", json={"drug_a": "a", "drug_b": "b"}).json()["found"] is False
+
+    resp = client.post("/admin/reload-rules")
+    assert resp.json() == {"ok": True, "rules": 2}
+    assert client.post("/check", json={"drug_a": "a", "drug_b": "b"}).json()["found"] is True
+
+
+def test_writes_of_another_worker_reach_the_index(main_app):
+    writer_client, writer = get_client(main_app)
+    reader = load_main()
+    reader.DB_PATH = writer.DB_PATH
+    reader.HISTORY_PATH = writer.HISTORY_PATH
+    reader.RULES_SYNC_INTERVAL = 0
+    reader.reload_rule_index()
+    reader_client = TestClient(reader.app)
+    check = {"drug_a": "x", "drug_b": "y"}
+
+    writer_client.post("/rules", json={"id": "x_y", "a": "x", "b": "y", "severity": "minor", "description": "first"})
+    assert reader_client.post("/check", json=check).json()["severity"] == "minor"
+
+    writer_client.put("/rules/x_y", params={"severity": "major", "description": "second"})
+    assert reader_client.post("/check", json=check).json()["description"] == "second"
+
+    writer_client.delete("/rules/x_y")
+    assert reader_client.post("/check", json=check).json()["found"] is False
+
+    #a new epoch (/admin/reload-rules on the writer) makes the reader load everything again
+    writer_client.post("/admin/reload-rules")
+    reader_client.post("/check", json=check)
+    assert reader.rule_index.epoch == writer.rule_index.epoch
@@ -0,0 +1,84 @@
+import sqlite3
+from fastapi.testclient import TestClient
+
+
+def get_client(main):
+    with main.db_conn() as conn:
+        conn.executemany("INSERT INTO rules VALUES (?,?,?,?,?)", [
+            ("aspirin_ibuprofen", "aspirin", "ibuprofen", "major", "Bleeding risk"),
+            ("insulin_prednisone", "insulin", "prednisone", "minor", "Glucose control"),
+        ])
+    return TestClient(main.app), main
+
+
+def test_unchanged_rules_return_304_without_reading_them(main_app, monkeypatch):
+    client, main = get_client(main_app)
+    first = client.get("/rules")
+    one = client.get("/rules/aspirin_ibuprofen")
+    assert first.headers["cache-control"] == "no-cache"
+
+    def no_query(*args, **kwargs):
+        raise AssertionError("a 304 should not read the rules")
+
+    monkeypatch.setattr(main, "fetch_rules_page", no_query)
+    resp = client.get("/rules", headers={"If-None-Match": first.headers["etag"]})
+    assert resp.status_code == 304
+    assert resp.content == b""
+    assert resp.headers["etag"] == first.headers["etag"]
+    resp = client.get("/rules/aspirin_ibuprofen", headers={"If-None-Match": f'W/{one.headers["etag"]}, "x"'})
+    assert resp.status_code == 304
+
+
+def test_writes_change_the_etags(main_app):
+    client, _ = get_client(main_app)
+    list_tag = client.get("/rules").headers["etag"]
+    rule_tag = client.get("/rules/aspirin_ibuprofen").headers["etag"]
+    other_tag = client.get("/rules/insulin_prednisone").headers["etag"]
+
+    client.put("/rules/aspirin_ibuprofen", params={"severity": "minor", "description": "changed"})
+
+    resp = client.get("/rules", headers={"If-None-Match": list_tag})
+    assert resp.status_code == 200
+    assert resp.headers["etag"] != list_tag
+    resp = client.get("/rules/aspirin_ibuprofen", headers={"If-None-Match": rule_tag})
+    assert resp.status_code == 200
+    assert resp.json()["description"] == "changed"
+    assert client.get("/rules/insulin_prednisone", headers={"If-None-Match": other_tag}).status_code == 304
+
+    client.delete("/rules/insulin_prednisone")
+    assert client.get("/rules/insulin_prednisone", headers={"If-None-Match": other_tag}).status_code == 404
+
+
+def test_reload_starts_a_new_epoch(main_app):
+    client, _ = get_client(main_app)
+    tag = client.get("/rules").headers["etag"]
+
+    client.post("/admin/reload-rules")
+    assert client.get("/rules", headers={"If-None-Match": tag}).status_code == 200
+
+
+def test_writes_from_another_process_change_the_etags(main_app):
+    client, main = get_client(main_app)
+    list_tag = client.get("/rules").headers["etag"]
+    rule_tag = client.get("/rules/aspirin_ibuprofen").headers["etag"]
+
+    #another worker or a script writing to app.db, this process's counters never see it
+    with sqlite3.connect(main.DB_PATH) as conn:
+        conn.execute("UPDATE rules SET description='elsewhere' WHERE id='aspirin_ibuprofen'")
+    resp = client.get("/rules/aspirin_ibuprofen", headers={"If-None-Match": rule_tag})
+    assert resp.status_code == 200 and resp.json()["description"] == "elsewhere"
+
+    list_tag = client.get("/rules").headers["etag"]
+    with sqlite3.connect(main.DB_PATH) as conn:
+        conn.execute("DELETE FROM rules WHERE id='insulin_prednisone'")
+    resp = client.get("/rules", headers={"If-None-Match": list_tag})
+    assert resp.status_code == 200 and len(resp.json()) == 1
+
+
+def test_missing_rules_are_never_304(main_app):
+    client, _ = get_client(main_app)
+    tag = client.get("/rules/aspirin_ibuprofen").headers["etag"]
+
+    resp = client.get("/rules/does-not-exist", headers={"If-None-Match": tag})
+    assert resp.status_code == 404
+    assert client.get("/rules/does-not-exist", headers={"If-None-Match": "*"}).status_code == 404
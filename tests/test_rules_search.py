@@ -0,0 +1,92 @@
+import sqlite3
+from fastapi.testclient import TestClient
+from conftest import load_main
+
+
+RULES = [
+    ("azithromycin_ondansetron", "azithromycin", "ondansetron", "moderate", "Can cause QT prolongation and an irregular heart rhythm."),
+    ("aspirin_insulin", "aspirin", "insulin", "moderate", "May increase the risk of hypoglycemia, or low blood sugar."),
+    ("insulin_prednisone", "insulin", "prednisone", "moderate", "Prednisone may interfere with blood glucose control."),
+    ("escitalopram_insulin", "escitalopram", "insulin", "moderate", "Escitalopram with insulin may increase the risk of hypoglycemia."),
+]
+
+
+def get_client(main):
+    with main.db_conn() as conn:
+        conn.executemany("INSERT INTO rules VALUES (?,?,?,?,?)", RULES)
+    return TestClient(main.app), main
+
+
+def search(client, q, **params):
+    resp = client.get("/rules/search", params={"q": q, **params})
+    assert resp.status_code == 200
+    return resp.json()
+
+
+def test_search_indexes_existing_rules_and_highlights_matches(tmp_path):
+    #a database filled before the search index existed: only the rules table is there
+    main = load_main()
+    main.DB_PATH = str(tmp_path / "rules.db")
+    main.HISTORY_PATH = tmp_path / "history.json"
+    with sqlite3.connect(main.DB_PATH) as conn:
+        conn.executescript(main.RULES_SCHEMA)
+        conn.executemany("INSERT INTO rules VALUES (?,?,?,?,?)", RULES)
+    client = TestClient(main.app)
+
+    data = search(client, "QT prolonged")
+    assert data["total"] == 1
+    hit = data["results"][0]
+    assert hit["id"] == "azithromycin_ondansetron"
+    assert "<mark>QT</mark> <mark>prolongation</mark>" in hit["snippet"]
+
+    assert search(client, "hypoglyc*")["total"] == 2
+    assert search(client, "nothing matches this")["results"] == []
+
+
+def test_drug_name_matches_rank_above_description_matches(main_app):
+    client, _ = get_client(main_app)
+
+    ids = [r["id"] for r in search(client, "escitalopram")["results"]]
+    assert ids == ["escitalopram_insulin"]
+    ids = [r["id"] for r in search(client, "prednisone")["results"]]
+    assert ids == ["insulin_prednisone"]
+    scores = [r["score"] for r in search(client, "insulin")["results"]]
+    assert scores == sorted(scores, reverse=True)
+
+
+def test_search_pages(main_app):
+    client, _ = get_client(main_app)
+
+    first = search(client, "insulin", limit=2)
+    assert first["total"] == 3 and first["next_offset"] == 2
+    second = search(client, "insulin", limit=2, offset=2)
+    assert second["next_offset"] is None
+    ids = [r["id"] for r in first["results"] + second["results"]]
+    assert sorted(ids) == ["aspirin_insulin", "escitalopram_insulin", "insulin_prednisone"]
+
+
+def test_index_follows_rule_writes(main_app):
+    client, main = get_client(main_app)
+    search(client, "insulin")
+
+    client.post("/rules", json={"a": "Warfarin", "b": "lexapro", "severity": "moderate", "description": "Bleeding risk"})
+    assert [r["id"] for r in search(client, "bleeding")["results"]] == ["lexapro_warfarin"]
+
+    client.put("/rules/lexapro_warfarin", params={"severity": "major", "description": "Serotonin syndrome"})
+    assert search(client, "bleeding")["total"] == 0
+    assert search(client, "serotonin")["results"][0]["severity"] == "major"
+
+    main.set_alias("lexapro", "escitalopram")
+    assert search(client, "lexapro")["total"] == 0
+    assert search(client, "escitalopram")["total"] == 2
+
+    client.delete("/rules/lexapro_warfarin")
+    assert search(client, "serotonin")["total"] == 0
+
+
+def test_query_syntax_is_not_interpreted(main_app):
+    client, _ = get_client(main_app)
+
+    assert search(client, 'QT AND (heart OR "')["total"] == 0
+    assert search(client, "heart:rhythm")["total"] == 1
+    assert client.get("/rules/search", params={"q": " ** "}).status_code == 400
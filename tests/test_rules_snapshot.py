@@ -0,0 +1,114 @@
+import pathlib
+import sqlite3
+import time
+from fastapi.testclient import TestClient
+from conftest import load_main
+
+
+def get_client(main):
+    main.RULE_SNAPSHOT_PATH = str(pathlib.Path(main.DB_PATH).with_name("rules.snap"))
+    with main.db_conn() as conn:
+        conn.executemany("INSERT INTO rules VALUES (?,?,?,?,?)", [
+            (f"d{i}_e{i}", f"d{i:03d}", f"e{i:03d}", "minor", f"rule {i} – ü") for i in range(300)
+        ] + [("aspirin_ibuprofen", "aspirin", "ibuprofen", "major", "Bleeding risk")])
+    return TestClient(main.app), main
+
+
+def test_snapshot_lookups_match_the_database(main_app):
+    client, main = get_client(main_app)
+    result = main.compile_rules_snapshot()
+    assert result["rules"] == 301
+
+    snap = main.RuleSnapshot(pathlib.Path(main.RULE_SNAPSHOT_PATH))
+    for i in (0, 150, 299):
+        severity, rule_id, body = snap.get((f"d{i:03d}", f"e{i:03d}"))
+        assert (severity, rule_id) == ("minor", f"d{i}_e{i}")
+        assert body == main.encode_check_found("minor", f"rule {i} – ü")
+    assert snap.get(("aspirin", "water")) is None
+    assert snap.get(("zzz", "zzzz")) is None
+
+    resp = client.post("/check", json={"drug_a": "Ibuprofen", "drug_b": "aspirin"})
+    assert resp.json()["severity"] == "major"
+    regimen = client.post("/check/regimen", json={"drugs": ["aspirin", "ibuprofen", "d001"]}).json()
+    assert [i["description"] for i in regimen["interactions"]] == ["Bleeding risk"]
+    assert not main.rule_index.loaded
+
+
+def test_workers_swap_to_a_recompiled_snapshot(main_app):
+    client, main = get_client(main_app)
+    main.SNAPSHOT_REBUILD_DELAY = 0
+    main.SNAPSHOT_CHECK_INTERVAL = 3600
+    assert client.post("/check", json={"drug_a": "x", "drug_b": "y"}).json()["found"] is False
+    old = main.current_snapshot()
+
+    client.post("/rules", json={"a": "x", "b": "y", "severity": "moderate", "description": "new"})
+    deadline = time.time() + 5
+    while main.current_snapshot() is old and time.time() < deadline:
+        time.sleep(0.02)
+
+    assert main.current_snapshot().generation > old.generation
+    assert client.post("/check", json={"drug_a": "x", "drug_b": "y"}).json()["severity"] == "moderate"
+    assert old.get(("aspirin", "ibuprofen"))[0] == "major"
+
+
+def test_older_compile_does_not_replace_a_newer_snapshot(tmp_path, main_app):
+    _, main = get_client(main_app)
+    path = pathlib.Path(main.RULE_SNAPSHOT_PATH)
+    main.compile_rules_snapshot(path)
+    newer = main.RuleSnapshot.read_generation(path)
+
+    real_time_ns = main.time.time_ns
+    main.time.time_ns = lambda: newer - 1
+    try:
+        assert main.compile_rules_snapshot(path)["replaced"] is False
+    finally:
+        main.time.time_ns = real_time_ns
+    assert main.RuleSnapshot.read_generation(path) == newer
+    assert not list(tmp_path.glob("*.tmp"))
+
+
+def test_streamed_compile_keeps_the_key_order(tmp_path, main_app):
+    _, main = get_client(main_app)
+    pairs = [("ab", "x"), ("a1", "abc"), ("a", "b"), ("é", "ö"), ("ab", "ab c"), ("z", "ß")]
+    with sqlite3.connect(main.DB_PATH) as conn:
+        conn.executemany("INSERT INTO rules VALUES (?,?,?,'minor','d')", [(f"{a}_{b}", a, b) for a, b in pairs])
+        conn.commit()
+
+    assert main.compile_rules_snapshot()["rules"] == 301 + len(pairs)
+    snap = main.RuleSnapshot(pathlib.Path(main.RULE_SNAPSHOT_PATH))
+    keys = []
+    for i in range(snap.count):
+        key_at, key_len, _, _ = snap._entry(i)
+        keys.append(snap._mm[key_at:key_at + key_len])
+    assert keys == sorted(keys)
+    for a, b in pairs:
+        assert snap.get((a, b))[1] == f"{a}_{b}"
+    assert not list(tmp_path.glob("*.tmp"))
+
+
+def test_rule_writes_are_answered_before_the_snapshot_is_rebuilt(main_app):
+    client, main = get_client(main_app)
+    main.SNAPSHOT_REBUILD_DELAY = 3600
+    main.SNAPSHOT_CHECK_INTERVAL = 3600
+    check = {"drug_a": "x", "drug_b": "y"}
+    assert client.post("/check", json=check).json()["found"] is False
+    snap = main.current_snapshot()
+
+    client.post("/rules", json={"id": "x_y", "a": "x", "b": "y", "severity": "moderate", "description": "new"})
+    assert client.post("/check", json=check).json()["severity"] == "moderate"
+    client.put("/rules/x_y", params={"severity": "major", "description": "changed"})
+    assert client.post("/check", json=check).json()["description"] == "changed"
+    client.delete("/rules/aspirin_ibuprofen")
+    assert client.post("/check", json={"drug_a": "aspirin", "drug_b": "ibuprofen"}).json()["found"] is False
+    assert main.current_snapshot() is snap
+
+    #another worker mapping the same file sees the writes through the change log too
+    other = load_main()
+    other.DB_PATH, other.RULE_SNAPSHOT_PATH = main.DB_PATH, main.RULE_SNAPSHOT_PATH
+    other_client = TestClient(other.app)
+    assert other_client.post("/check", json=check).json()["description"] == "changed"
+    regimen = other_client.post("/check/regimen", json={"drugs": ["aspirin", "ibuprofen", "x", "y"]}).json()
+    assert [i["description"] for i in regimen["interactions"]] == ["changed"]
+    for timer in (main._snapshot_timer, other._snapshot_timer):
+        if timer is not None:
+            timer.cancel()
@@ -0,0 +1,67 @@
+from fastapi.testclient import TestClient
+
+
+def get_client(main):
+    with main.db_conn() as conn:
+        conn.executemany("INSERT INTO rules VALUES (?,?,?,?,?)", [
+            ("aspirin_ibuprofen", "aspirin", "ibuprofen", "major", "Bleeding risk"),
+            ("sertraline_tramadol", "sertraline", "tramadol", "major", "Serotonin syndrome"),
+        ])
+    return TestClient(main.app), main
+
+
+def test_suggest_finds_misspelled_names(main_app):
+    client, _ = get_client(main_app)
+
+    names = [s["name"] for s in client.get("/drugs/suggest", params={"q": "ibuprofin"}).json()["suggestions"]]
+    assert names[0] == "ibuprofen"
+
+    names = [s["name"] for s in client.get("/drugs/suggest", params={"q": "ser"}).json()["suggestions"]]
+    assert names == ["sertraline"]
+
+
+def test_index_follows_rule_and_alias_changes(main_app):
+    client, main = get_client(main_app)
+    main.reload_rule_index()
+
+    client.post("/rules", json={"id": "warfarin_x", "a": "warfarin", "b": "x", "severity": "minor", "description": ""})
+    assert "warfarin" in main.rule_index.names
+    client.put("/aliases/coumadin", params={"canonical": "warfarin"})
+    assert "coumadin" in main.rule_index.names
+
+    client.delete("/rules/warfarin_x")
+    assert "warfarin" not in main.rule_index.names
+    client.delete("/aliases/coumadin")
+    assert "coumadin" not in main.rule_index.names
+    assert "aspirin" in main.rule_index.names
+
+
+def test_check_miss_returns_did_you_mean(main_app):
+    client, _ = get_client(main_app)
+
+    data = client.post("/check", json={"drug_a": "asprin", "drug_b": "ibuprofen"}).json()
+    assert data["found"] is False
+    assert data["did_you_mean"] == {"asprin": ["aspirin"]}
+
+    assert client.post("/check", json={"drug_a": "aspirin", "drug_b": "ibuprofen"}).json()["did_you_mean"] is None
+
+
+def test_names_only_index_without_the_rule_index(main_app):
+    client, main = get_client(main_app)
+    main.RULE_INDEX_ENABLED = False
+
+    data = client.post("/check", json={"drug_a": "asprin", "drug_b": "tramadol"}).json()
+    assert data["did_you_mean"] == {"asprin": ["aspirin"]}
+    assert not main.rule_index.loaded
+
+    def suggest(q):
+        return [s["name"] for s in client.get("/drugs/suggest", params={"q": q}).json()["suggestions"]]
+
+    client.post("/rules", json={"id": "warfarin_x", "a": "warfarin", "b": "x", "severity": "minor", "description": "d"})
+    assert suggest("warfarn")[0] == "warfarin"
+    client.put("/aliases/coumadin", params={"canonical": "warfarin"})
+    assert "coumadin" in suggest("coumadn")
+    client.delete("/rules/warfarin_x")
+    assert "warfarin" not in suggest("warfarn")
+    assert client.post("/admin/reload-rules").json() == {"ok": True, "rules": 2}
+    assert not main.rule_index.loaded